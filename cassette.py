@@ -0,0 +1,407 @@
+# Copyright 2022 Google LLC
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     https://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+
+"""The module to record API traffic of a scan and replay it offline.
+
+A cassette is a zip archive of interactions, one compressed JSON entry per
+response, with the time the response took. Traffic is captured at the
+transports used by the scanner:
+
+  httplib2  discovery documents, REST calls and token refreshes
+  requests  the GCR registry API
+  async API calls of crawlers (gRPC clients such as the GKE one), recorded
+            as serialized response messages
+  iam       IAM credentials calls, such as the generateAccessToken calls
+            impersonating service accounts, recorded the same way
+
+In replay mode no request leaves the process. A request is answered with
+the next recorded response for the same caller, method, URL and body,
+falling back to the same caller, method and URL because bodies of token
+requests carry timestamps, then to the same method and URL. The caller is
+a hash of the Authorization header, or of the token of gRPC credentials, so
+identities of a scan calling the same URL get their own responses whatever
+the order of the calls. Tokens match between recording and replay as they
+come from replayed token responses. The last response of a key is repeated when a replay makes
+more calls than the recording. Recorded latencies can be injected, scaled
+by a factor.
+
+Errors of gRPC and async calls are recorded with their type, status code
+and reason, and raised again as the same google.api_core or
+googleapiclient exception, so permission denials replay like live ones.
+"""
+
+import asyncio
+import base64
+import collections
+import hashlib
+import importlib
+import json
+import logging
+import os
+import threading
+import time
+import zipfile
+from typing import Any, Deque, Dict, Optional, Tuple
+
+from google.api_core import exceptions as api_exceptions
+from google.rpc import error_details_pb2
+import googleapiclient.errors
+import httplib2
+import requests
+
+from crawlers import basecrawler
+from crawlers import clientpool
+
+
+class CassetteMiss(Exception):
+  """Raised in replay mode for a request that was not recorded."""
+
+
+def _encode(content: Optional[bytes]) -> str:
+  return base64.b64encode(content or b'').decode('ascii')
+
+
+def _decode(content: str) -> bytes:
+  return base64.b64decode(content)
+
+
+def _error_entry(error: Exception) -> Dict[str, Any]:
+  """Describe an API error so that it can be raised again in replay."""
+
+  entry = {'error': repr(error)}
+  if isinstance(error, googleapiclient.errors.HttpError):
+    entry['http_error'] = {'status': error.resp.status,
+                           'content': _encode(error.content),
+                           'uri': error.uri}
+  elif isinstance(error, api_exceptions.GoogleAPICallError):
+    error_class = type(error)
+    entry['api_error'] = {
+        'type': f'{error_class.__module__}.{error_class.__qualname__}',
+        'message': error.message,
+        'reason': getattr(error, 'reason', None),
+        'domain': getattr(error, 'domain', None),
+    }
+  return entry
+
+
+def _rebuild_error(entry: Dict[str, Any]) -> Exception:
+  if 'http_error' in entry:
+    http_error = entry['http_error']
+    return googleapiclient.errors.HttpError(
+        httplib2.Response({'status': http_error['status']}),
+        _decode(http_error['content']), uri=http_error['uri'])
+  if 'api_error' in entry:
+    api_error = entry['api_error']
+    module_name, _, class_name = api_error['type'].rpartition('.')
+    error_class = getattr(importlib.import_module(module_name), class_name)
+    error_info = None
+    if api_error['reason']:
+      error_info = error_details_pb2.ErrorInfo(
+          reason=api_error['reason'], domain=api_error['domain'] or '')
+    return error_class(api_error['message'], error_info=error_info)
+  return RuntimeError(entry['error'])
+
+
+def _message_entry(result: Any) -> Dict[str, Any]:
+  message_class = type(result)
+  return {
+      'type': f'{message_class.__module__}.{message_class.__qualname__}',
+      'content': _encode(message_class.serialize(result))}
+
+
+def _message(entry: Dict[str, Any]) -> Any:
+  module_name, _, class_name = entry['type'].rpartition('.')
+  message_class = getattr(importlib.import_module(module_name), class_name)
+  return message_class.deserialize(_decode(entry['content']))
+
+
+def _authorization(headers: Optional[Dict[str, str]]) -> Optional[str]:
+  for name, value in (headers or {}).items():
+    if name.lower() == 'authorization':
+      return value
+  return None
+
+
+def _body_hash(body: Any) -> str:
+  if body is None:
+    return ''
+  if isinstance(body, str):
+    body = body.encode('utf-8')
+  if not isinstance(body, bytes):
+    body = repr(body).encode('utf-8')
+  return hashlib.sha1(body).hexdigest()
+
+
+class Cassette:
+  """Recorded interactions and the transport hooks that use them.
+
+  Args:
+    path: A path of the cassette archive.
+    mode: 'record' to call APIs and save responses, or 'replay'.
+    latency_scale: In replay mode, a factor applied to recorded latencies
+      before sleeping them. 0 answers immediately.
+  """
+
+  def __init__(self, path: str, mode: str, latency_scale: float = 0.0):
+    if mode not in ('record', 'replay'):
+      raise ValueError(f'Unknown cassette mode {mode}')
+    self.path = path
+    self.mode = mode
+    self.latency_scale = latency_scale
+    self._lock = threading.Lock()
+    self._archive: Optional[zipfile.ZipFile] = None
+    self._recorded = 0
+    # key -> responses not replayed yet; the last one is kept
+    self._exact: Dict[Tuple, Deque[Dict[str, Any]]] = dict()
+    self._by_caller: Dict[Tuple, Deque[Dict[str, Any]]] = dict()
+    self._loose: Dict[Tuple, Deque[Dict[str, Any]]] = dict()
+    self._originals: Dict[str, Any] = dict()
+    self._iam_clients: Optional[clientpool.ClientPool] = None
+    self.misses = 0
+
+  def load(self) -> 'Cassette':
+    with zipfile.ZipFile(self.path) as archive:
+      for name in sorted(archive.namelist()):
+        entry = json.loads(archive.read(name))
+        caller = entry.get('caller', '')
+        exact = (entry['kind'], entry['method'], entry['url'], entry['body'],
+                 caller)
+        by_caller = (entry['kind'], entry['method'], entry['url'], caller)
+        loose = (entry['kind'], entry['method'], entry['url'])
+        self._exact.setdefault(exact, collections.deque()).append(entry)
+        self._by_caller.setdefault(by_caller,
+                                   collections.deque()).append(entry)
+        self._loose.setdefault(loose, collections.deque()).append(entry)
+    logging.info('Loaded %d interactions from %s', sum(
+        len(entries) for entries in self._exact.values()), self.path)
+    return self
+
+  def save(self) -> None:
+    with self._lock:
+      self._archive.close()
+      self._archive = None
+    os.replace(self.path + '.tmp', self.path)
+    logging.info('Recorded %d interactions into %s', self._recorded,
+                 self.path)
+
+  def _record(self, kind: str, method: str, url: str, body: Any,
+              elapsed: float, response: Dict[str, Any],
+              caller: Optional[str] = None) -> None:
+    entry = dict(response, kind=kind, method=method, url=url,
+                 body=_body_hash(body), caller=_body_hash(caller),
+                 elapsed=elapsed)
+    with self._lock:
+      # Entries are compressed as they come, so a recording is not held in
+      # memory. Their names keep the order of the calls.
+      self._archive.writestr('%08d.json' % self._recorded, json.dumps(entry))
+      self._recorded += 1
+
+  def _next(self, kind: str, method: str, url: str, body: Any,
+            caller: Optional[str] = None) -> Dict[str, Any]:
+    caller = _body_hash(caller)
+    with self._lock:
+      entries = self._exact.get((kind, method, url, _body_hash(body), caller))
+      if not entries:
+        entries = self._by_caller.get((kind, method, url, caller))
+      if not entries:
+        entries = self._loose.get((kind, method, url))
+      if not entries:
+        self.misses += 1
+        raise CassetteMiss(f'No recorded response for {method} {url}')
+      return entries.popleft() if len(entries) > 1 else entries[0]
+
+  def _delay(self, entry: Dict[str, Any]) -> float:
+    return entry['elapsed'] * self.latency_scale
+
+  # httplib2, used by googleapiclient and google-auth-httplib2
+
+  def _httplib2_request(self, http, uri, method='GET', body=None,
+                        headers=None, *args, **kwargs):
+    caller = _authorization(headers)
+    if self.mode == 'replay':
+      entry = self._next('http', method, uri, body, caller)
+      time.sleep(self._delay(entry))
+      return httplib2.Response(entry['headers']), _decode(entry['content'])
+    start = time.monotonic()
+    response, content = self._originals['httplib2'](
+        http, uri, method, body, headers, *args, **kwargs)
+    self._record('http', method, uri, body, time.monotonic() - start, {
+        'headers': dict(response, status=str(response.status)),
+        'content': _encode(content)}, caller)
+    return response, content
+
+  # requests, used for the GCR registry API
+
+  def _requests_send(self, adapter, request, *args, **kwargs):
+    caller = _authorization(request.headers)
+    if self.mode == 'replay':
+      entry = self._next('http', request.method, request.url, request.body,
+                         caller)
+      time.sleep(self._delay(entry))
+      response = requests.Response()
+      response.status_code = entry['status']
+      response.headers = requests.structures.CaseInsensitiveDict(
+          entry['headers'])
+      response._content = _decode(entry['content'])  # pylint: disable=protected-access
+      response.url = request.url
+      response.request = request
+      response.connection = adapter
+      return response
+    start = time.monotonic()
+    response = self._originals['requests'](adapter, request, *args, **kwargs)
+    self._record('http', request.method, request.url, request.body,
+                 time.monotonic() - start, {
+                     'status': response.status_code,
+                     'headers': dict(response.headers),
+                     'content': _encode(response.content)}, caller)
+    return response
+
+  # async API calls of crawlers
+
+  async def _async_call(self, method, project_name, func, *args, **kwargs):
+    url = json.dumps([project_name, [repr(arg) for arg in args],
+                      {key: repr(value) for key, value in kwargs.items()}],
+                     sort_keys=True)
+    if self.mode == 'replay':
+      entry = self._next('async', method, url, None)
+      await asyncio.sleep(self._delay(entry))
+      if 'error' in entry:
+        raise _rebuild_error(entry)
+      return _message(entry)
+    start = time.monotonic()
+    try:
+      result = await func(*args, **kwargs)
+    except Exception as e:
+      self._record('async', method, url, None, time.monotonic() - start,
+                   _error_entry(e))
+      raise
+    self._record('async', method, url, None, time.monotonic() - start,
+                 _message_entry(result))
+    return result
+
+  # IAM credentials clients, used to impersonate service accounts
+
+  def _grpc_call(self, client: Any, credentials: Any, method: str,
+                 args: Tuple, kwargs: Dict[str, Any]) -> Any:
+    url = json.dumps([[repr(arg) for arg in args],
+                      {key: repr(value) for key, value in kwargs.items()}],
+                     sort_keys=True)
+    # The token tells callers apart where it is known; calls whose token
+    # differs between recording and replay fall back to the method and URL.
+    caller = getattr(credentials, 'token', None)
+    if self.mode == 'replay':
+      entry = self._next('grpc', method, url, None, caller)
+      time.sleep(self._delay(entry))
+      if 'error' in entry:
+        raise _rebuild_error(entry)
+      return _message(entry)
+    start = time.monotonic()
+    try:
+      result = getattr(client, method)(*args, **kwargs)
+    except Exception as e:
+      self._record('grpc', method, url, None, time.monotonic() - start,
+                   _error_entry(e), caller)
+      raise
+    self._record('grpc', method, url, None, time.monotonic() - start,
+                 _message_entry(result), caller)
+    return result
+
+  def install(
+      self,
+      iam_clients: Optional[clientpool.ClientPool] = None) -> 'Cassette':
+    """Route scanner traffic through the cassette.
+
+    Args:
+      iam_clients: The pool of IAM credentials clients of the scanner. Its
+        clients are replaced with ones calling through the cassette, which
+        in replay mode open no channel.
+    """
+
+    if self.mode == 'replay':
+      self.load()
+    else:
+      self._archive = zipfile.ZipFile(self.path + '.tmp', 'w',
+                                      zipfile.ZIP_DEFLATED)
+    cassette = self
+    self._originals['httplib2'] = httplib2.Http.request
+    self._originals['requests'] = requests.adapters.HTTPAdapter.send
+
+    def httplib2_request(http, *args, **kwargs):
+      return cassette._httplib2_request(http, *args, **kwargs)
+
+    def requests_send(adapter, request, *args, **kwargs):
+      return cassette._requests_send(adapter, request, *args, **kwargs)
+
+    httplib2.Http.request = httplib2_request
+    requests.adapters.HTTPAdapter.send = requests_send
+    basecrawler.ASYNC_CALL_HOOK = self._async_call
+    if iam_clients is not None:
+      self._iam_clients = iam_clients
+      self._originals['iam_factory'] = factory = iam_clients.factory
+      iam_clients.factory = lambda credentials: _CassetteClient(
+          cassette, None if cassette.mode == 'replay' else
+          factory(credentials), credentials)
+    return self
+
+  def close(self) -> None:
+    """Restore the transports and save a recording."""
+
+    if self._originals:
+      httplib2.Http.request = self._originals.pop('httplib2')
+      requests.adapters.HTTPAdapter.send = self._originals.pop('requests')
+      basecrawler.ASYNC_CALL_HOOK = None
+      if 'iam_factory' in self._originals:
+        self._iam_clients.factory = self._originals.pop('iam_factory')
+    if self.mode == 'record':
+      self.save()
+    elif self.misses:
+      logging.warning('%d requests were not found in %s', self.misses,
+                      self.path)
+
+
+class _NoTransport:
+  """Transport of a replaying client, which has no channel to close."""
+
+  def close(self) -> None:
+    pass
+
+
+class _CassetteClient:
+  """A gRPC client whose calls go through a cassette.
+
+  Args:
+    cassette: The cassette recording or replaying the calls.
+    client: The client to call when recording, None when replaying.
+    credentials: Credentials the client was created with.
+  """
+
+  def __init__(self, cassette: Cassette, client: Any, credentials: Any):
+    self._cassette = cassette
+    self._client = client
+    self._credentials = credentials
+
+  @property
+  def transport(self) -> Any:
+    return self._client.transport if self._client is not None else (
+        _NoTransport())
+
+  def __getattr__(self, method: str) -> Any:
+    if method.startswith('_'):
+      raise AttributeError(method)
+
+    def call(*args, **kwargs):
+      return self._cassette._grpc_call(  # pylint: disable=protected-access
+          self._client, self._credentials, method, args, kwargs)
+    return call
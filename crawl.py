@@ -24,12 +24,7 @@ import io
 import sys
 from typing import List, Dict, Any, Tuple
 
-from google.cloud import container_v1
-import googleapiclient
-from googleapiclient import discovery
 from httplib2 import Credentials
-import requests
-from requests.auth import HTTPBasicAuth
 
 
 def infinite_defaultdict():
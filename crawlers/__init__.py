@@ -1,9 +1,13 @@
-from .computecrawler import ComputeManager
-from .dbcrawler import DBManager
-from .gkecrawler import GKEManager
-from .mqcrawler import MQManager
-from .networkcrawler import NetworkManager
-from .serverlesscrawler import ServerlessManager
-from .sourcerepocrawler import SourceRepoManager
-from .storagecrawler import StorageManager
-from .projectcrawler import ProjectManager
\ No newline at end of file
+from . import registry
+
+
+def __getattr__(name):
+  # Managers are imported on first access so that unused API clients are
+  # never loaded.
+  for resource_key, spec in registry.CRAWLERS.items():
+    if spec.class_name == name:
+      return registry.load_crawler(resource_key)
+  if name == 'ProjectManager':
+    from .projectcrawler import ProjectManager
+    return ProjectManager
+  raise AttributeError(f'module {__name__!r} has no attribute {name!r}')
@@ -0,0 +1,333 @@
+"""Bulk inventory of resources from Cloud Asset Inventory.
+
+Instead of listing every resource type in every project, an inventory pages
+through searchAllResources and searchAllIamPolicies once for an organization
+or a folder and groups the results by project. Results are shaped like those
+of the per API crawlers, so the Worker uses them in place of the tasks they
+cover and crawls only the gaps:
+
+* result keys without an asset type below, e.g. gke_images or app_services,
+* asset types whose search failed,
+* asset types returned without the full resource (versionedResources) in a
+  project,
+* projects outside of the scope of the search.
+
+One search runs per asset type, a few at a time, each with its own HTTP
+client. The endpoint can be overridden, e.g. to test against a local fake.
+
+The data of a project is kept until every service account expected to crawl
+it has taken it, so one inventory serves all accounts of a scan.
+"""
+
+import collections
+import concurrent.futures
+import logging
+import sys
+import threading
+from typing import Any, Callable, Dict, Iterable, List, Optional, Set, Tuple
+
+from googleapiclient import discovery
+
+PAGE_SIZE = 500
+SEARCH_WORKERS = 8
+PROJECT_ASSET_TYPE = "cloudresourcemanager.googleapis.com/Project"
+
+# result key -> asset types it is made of
+ASSET_TYPES: Dict[str, Tuple[str, ...]] = {
+    "compute_instances": ("compute.googleapis.com/Instance",),
+    "compute_images": ("compute.googleapis.com/Image",),
+    "compute_disks": ("compute.googleapis.com/Disk",),
+    "static_ips": ("compute.googleapis.com/Address",
+                   "compute.googleapis.com/GlobalAddress"),
+    "compute_snapshots": ("compute.googleapis.com/Snapshot",),
+    "subnets": ("compute.googleapis.com/Subnetwork",),
+    "firewall_rules": ("compute.googleapis.com/Firewall",),
+    "sql_instances": ("sqladmin.googleapis.com/Instance",),
+    "bq": ("bigquery.googleapis.com/Dataset",
+           "bigquery.googleapis.com/Table"),
+    "bigtable_instances": ("bigtableadmin.googleapis.com/Instance",),
+    "spanner_instances": ("spanner.googleapis.com/Instance",),
+    "gke_clusters": ("container.googleapis.com/Cluster",),
+    "pubsub_subs": ("pubsub.googleapis.com/Subscription",),
+    "managed_zones": ("dns.googleapis.com/ManagedZone",),
+    "kms": ("cloudkms.googleapis.com/CryptoKey",),
+    "cloud_functions": ("cloudfunctions.googleapis.com/CloudFunction",),
+    "sourcerepos": ("sourcerepo.googleapis.com/Repository",),
+    "storage_buckets": ("storage.googleapis.com/Bucket",),
+    "filestore_instances": ("file.googleapis.com/Instance",),
+}
+
+
+def _scope_of(resource: Dict[str, Any]) -> str:
+  """Return the aggregatedList key of a regional or global compute resource."""
+  region = resource.get("region")
+  if not region:
+    return "global"
+  return "regions/" + region.rsplit("/", 1)[-1]
+
+
+def _scoped(resources: List[Dict[str, Any]],
+            field: str) -> List[Tuple[str, Dict[str, Any]]]:
+  scopes: Dict[str, List[Dict[str, Any]]] = collections.OrderedDict()
+  for resource in resources:
+    scopes.setdefault(_scope_of(resource), []).append(resource)
+  return [(scope, {field: items}) for scope, items in scopes.items()]
+
+
+def _static_ips(resources: List[Dict[str, Any]]) -> List[Dict[str, Any]]:
+  return [{scope: addresses}
+          for scope, addresses in _scoped(resources, "addresses")]
+
+
+def _bq(resources: List[Dict[str, Any]]) -> Dict[str, List[Dict[str, Any]]]:
+  datasets: Dict[str, List[Dict[str, Any]]] = dict()
+  for resource in resources:
+    if "tableReference" in resource:
+      datasets.setdefault(resource["tableReference"]["datasetId"],
+                          []).append(resource)
+    elif "datasetReference" in resource:
+      datasets.setdefault(resource["datasetReference"]["datasetId"], [])
+  return datasets
+
+
+def _gke_clusters(resources: List[Dict[str, Any]]) -> List[Dict[str, Any]]:
+  # The same fields as gkecrawler.cluster_summary, from the REST form.
+  return [{
+      "name": cluster.get("name", ""),
+      "description": cluster.get("description", ""),
+      "location": cluster.get("location", ""),
+      "workload_pool": cluster.get("workloadIdentityConfig", {}).get(
+          "workloadPool", ""),
+      "node_pools": [{
+          "name": node_pool.get("name", ""),
+          "service_account": node_pool.get("config", {}).get(
+              "serviceAccount", ""),
+          "oauth_scopes": node_pool.get("config", {}).get("oauthScopes", []),
+          "workload_metadata_mode": node_pool.get("config", {}).get(
+              "workloadMetadataConfig", {}).get("mode", "MODE_UNSPECIFIED"),
+      } for node_pool in cluster.get("nodePools", [])],
+  } for cluster in resources]
+
+
+# result key -> function building the crawler result from resources of the
+# key; a plain list of resources by default
+SHAPES: Dict[str, Callable[[List[Dict[str, Any]]], Any]] = {
+    "static_ips": _static_ips,
+    "subnets": lambda resources: _scoped(resources, "subnetworks"),
+    "bq": _bq,
+    "gke_clusters": _gke_clusters,
+    # repos are listed in a single page, None when there are none
+    "sourcerepos": lambda resources: [resources or None],
+    "storage_buckets": lambda resources: {
+        bucket["name"]: (bucket, None) for bucket in resources},
+}
+
+
+def _project_number(result: Dict[str, Any]) -> Optional[str]:
+  project = result.get("project", "")
+  if not project.startswith("projects/"):
+    return None
+  return project[len("projects/"):]
+
+
+class AssetInventory:
+  """Resources and project IAM policies of a scope, grouped by project.
+
+  Args:
+    scope: organizations/NUMBER or folders/NUMBER to search in.
+    credentials: Credentials allowed to search assets of the scope.
+    endpoint: A root URL of the Cloud Asset API, None for the default one.
+    result_keys: Result keys to fill, None for every key in ASSET_TYPES.
+    page_size: Results requested per page.
+    workers: Searches run at the same time.
+    keep: Tells by project id whether to keep the data of a project once
+      searched, e.g. to drop projects of other shards. None to keep all.
+  """
+
+  def __init__(self, scope: str, credentials: Any,
+               endpoint: Optional[str] = None,
+               result_keys: Optional[Iterable[str]] = None,
+               page_size: int = PAGE_SIZE, workers: int = SEARCH_WORKERS,
+               keep: Optional[Callable[[str], bool]] = None):
+    self.scope = scope
+    self.credentials = credentials
+    self.endpoint = endpoint
+    self.result_keys = [key for key in (result_keys or ASSET_TYPES)
+                        if key in ASSET_TYPES]
+    self.page_size = page_size
+    self.workers = workers
+    self.keep = keep
+    self._lock = threading.Lock()
+    # project number -> asset type -> full resources
+    self._assets: Dict[str, Dict[str, List[Dict[str, Any]]]] = dict()
+    # project number -> asset types returned without the full resource
+    self._incomplete: Dict[str, Set[str]] = dict()
+    # project number -> bindings of the project IAM policy, the shape
+    # returned by ProjectManager.get_iam_policy
+    self._policies: Dict[str, List[Dict[str, Any]]] = dict()
+    # numbers of projects in the scope with data left
+    self._projects: Set[str] = set()
+    # project number -> project id, from the project assets
+    self._project_ids: Dict[str, str] = dict()
+    # project number -> crawls expected to take the data of the project
+    self._expected: Dict[str, int] = collections.Counter()
+    self.failed: Set[str] = set()
+    self.pages = 0
+    self.results = 0
+
+  def _service(self) -> Any:
+    client_options = None
+    if self.endpoint is not None:
+      client_options = {"api_endpoint": self.endpoint}
+    return discovery.build("cloudasset", "v1", credentials=self.credentials,
+                           client_options=client_options,
+                           cache_discovery=False)
+
+  def _pages(self, search: str, **params: Any) -> Iterable[Dict[str, Any]]:
+    # googleapiclient HTTP clients are not thread safe, so every search
+    # builds its own.
+    resource = self._service().v1()
+    request = getattr(resource, search)(scope=self.scope,
+                                        pageSize=self.page_size, **params)
+    while request is not None:
+      response = request.execute()
+      with self._lock:
+        self.pages += 1
+      yield response
+      request = getattr(resource, search + "_next")(
+          previous_request=request, previous_response=response)
+
+  def _search_resources(self, asset_type: str) -> None:
+    for response in self._pages(
+        "searchAllResources", assetTypes=[asset_type],
+        readMask="name,assetType,project,versionedResources"):
+      with self._lock:
+        for result in response.get("results", []):
+          number = _project_number(result)
+          if number is None:
+            continue
+          self.results += 1
+          self._projects.add(number)
+          versions = result.get("versionedResources")
+          if asset_type == PROJECT_ASSET_TYPE:
+            if versions and "projectId" in versions[0].get("resource", {}):
+              self._project_ids[number] = versions[0]["resource"]["projectId"]
+            continue
+          if not versions or "resource" not in versions[0]:
+            self._incomplete.setdefault(number, set()).add(asset_type)
+            continue
+          self._assets.setdefault(number, {}).setdefault(
+              asset_type, []).append(versions[0]["resource"])
+
+  def _search_iam_policies(self) -> None:
+    for response in self._pages("searchAllIamPolicies",
+                                assetTypes=[PROJECT_ASSET_TYPE]):
+      with self._lock:
+        for result in response.get("results", []):
+          number = _project_number(result)
+          if number is None or "policy" not in result:
+            continue
+          self.results += 1
+          self._projects.add(number)
+          self._policies[number] = result["policy"].get("bindings", [])
+
+  def load(self) -> "AssetInventory":
+    """Run every search of the scope.
+
+    A failed search leaves the result keys of its asset type to the per API
+    crawlers.
+    """
+
+    searches: Dict[str, Callable[[], None]] = {
+        "iam_policy": self._search_iam_policies,
+        PROJECT_ASSET_TYPE: lambda: self._search_resources(PROJECT_ASSET_TYPE),
+    }
+    for key in self.result_keys:
+      for asset_type in ASSET_TYPES[key]:
+        searches[asset_type] = (
+            lambda asset_type=asset_type: self._search_resources(asset_type))
+
+    logging.info("Searching %d asset types in %s", len(searches), self.scope)
+    with concurrent.futures.ThreadPoolExecutor(
+        max_workers=self.workers, thread_name_prefix="assets") as executor:
+      futures = {executor.submit(search): name
+                 for name, search in searches.items()}
+      for future in concurrent.futures.as_completed(futures):
+        try:
+          future.result()
+        except Exception:
+          logging.info("Failed to search %s in %s", futures[future], self.scope)
+          logging.info(sys.exc_info())
+          self.failed.add(futures[future])
+
+    for asset_type in self.failed:
+      for assets in self._assets.values():
+        assets.pop(asset_type, None)
+    if self.keep is not None:
+      for number, project_id in self._project_ids.items():
+        if not self.keep(project_id):
+          self._drop(number)
+    logging.info("Asset inventory of %s: %s", self.scope, self.stats())
+    return self
+
+  def in_scope(self, project_number: str) -> bool:
+    return str(project_number) in self._projects
+
+  def _drop(self, number: str) -> None:
+    self._projects.discard(number)
+    self._assets.pop(number, None)
+    self._incomplete.pop(number, None)
+    self._policies.pop(number, None)
+    self._expected.pop(number, None)
+
+  def expect(self, project_number: str) -> None:
+    """Keep the data of a project for one more crawl of it."""
+    number = str(project_number)
+    with self._lock:
+      if number in self._projects:
+        self._expected[number] += 1
+
+  def pop_project(
+      self, project_number: str
+  ) -> Tuple[Optional[List[Dict[str, Any]]], Dict[str, Any]]:
+    """Return the IAM policy and the crawler results of a project.
+
+    The data of the project is dropped from the inventory after the last
+    crawl expected to take it.
+
+    Args:
+      project_number: A number of the project.
+
+    Returns:
+      The bindings of the IAM policy, None when not found, and results by
+      result key for the keys the inventory covers in the project.
+    """
+
+    number = str(project_number)
+    with self._lock:
+      if number not in self._projects:
+        return None, {}
+      assets = self._assets.get(number, {})
+      incomplete = self._incomplete.get(number, set())
+      policy = self._policies.get(number)
+      self._expected[number] -= 1
+      if self._expected[number] <= 0:
+        self._drop(number)
+    results = dict()
+    for key in self.result_keys:
+      asset_types = ASSET_TYPES[key]
+      if any(asset_type in self.failed or asset_type in incomplete
+             for asset_type in asset_types):
+        continue
+      resources = [resource for asset_type in asset_types
+                   for resource in assets.get(asset_type, [])]
+      results[key] = SHAPES.get(key, list)(resources)
+    return policy, results
+
+  def stats(self) -> Dict[str, Any]:
+    return {
+        "projects": len(self._projects),
+        "pages": self.pages,
+        "results": self.results,
+        "failed": sorted(self.failed),
+    }
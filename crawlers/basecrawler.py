@@ -1,3 +1,295 @@
+import asyncio
+import collections
+import concurrent.futures
+import functools
+import time
+from typing import Any, Awaitable, Callable, Dict, List, Optional, Set, Tuple
+from urllib.parse import parse_qs, urlparse
+from httplib2 import Credentials
+from . import concurrency
+from . import profiling
+from . import progress
+from . import singleflight
+from .clientpool import credential_key
+from .permcache import (PER_RESOURCE_METHODS, PermissionCache,
+                        is_permission_denied)
+
+
+# Threads running blocking API calls. The pool outlives the event loop of a
+# single Worker run, so a call abandoned at a deadline does not delay the end
+# of the run.
+_EXECUTOR = concurrent.futures.ThreadPoolExecutor(
+    max_workers=concurrency.BLOCKING_THREADS, thread_name_prefix="crawler")
+
+
+# When set, asynchronous API calls are made through it as
+# ASYNC_CALL_HOOK(method, project_name, func, *args, **kwargs), e.g. to record
+# or replay them.
+ASYNC_CALL_HOOK: Optional[Callable[..., Awaitable[Any]]] = None
+
+
+class DeadlineExceeded(Exception):
+  """Raised when a crawler runs out of its time budget."""
+
+
+class PermissionDenied(Exception):
+  """Raised instead of a call that was denied to the identity before."""
+
+
 class Crawler:
-    def __init__(self) -> None:
-        pass
\ No newline at end of file
+  """Base class of resource managers run by the Worker.
+
+  Subclasses list the coroutines they run in tasks(). API requests are sent
+  through _execute so that blocking HTTP calls do not stall the event loop and
+  crawlers of a project can run in parallel.
+
+  task_apis maps result keys to the services a task calls. When the set of
+  services enabled in the project is known, tasks whose services are all
+  disabled are skipped without calling the API.
+
+  With a permission cache set, calls denied to the identity before are not
+  sent again and new denials are recorded.
+
+  Results known before the crawl, e.g. from an asset inventory, are set in
+  prefilled by result key. Their tasks are not run.
+
+  When a deadline is set, requests are refused once it passes. Getters catch
+  the resulting DeadlineExceeded like any other API error and return what they
+  have collected, and crawl() stops before the remaining tasks.
+  """
+
+  task_apis: Dict[str, Tuple[str, ...]] = {}
+
+  def __init__(self, project_name: str, credentials: Credentials):
+    self.project_name = project_name
+    self.credentials = credentials
+    # time.monotonic() value after which no request is sent
+    self.deadline: Optional[float] = None
+    self.results: Dict[str, Any] = dict()
+    self.truncated = False
+    self.resume_token: Optional[str] = None
+    self._current_key: Optional[str] = None
+    # names of services enabled in the project, None when unknown
+    self.enabled_services: Optional[Set[str]] = None
+    # result key -> services of a task skipped because they are disabled
+    self.disabled: Dict[str, Tuple[str, ...]] = dict()
+    # name of the scanning identity, used to key the permission cache
+    self.identity: Optional[str] = None
+    self.permission_cache: Optional[PermissionCache] = None
+    # API methods denied to the identity in this project
+    self.denied: Set[str] = set()
+    # result key -> result obtained without running the task
+    self.prefilled: Dict[str, Any] = dict()
+    # API calls sent, and failed ones by API method
+    self.api_calls = 0
+    self.errors: Dict[str, int] = collections.Counter()
+
+  def tasks(self) -> List[Tuple[str, Callable[[], Awaitable[Any]]]]:
+    """Return (result key, coroutine function) pairs crawled by the manager."""
+    return []
+
+  def _expire(self, resume_token: Optional[str] = None) -> DeadlineExceeded:
+    self.truncated = True
+    self.resume_token = resume_token
+    return DeadlineExceeded(
+        f"Deadline exceeded while crawling {self._current_key} in "
+        f"{self.project_name}")
+
+  async def _run_blocking(self, func: Callable[..., Any], *args: Any,
+                          resume_token: Optional[str] = None,
+                          method: Optional[str] = None,
+                          resource: Optional[str] = None,
+                          **kwargs: Any) -> Any:
+    """Run a blocking call in a worker thread within the crawler deadline.
+
+    A call still running at the deadline is abandoned: its thread finishes in
+    the background and the result is discarded. When method names the API
+    method called, the permission cache is consulted and updated, for the
+    resource called when its permissions are set per resource.
+    """
+
+    call = functools.partial(func, *args, **kwargs)
+    if profiling.ACTIVE is not None:
+      call = profiling.ACTIVE.tagged(call, type(self).__name__, method,
+                                     self.project_name)
+    return await self._guarded(lambda: self._in_thread(call, method),
+                               resume_token, method, limited=False,
+                               resource=resource)
+
+  async def _in_thread(self, call: Callable[[], Any],
+                       method: Optional[str]) -> Any:
+    """Run a call in a worker thread in a slot of its API endpoint.
+
+    The slot is held until the thread is done, also when the caller stops
+    waiting at the deadline. Latency is measured from the start of the call in
+    the thread, so time queued for a thread is not taken for a slow endpoint.
+    """
+
+    loop = asyncio.get_running_loop()
+    limiter = concurrency.LIMITER
+    if limiter is None or method is None:
+      return await loop.run_in_executor(_EXECUTOR, call)
+    endpoint = concurrency.endpoint_of(method)
+    await limiter.acquire(endpoint)
+    timing = dict()
+
+    def timed() -> Any:
+      started = time.monotonic()
+      try:
+        return call()
+      finally:
+        timing["latency"] = time.monotonic() - started
+
+    def finished(future: concurrent.futures.Future) -> None:
+      error = (asyncio.CancelledError() if future.cancelled() else
+               future.exception())
+      release = functools.partial(limiter.release, endpoint,
+                                  timing.get("latency", 0.0), error)
+      try:
+        loop.call_soon_threadsafe(release)
+      except RuntimeError:
+        # The event loop of the run is closed, nobody waits for the slot.
+        release()
+
+    future = _EXECUTOR.submit(timed)
+    future.add_done_callback(finished)
+    return await asyncio.wrap_future(future)
+
+  async def _run_async(self, func: Callable[..., Awaitable[Any]], *args: Any,
+                       method: Optional[str] = None, **kwargs: Any) -> Any:
+    """Await an asynchronous API call like _run_blocking runs a blocking one.
+
+    A call still running at the deadline is cancelled.
+    """
+
+    if ASYNC_CALL_HOOK is not None:
+      return await self._guarded(
+          lambda: ASYNC_CALL_HOOK(method, self.project_name, func, *args,
+                                  **kwargs), None, method)
+    return await self._guarded(lambda: func(*args, **kwargs), None, method)
+
+  async def _guarded(self, start: Callable[[], Awaitable[Any]],
+                     resume_token: Optional[str],
+                     method: Optional[str], limited: bool = True,
+                     resource: Optional[str] = None) -> Any:
+    cache = self.permission_cache if self.identity is not None else None
+    if cache is not None and method is not None:
+      if cache.is_denied(self.identity, self.project_name, method, resource):
+        self.denied.add(method)
+        raise PermissionDenied(
+            f"{method} was denied to {self.identity} in {self.project_name}")
+    reporter = progress.ACTIVE
+    if reporter is not None:
+      reporter.request_started()
+    self.api_calls += 1
+    try:
+      return await self._with_deadline(
+          lambda: self._limited(start, method) if limited else start(),
+          resume_token)
+    except Exception as e:
+      # Deadlines are reported as truncation.
+      if not isinstance(e, DeadlineExceeded):
+        self.errors[method or "unknown"] += 1
+      if method is not None and is_permission_denied(e):
+        self.denied.add(method)
+        if cache is not None:
+          cache.record(self.identity, self.project_name, method, resource)
+      raise
+    finally:
+      if reporter is not None:
+        reporter.request_finished()
+
+  async def _limited(self, start: Callable[[], Awaitable[Any]],
+                     method: Optional[str]) -> Any:
+    """Wait for a slot of the API endpoint, then make the call.
+
+    Time spent waiting counts against the deadline.
+    """
+
+    limiter = concurrency.LIMITER
+    if limiter is None or method is None:
+      return await start()
+    endpoint = concurrency.endpoint_of(method)
+    await limiter.acquire(endpoint)
+    started = time.monotonic()
+    error = None
+    try:
+      return await start()
+    except BaseException as e:
+      error = e
+      raise
+    finally:
+      limiter.release(endpoint, time.monotonic() - started, error)
+
+  async def _with_deadline(self, start: Callable[[], Awaitable[Any]],
+                           resume_token: Optional[str]) -> Any:
+    if self.deadline is None:
+      return await start()
+
+    remaining = self.deadline - time.monotonic()
+    if remaining <= 0:
+      raise self._expire(resume_token)
+    try:
+      return await asyncio.wait_for(start(), timeout=remaining)
+    except asyncio.TimeoutError:
+      raise self._expire(resume_token) from None
+
+  async def _execute(self, request: Any) -> Dict[str, Any]:
+    """Execute a googleapiclient request in a worker thread.
+
+    Identical requests made with the same credentials while this one is in
+    flight share its response.
+    """
+
+    uri = urlparse(request.uri)
+    page_token = parse_qs(uri.query).get("pageToken")
+    key = (credential_key(self.credentials), request.methodId, request.method,
+           request.uri, request.body)
+    # The path names the resource, e.g. /storage/v1/b/<bucket>/o
+    resource = uri.path if request.methodId in PER_RESOURCE_METHODS else None
+    return await self._run_blocking(
+        singleflight.SHARED.do, key, request.execute,
+        resume_token=page_token[0] if page_token else None,
+        method=request.methodId, resource=resource)
+
+  def is_enabled(self, result_key: str) -> bool:
+    """Check whether a service used by a task is enabled in the project."""
+    apis = self.task_apis.get(result_key)
+    if self.enabled_services is None or not apis:
+      return True
+    return any(api in self.enabled_services for api in apis)
+
+  def pending_tasks(self) -> List[str]:
+    """Return result keys that were not crawled to completion."""
+    keys = [result_key for result_key, _ in self.tasks()
+            if result_key not in self.disabled]
+    if not self.truncated:
+      return [key for key in keys if key not in self.results]
+    if self._current_key is None:
+      return keys
+    return keys[keys.index(self._current_key):]
+
+  async def crawl(self) -> Dict[str, Any]:
+    """Run every task of the manager and collect results by key.
+
+    Results are stored in self.results as each task completes, so they
+    survive cancellation of the crawl.
+    """
+
+    for result_key, task in self.tasks():
+      self._current_key = result_key
+      if result_key in self.prefilled:
+        self.results[result_key] = self.prefilled[result_key]
+        continue
+      if self.deadline is not None and time.monotonic() >= self.deadline:
+        self.truncated = True
+        break
+      if not self.is_enabled(result_key):
+        self.disabled[result_key] = self.task_apis[result_key]
+        continue
+      self.results[result_key] = await task()
+      if self.truncated:
+        break
+    else:
+      self._current_key = None
+    return self.results
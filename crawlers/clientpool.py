@@ -0,0 +1,81 @@
+"""Pool of API clients shared by every project scanned with a credential.
+
+Creating a gRPC client opens a channel and performs a TLS handshake. A scan
+uses the same credentials for many projects, so clients are kept per
+credential and handed out again instead of being created per project.
+"""
+
+import collections
+import threading
+from typing import Any, Callable, Dict, Hashable, Optional
+
+
+def credential_key(credentials: Any) -> Hashable:
+  """Return a key identifying credentials.
+
+  Credentials objects are long lived and refreshed in place, so the object
+  identity is what distinguishes them.
+  """
+  return id(credentials)
+
+
+class ClientPool:
+  """LRU pool of clients created on demand for each credential.
+
+  Clients are shared by concurrent users. A client is closed when it is
+  evicted or when the pool is closed, so max_size should exceed the number of
+  credentials used at once.
+  """
+
+  def __init__(self, factory: Callable[[Any], Any], max_size: int = 256,
+               close: Optional[Callable[[Any], Any]] = None):
+    self.factory = factory
+    self.max_size = max_size
+    self.close = close
+    self._clients: 'collections.OrderedDict[Hashable, Any]' = (
+        collections.OrderedDict())
+    # Keeps credentials alive so that their ids are not reused.
+    self._credentials: Dict[Hashable, Any] = dict()
+    self._lock = threading.Lock()
+    self.created = 0
+    self.reused = 0
+    self.evicted = 0
+
+  def get(self, credentials: Any) -> Any:
+    key = credential_key(credentials)
+    evicted = list()
+    with self._lock:
+      client = self._clients.get(key)
+      if client is not None:
+        self._clients.move_to_end(key)
+        self.reused += 1
+        return client
+      client = self.factory(credentials)
+      self._clients[key] = client
+      self._credentials[key] = credentials
+      self.created += 1
+      while len(self._clients) > self.max_size:
+        old_key, old_client = self._clients.popitem(last=False)
+        del self._credentials[old_key]
+        evicted.append(old_client)
+        self.evicted += 1
+    for old_client in evicted:
+      self._close(old_client)
+    return client
+
+  def _close(self, client: Any) -> None:
+    if self.close is not None:
+      self.close(client)
+
+  def close_all(self) -> None:
+    with self._lock:
+      clients = list(self._clients.values())
+      self._clients.clear()
+      self._credentials.clear()
+    for client in clients:
+      self._close(client)
+
+  def stats(self) -> Dict[str, int]:
+    with self._lock:
+      return {'open': len(self._clients), 'created': self.created,
+              'reused': self.reused, 'evicted': self.evicted}
@@ -1,13 +1,20 @@
 import logging
 import sys
-from typing import Dict, Any, List
+from typing import Dict, Any, List, Awaitable, Callable, Tuple
 from httplib2 import Credentials
 from googleapiclient import discovery
+from .basecrawler import Crawler
+
+class ComputeManager(Crawler):
+  task_apis = {
+      result_key: ("compute.googleapis.com",)
+      for result_key in ("compute_instances", "compute_images", "compute_disks",
+                         "static_ips", "compute_snapshots", "subnets",
+                         "firewall_rules")
+  }
 
-class ComputeManager:
   def __init__(self,project_name: str, credentials:Credentials):
-    self.project_name = project_name
-    self.credentials = credentials
+    super().__init__(project_name, credentials)
     self.service = discovery.build('compute', 'v1', credentials=self.credentials, cache_discovery=False)
 
   async def get_compute_instances_names(self) -> List[Dict[str, Any]]:
@@ -26,7 +33,7 @@ class ComputeManager:
     try:
       request = self.service.instances().aggregatedList(project=self.project_name)
       while request is not None:
-        response = request.execute()
+        response = await self._execute(request)
         if response.get("items", None) is not None:
           for _, instances_scoped_list in response["items"].items():
             for instance in instances_scoped_list.get("instances", []):
@@ -57,7 +64,7 @@ class ComputeManager:
     try:
       request = self.service.images().list(project=self.project_name)
       while request is not None:
-        response = request.execute()
+        response = await self._execute(request)
         for image in response.get("items", []):
           images_result.append(image)
 
@@ -85,7 +92,7 @@ class ComputeManager:
     try:
       request = self.service.disks().aggregatedList(project=self.project_name)
       while request is not None:
-        response = request.execute()
+        response = await self._execute(request)
         if response.get("items", None) is not None:
           for _, disks_scoped_list in response["items"].items():
             for disk in disks_scoped_list.get("disks", []):
@@ -117,7 +124,7 @@ class ComputeManager:
     try:
       request = self.service.addresses().aggregatedList(project=self.project_name)
       while request is not None:
-        response = request.execute()
+        response = await self._execute(request)
         for name, addresses_scoped_list in response["items"].items():
           if addresses_scoped_list.get("addresses", None) is None:
             continue
@@ -148,7 +155,7 @@ class ComputeManager:
     try:
       request = self.service.snapshots().list(project=self.project_name)
       while request is not None:
-        response = request.execute()
+        response = await self._execute(request)
         for snapshot in response.get("items", []):
           snapshots_list.append(snapshot)
 
@@ -177,12 +184,12 @@ class ComputeManager:
     try:
       request = self.service.subnetworks().aggregatedList(project=self.project_name)
       while request is not None:
-        response = request.execute()
+        response = await self._execute(request)
         if response.get("items", None) is not None:
           for name, subnetworks_scoped_list in response["items"].items():
             subnets_list.append((name, subnetworks_scoped_list))
 
-        request = self.subnetworks().aggregatedList_next(
+        request = self.service.subnetworks().aggregatedList_next(
             previous_request=request, previous_response=response)
     except Exception:
       logging.info("Failed to get subnets in the %s", self.project_name)
@@ -207,12 +214,9 @@ class ComputeManager:
     try:
       request = self.service.firewalls().list(project=self.project_name)
       while request is not None:
-        response = request.execute()
+        response = await self._execute(request)
         for firewall in response.get("items", []):
-          firewall_rules_list.append((
-              firewall["name"],
-              # firewall['description'],
-          ))
+          firewall_rules_list.append(firewall)
 
         request = self.service.firewalls().list_next(
             previous_request=request, previous_response=response)
@@ -220,6 +224,14 @@ class ComputeManager:
       logging.info("Failed to get firewall rules in the %s", self.project_name)
       logging.info(sys.exc_info())
     return firewall_rules_list
-  
-  def crawl(self):
-    pass
+
+  def tasks(self) -> List[Tuple[str, Callable[[], Awaitable[Any]]]]:
+    return [
+        ("compute_instances", self.get_compute_instances_names),
+        ("compute_images", self.get_compute_images_names),
+        ("compute_disks", self.get_compute_disks_names),
+        ("static_ips", self.get_static_ips),
+        ("compute_snapshots", self.get_compute_snapshots),
+        ("subnets", self.get_subnets),
+        ("firewall_rules", self.get_firewall_rules),
+    ]
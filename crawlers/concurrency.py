@@ -0,0 +1,173 @@
+"""Adaptive limits of concurrent API requests per endpoint.
+
+Each API endpoint, named after the service of a method such as "compute" or
+"cloudkms", has a limit of requests in flight, adjusted with additive
+increase, multiplicative decrease (AIMD):
+
+* every successful round of requests raises the limit by one, so the limit
+  grows by about one per round trip while the endpoint is healthy,
+* a 429 or 5xx response, or a response much slower than the moving average
+  latency of the endpoint, cuts the limit by half. Cuts closer together than
+  one average latency count once, as they come from the same burst.
+
+Requests over the limit wait for a slot. The limiter runs on the event loop
+of the Worker and is shared by all crawlers of the process. stats() may be
+called from other threads, e.g. by the progress reporter.
+"""
+
+import asyncio
+import collections
+import threading
+import time
+from typing import Any, Deque, Dict, Optional
+
+from googleapiclient import errors
+
+# Threads running blocking API calls of crawlers.
+BLOCKING_THREADS = 32
+INITIAL_LIMIT = 16
+MIN_LIMIT = 1
+# Blocking requests over the thread count would only queue for a thread.
+MAX_LIMIT = BLOCKING_THREADS
+DECREASE_FACTOR = 0.5
+# A response slower than this many times the average latency is a spike.
+LATENCY_SPIKE = 4.0
+# Weight of the latest latency in the moving average of an endpoint.
+LATENCY_ALPHA = 0.1
+# Responses needed before latency spikes are detected.
+WARMUP_RESPONSES = 20
+
+OK = "ok"
+OVERLOADED = "overloaded"
+FAILED = "failed"
+
+
+def endpoint_of(method: str) -> str:
+  """Return the endpoint of an API method, e.g. compute for compute.disks.list."""
+  return method.split(".", 1)[0]
+
+
+def classify(error: Optional[BaseException]) -> str:
+  """Tell whether a call succeeded, overloaded the API or failed otherwise."""
+
+  if error is None:
+    return OK
+  status = None
+  if isinstance(error, errors.HttpError):
+    status = error.resp.status
+  elif isinstance(getattr(error, "code", None), int):
+    # google.api_core exceptions carry the HTTP status as code
+    status = error.code
+  if status is not None and (status == 429 or status >= 500):
+    return OVERLOADED
+  return FAILED
+
+
+class _Endpoint:
+
+  def __init__(self, limit: float):
+    self.limit = limit
+    self.in_flight = 0
+    self.waiters: Deque[asyncio.Future] = collections.deque()
+    self.latency: Optional[float] = None
+    self.responses = 0
+    self.cuts = 0
+    self.last_cut = 0.0
+    self.max_in_flight = 0
+
+
+class AdaptiveLimiter:
+  """Per endpoint AIMD limits of requests in flight."""
+
+  def __init__(self, initial: int = INITIAL_LIMIT, min_limit: int = MIN_LIMIT,
+               max_limit: int = MAX_LIMIT):
+    self.initial = initial
+    self.min_limit = min_limit
+    self.max_limit = max_limit
+    self._endpoints: Dict[str, _Endpoint] = dict()
+    # guards _endpoints against stats() iterating it from another thread
+    self._lock = threading.Lock()
+
+  def _endpoint(self, name: str) -> _Endpoint:
+    endpoint = self._endpoints.get(name)
+    if endpoint is None:
+      with self._lock:
+        endpoint = self._endpoints.setdefault(name,
+                                              _Endpoint(float(self.initial)))
+    return endpoint
+
+  async def acquire(self, name: str) -> None:
+    """Wait until a request to the endpoint may be sent."""
+
+    endpoint = self._endpoint(name)
+    if endpoint.in_flight < int(endpoint.limit) and not endpoint.waiters:
+      endpoint.in_flight += 1
+      endpoint.max_in_flight = max(endpoint.max_in_flight, endpoint.in_flight)
+      return
+    waiter = asyncio.get_running_loop().create_future()
+    endpoint.waiters.append(waiter)
+    try:
+      await waiter
+    except asyncio.CancelledError:
+      if waiter.done() and not waiter.cancelled():
+        # The slot was handed over just before the cancellation.
+        self._release_slot(endpoint)
+      else:
+        endpoint.waiters.remove(waiter)
+      raise
+
+  def _release_slot(self, endpoint: _Endpoint) -> None:
+    endpoint.in_flight -= 1
+    while endpoint.waiters and endpoint.in_flight < int(endpoint.limit):
+      waiter = endpoint.waiters.popleft()
+      if waiter.done():
+        continue
+      # The slot passes to the waiter without being released.
+      endpoint.in_flight += 1
+      endpoint.max_in_flight = max(endpoint.max_in_flight, endpoint.in_flight)
+      waiter.set_result(None)
+
+  def release(self, name: str, latency: float,
+              error: Optional[BaseException] = None) -> None:
+    """Free a slot and adjust the limit from the outcome of the request."""
+
+    endpoint = self._endpoint(name)
+    outcome = classify(error)
+    now = time.monotonic()
+    spike = (outcome == OK and endpoint.responses >= WARMUP_RESPONSES
+             and latency > LATENCY_SPIKE * endpoint.latency)
+    if outcome == OVERLOADED or spike:
+      if now - endpoint.last_cut > (endpoint.latency or 0.0):
+        endpoint.limit = max(float(self.min_limit),
+                             endpoint.limit * DECREASE_FACTOR)
+        endpoint.cuts += 1
+        endpoint.last_cut = now
+    elif outcome == OK:
+      # +1 for every limit successful responses, about one per round trip
+      endpoint.limit = min(float(self.max_limit),
+                           endpoint.limit + 1.0 / endpoint.limit)
+    if outcome == OK:
+      endpoint.responses += 1
+      endpoint.latency = (latency if endpoint.latency is None else
+                          LATENCY_ALPHA * latency
+                          + (1 - LATENCY_ALPHA) * endpoint.latency)
+    self._release_slot(endpoint)
+
+  def stats(self) -> Dict[str, Dict[str, Any]]:
+    """Return the current limit and counters of every endpoint."""
+    with self._lock:
+      endpoints = sorted(self._endpoints.items())
+    return {
+        name: {
+            "limit": int(endpoint.limit),
+            "in_flight": endpoint.in_flight,
+            "waiting": len(endpoint.waiters),
+            "max_in_flight": endpoint.max_in_flight,
+            "cuts": endpoint.cuts,
+            "latency_ms": round((endpoint.latency or 0.0) * 1000, 1),
+        } for name, endpoint in endpoints
+    }
+
+
+# The limiter used by crawlers, None to send requests without limits.
+LIMITER: Optional[AdaptiveLimiter] = AdaptiveLimiter()
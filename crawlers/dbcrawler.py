@@ -1,13 +1,20 @@
 import logging
 from googleapiclient import discovery
-from typing import Dict,List,Any
+from typing import Dict, List, Any, Awaitable, Callable, Tuple
 from httplib2 import Credentials
 import sys
+from .basecrawler import Crawler
+
+class DBManager(Crawler):
+  task_apis = {
+      "sql_instances": ("sqladmin.googleapis.com",),
+      "bq": ("bigquery.googleapis.com",),
+      "bigtable_instances": ("bigtableadmin.googleapis.com",),
+      "spanner_instances": ("spanner.googleapis.com",),
+  }
 
-class DBManager:
   def __init__(self,project_name: str,credentials: Credentials):
-    self.project_name = project_name
-    self.credentails = credentials
+    super().__init__(project_name, credentials)
 
     
   async def get_sql_instances(self) -> List[Dict[str, Any]]:
@@ -29,7 +36,7 @@ class DBManager:
 
       request = service.instances().list(project=self.project_name)
       while request is not None:
-        response = request.execute()
+        response = await self._execute(request)
         for database_instance in response.get("items", []):
           sql_instances_list.append(database_instance)
 
@@ -61,7 +68,7 @@ class DBManager:
       request = bq_service.tables().list(
           projectId=project_id, datasetId=dataset_id)
       while request is not None:
-        response = request.execute()
+        response = await self._execute(request)
 
         for table in response.get("tables", []):
           list_of_tables.append(table)
@@ -93,11 +100,11 @@ class DBManager:
 
       request = service.datasets().list(projectId=self.project_name)
       while request is not None:
-        response = request.execute()
+        response = await self._execute(request)
 
         for dataset in response.get("datasets", []):
           dataset_id = dataset["datasetReference"]["datasetId"]
-          bq_datasets[dataset_id] = self.get_bq_tables(self.project_name, dataset_id, service)
+          bq_datasets[dataset_id] = await self.get_bq_tables(self.project_name, dataset_id, service)
 
         request = service.datasets().list_next(
             previous_request=request, previous_response=response)
@@ -126,7 +133,7 @@ class DBManager:
       request = service.projects().instances().list(
           parent=f"projects/{self.project_name}")
       while request is not None:
-        response = request.execute()
+        response = await self._execute(request)
         for instance in response.get("instances", []):
           bigtable_instances_list.append(instance)
 
@@ -159,7 +166,7 @@ class DBManager:
       request = service.projects().instances().list(
           parent=f"projects/{self.project_name}")
       while request is not None:
-        response = request.execute()
+        response = await self._execute(request)
         for instance in response.get("instances", []):
           spanner_instances_list.append(instance)
 
@@ -171,5 +178,10 @@ class DBManager:
       logging.info(sys.exc_info())
     return spanner_instances_list
 
-  def crawl(self):
-    pass
\ No newline at end of file
+  def tasks(self) -> List[Tuple[str, Callable[[], Awaitable[Any]]]]:
+    return [
+        ("sql_instances", self.get_sql_instances),
+        ("bq", self.get_bq),
+        ("bigtable_instances", self.get_bigtable_instances),
+        ("spanner_instances", self.get_spanner_instances),
+    ]
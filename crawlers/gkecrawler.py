@@ -1,40 +1,184 @@
+import asyncio
 import logging
-from typing import List, Tuple,Dict,Any
+from typing import List, Tuple, Dict, Any, AsyncIterator, Awaitable, Callable, Optional
 import sys
+from urllib.parse import urljoin
 from google.cloud import container_v1
 import requests
 from requests.auth import HTTPBasicAuth
-from httplib2 import Credentials
+from . import clientpool
+from .basecrawler import Crawler
 
-class GKEManager:
-  def __init__(self,project_name: str, credentials: Credentials):
-    self.project_name = project_name
-    self.credentials = credentials
-    self.gke_client = container_v1.services.cluster_manager.ClusterManagerClient(credentials=credentials)
+GCR_REGIONS = ["", "us.", "eu.", "asia."]
+GCR_PAGE_SIZE = 1000
+GCR_CONCURRENCY = 16
+GCR_TIMEOUT = 60
+GCR_MAX_REPOSITORIES = 5000
+GCR_MAX_TAGS = 10000
+# Repositories retrieved and not yet consumed before walkers wait.
+GCR_RESULTS_BUFFER = 2 * GCR_CONCURRENCY
 
-  async def get_gke_clusters(self) -> List[Tuple[str, str]]:
+# Async cluster manager clients by credential. Their channels are bound to the
+# event loop of the Worker, which is shared by all projects of a scan.
+CLUSTER_CLIENTS = clientpool.ClientPool(
+    lambda credentials: container_v1.ClusterManagerAsyncClient(
+        credentials=credentials))
+
+
+def cluster_summary(cluster: Any) -> Dict[str, Any]:
+  """Extract identity related details of a GKE cluster."""
+  return {
+      "name": cluster.name,
+      "description": cluster.description,
+      "location": cluster.location,
+      "workload_pool": cluster.workload_identity_config.workload_pool,
+      "node_pools": [{
+          "name": node_pool.name,
+          "service_account": node_pool.config.service_account,
+          "oauth_scopes": list(node_pool.config.oauth_scopes),
+          "workload_metadata_mode":
+              node_pool.config.workload_metadata_config.mode.name,
+      } for node_pool in cluster.node_pools],
+  }
+
+
+class GKEManager(Crawler):
+  task_apis = {
+      "gke_clusters": ("container.googleapis.com",),
+      "gke_images": ("containerregistry.googleapis.com",),
+  }
+
+  async def get_gke_clusters(self) -> List[Dict[str, Any]]:
     """Retrieve a list of GKE clusters available in the project.
 
-    Args:
-      project_name: A name of a project to query info about.
-      gke_client: I do not know TBD.
+    Clusters are listed with an async client whose gRPC channel is shared by
+    every project scanned with the same credentials.
 
     Returns:
-      A list of GKE clusters in the project.
+      A list of GKE clusters in the project with their node pools and
+      workload identity settings.
     """
 
     logging.info("Retrieving list of GKE clusters")
     parent = f"projects/{self.project_name}/locations/-"
     try:
-      clusters = self.gke_client.list_clusters(parent=parent)
-      return [(cluster.name, cluster.description) for cluster in clusters.clusters
-            ]
+      gke_client = CLUSTER_CLIENTS.get(self.credentials)
+      clusters = await self._run_async(
+          gke_client.list_clusters, parent=parent,
+          method="container.projects.locations.clusters.list")
+      return [cluster_summary(cluster) for cluster in clusters.clusters]
     except Exception:
       logging.info("Failed to retrieve cluster list for project %s", self.project_name)
       logging.info(sys.exc_info())
       return []
 
 
+  async def _get_repository(self, session: requests.Session, region: str,
+                            repository: str,
+                            max_tags: int) -> Optional[Dict[str, Any]]:
+    """Retrieve tags, manifests and child repositories of a repository.
+
+    Pages are followed through the Link header of each response.
+
+    Returns:
+      The tags/list JSON object merged over all pages, or None on failure.
+    """
+
+    url = f"https://{region}gcr.io/v2/{repository}/tags/list"
+    params = {"n": GCR_PAGE_SIZE}
+    result = {"name": repository, "child": [], "manifest": {}, "tags": []}
+    while url:
+      res = await self._run_blocking(session.get, url, params=params,
+                                     timeout=GCR_TIMEOUT)
+      if not res.ok:
+        logging.info("Failed to retrieve gcr images list. Status code: %d",
+                    res.status_code)
+        # A failed first page means the repository is not readable.
+        return None if params is not None else result
+      page = res.json()
+      result["child"].extend(page.get("child", []))
+      result["manifest"].update(page.get("manifest", {}))
+      result["tags"].extend(page.get("tags", []))
+      if len(result["tags"]) >= max_tags:
+        del result["tags"][max_tags:]
+        result["truncated"] = True
+        break
+      params = None
+      next_url = res.links.get("next", {}).get("url")
+      url = urljoin(url, next_url) if next_url else None
+    return result
+
+  async def iter_gke_images(
+      self, access_token: str,
+      max_repositories: int = GCR_MAX_REPOSITORIES,
+      max_tags: int = GCR_MAX_TAGS) -> AsyncIterator[Tuple[str, Dict[str, Any]]]:
+    """Walk every repository of the project in all GCR hosts.
+
+    Repositories are fetched concurrently. Each one is yielded as soon as it
+    is retrieved, so callers can process large registries without holding
+    them in memory.
+
+    Args:
+      access_token: An Oauth2 token with permissions to query list of gke images.
+      max_repositories: A maximum number of repositories walked per host.
+      max_tags: A maximum number of tags retrieved per repository.
+
+    Yields:
+      (region, tags/list JSON object) for each repository.
+    """
+
+    project_name = self.project_name.replace(":", "/")
+    session = requests.Session()
+    session.auth = HTTPBasicAuth("oauth2accesstoken", access_token)
+    session.mount("https://", requests.adapters.HTTPAdapter(
+        pool_maxsize=GCR_CONCURRENCY))
+
+    pending: asyncio.Queue = asyncio.Queue()
+    # Bounded, so walkers wait while the caller processes repositories.
+    results: asyncio.Queue = asyncio.Queue(maxsize=GCR_RESULTS_BUFFER)
+    walked = dict()
+    for region in GCR_REGIONS:
+      pending.put_nowait((region, project_name))
+      walked[region] = 1
+
+    async def walk():
+      while True:
+        region, repository = await pending.get()
+        try:
+          if not self.truncated:
+            result = await self._get_repository(session, region, repository,
+                                                max_tags)
+            if result is not None:
+              for child in result["child"]:
+                if walked[region] >= max_repositories:
+                  result["children_truncated"] = True
+                  break
+                walked[region] += 1
+                pending.put_nowait((region, f"{repository}/{child}"))
+              await results.put((region, result))
+        except Exception:
+          logging.info("Failed to retrieve gke images for %s", repository)
+          logging.info(sys.exc_info())
+        finally:
+          pending.task_done()
+
+    async def finish():
+      await pending.join()
+      await results.put(None)
+
+    workers = [asyncio.create_task(walk()) for _ in range(GCR_CONCURRENCY)]
+    workers.append(asyncio.create_task(finish()))
+    try:
+      while True:
+        result = await results.get()
+        if result is None:
+          break
+        yield result
+    finally:
+      for worker in workers:
+        worker.cancel()
+      session.close()
+
   async def get_gke_images(self,access_token: str) -> Dict[str, Any]:
     """Retrieve a list of GKE images available in the project.
 
@@ -43,28 +187,25 @@ class GKEManager:
       access_token: An Oauth2 token with permissions to query list of gke images.
 
     Returns:
-      A gke images JSON object for each accessible zone.
+      For each accessible zone, the tags/list JSON object of the project
+      repository. Nested repositories are under "repositories", by name.
     """
 
     images = dict()
     logging.info("Retrieving list of GKE images")
-    project_name = self.project_name.replace(":", "/")
-    regions = ["", "us.", "eu.", "asia."]
-    for region in regions:
-      gcr_url = f"https://{region}gcr.io/v2/{project_name}/tags/list"
-      try:
-        res = requests.get(
-            gcr_url, auth=HTTPBasicAuth("oauth2accesstoken", access_token))
-        if not res.ok:
-          logging.info("Failed to retrieve gcr images list. Status code: %d",
-                      res.status_code)
-          continue
-        images[region.replace(".", "")] = res.json()
-      except Exception:
-        logging.info("Failed to retrieve gke images for project %s", project_name)
-        logging.info(sys.exc_info())
+    root = self.project_name.replace(":", "/")
+    async for region, repository in self.iter_gke_images(access_token):
+      zone_images = images.setdefault(region.replace(".", ""), dict())
+      if repository["name"] == root:
+        zone_images.update(repository)
+      else:
+        zone_images.setdefault("repositories", dict())[
+            repository["name"]] = repository
 
     return images
 
-  def crawl(self):
-    pass
\ No newline at end of file
+  def tasks(self) -> List[Tuple[str, Callable[[], Awaitable[Any]]]]:
+    return [
+        ("gke_clusters", self.get_gke_clusters),
+        ("gke_images", lambda: self.get_gke_images(self.credentials.token)),
+    ]
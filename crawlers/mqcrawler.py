@@ -1,13 +1,17 @@
-from typing import List,Dict,Any
+from typing import List, Dict, Any, Awaitable, Callable, Tuple
 from httplib2 import Credentials
 from googleapiclient import discovery
 import logging
 import sys
+from .basecrawler import Crawler
+
+class MQManager(Crawler):
+  task_apis = {
+      "pubsub_subs": ("pubsub.googleapis.com",),
+  }
 
-class MQManager:
   def __init__(self,project_name:str,credentials:Credentials):
-    self.project_name = project_name
-    self.credentials = credentials
+    super().__init__(project_name, credentials)
     
   async def get_pubsub_subscriptions(self) -> List[Dict[str, Any]]:
     """Retrieve a list of PubSub subscriptions available in the project.
@@ -29,7 +33,7 @@ class MQManager:
       request = service.projects().subscriptions().list(
           project=f"projects/{self.project_name}")
       while request is not None:
-        response = request.execute()
+        response = await self._execute(request)
         for subscription in response.get("subscriptions", []):
           pubsubs_list.append(subscription)
 
@@ -40,5 +44,7 @@ class MQManager:
       logging.info(sys.exc_info())
     return pubsubs_list
 
-  def crawl(self):
-    pass
\ No newline at end of file
+  def tasks(self) -> List[Tuple[str, Callable[[], Awaitable[Any]]]]:
+    return [
+        ("pubsub_subs", self.get_pubsub_subscriptions),
+    ]
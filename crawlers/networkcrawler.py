@@ -1,13 +1,19 @@
-from typing import List,Any,Dict
+from typing import List, Any, Dict, Awaitable, Callable, Tuple
 from httplib2 import Credentials
 from googleapiclient import discovery
 import logging
 import sys
+from .basecrawler import Crawler
+
+class NetworkManager(Crawler):
+  task_apis = {
+      "managed_zones": ("dns.googleapis.com",),
+      "kms": ("cloudkms.googleapis.com",),
+      "endpoints": ("servicemanagement.googleapis.com",),
+  }
 
-class NetworkManager:
   def __init__(self,project_name:str,credentials:Credentials):
-    self.project_name = project_name
-    self.credentials = credentials
+    super().__init__(project_name, credentials)
   
   async def get_managed_zones(self) -> List[Dict[str, Any]]:
     """Retrieve a list of DNS zones available in the project.
@@ -29,7 +35,7 @@ class NetworkManager:
 
       request = service.managedZones().list(project=self.project_name)
       while request is not None:
-        response = request.execute()
+        response = await self._execute(request)
 
         for managed_zone in response["managedZones"]:
           zones_list.append(managed_zone)
@@ -64,7 +70,7 @@ class NetworkManager:
       locations_list = list()
       request = service.projects().locations().list(name=f"projects/{self.project_name}")
       while request is not None:
-        response = request.execute()
+        response = await self._execute(request)
         for location in response.get("locations", []):
           locations_list.append(location["locationId"])
         request = service.projects().locations().list_next(
@@ -72,14 +78,14 @@ class NetworkManager:
 
       for location_id in locations_list:
         request_loc = service.projects().locations().keyRings().list(
-            parent=f"projects/{self.project_id}/locations/{location_id}")
+            parent=f"projects/{self.project_name}/locations/{location_id}")
         while request_loc is not None:
-          response_loc = request_loc.execute()
+          response_loc = await self._execute(request_loc)
           for keyring in response_loc.get("keyRings", []):
             request = service.projects().locations().keyRings().cryptoKeys().list(
                 parent=keyring["name"])
             while request is not None:
-              response = request.execute()
+              response = await self._execute(request)
               for key in response.get("cryptoKeys", []):
                 kms_keys_list.append(key)
 
@@ -88,9 +94,9 @@ class NetworkManager:
                   previous_request=request, previous_response=response)
 
           request_loc = service.projects().locations().keyRings().list_next(
-              previous_request=request, previous_response=response)
+              previous_request=request_loc, previous_response=response_loc)
     except Exception:
-      logging.info("Failed to retrieve KMS keys for project %s", self.project_id)
+      logging.info("Failed to retrieve KMS keys for project %s", self.project_name)
       logging.info(sys.exc_info())
     return kms_keys_list
 
@@ -117,7 +123,7 @@ class NetworkManager:
 
       request = service.services().list(producerProjectId=self.project_name)
       while request is not None:
-        response = request.execute()
+        response = await self._execute(request)
         for service_entry in response.get("services", []):
           endpoints_list.append(service_entry)
 
@@ -128,5 +134,9 @@ class NetworkManager:
       logging.info(sys.exc_info())
     return endpoints_list
 
-  def crawl(self):
-    pass
\ No newline at end of file
+  def tasks(self) -> List[Tuple[str, Callable[[], Awaitable[Any]]]]:
+    return [
+        ("managed_zones", self.get_managed_zones),
+        ("kms", self.get_kms_keys),
+        ("endpoints", self.get_endpoints),
+    ]
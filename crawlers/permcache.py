@@ -0,0 +1,135 @@
+"""Cache of API calls denied to an identity, persisted between scans.
+
+Low privileged credentials get PERMISSION_DENIED from most APIs. The cache
+remembers every denial by (identity, project, API method) so that the same
+call is not sent again for the next service account iteration or the next
+scan until the entry expires. Methods whose permission is granted per
+resource, such as the objects of a bucket, are also keyed by the resource.
+"""
+
+import json
+import logging
+import os
+import threading
+import time
+from typing import Any, Dict, Optional
+
+import googleapiclient.errors
+
+# Name of the file in the output directory holding cached denials.
+CACHE_FILE = 'permission_denials.json'
+
+DEFAULT_TTL = 24 * 60 * 60
+
+
+# Reasons of 403 errors sent for an API that is disabled in the project.
+SERVICE_DISABLED_REASONS = ('SERVICE_DISABLED', 'accessNotConfigured')
+
+# Methods checked against the IAM policy of a bucket rather than the project.
+PER_RESOURCE_METHODS = frozenset((
+    'storage.buckets.get',
+    'storage.buckets.getIamPolicy',
+    'storage.objects.get',
+    'storage.objects.list',
+))
+
+
+def is_permission_denied(error: Exception) -> bool:
+  """Check whether an API error is a denial of permission.
+
+  Quota and rate limit errors share the 403 status code but are transient,
+  so they are not treated as denials. Neither are errors of an API disabled
+  in the project, which may be enabled before the cache entry expires.
+  """
+
+  if isinstance(error, googleapiclient.errors.HttpError):
+    if error.resp.status != 403:
+      return False
+    try:
+      details = json.loads(error.content.decode('utf-8'))['error']
+    except (ValueError, KeyError, TypeError, AttributeError):
+      return True
+    reasons = [entry.get('reason', '') for entry in
+               details.get('errors', []) + details.get('details', [])
+               if isinstance(entry, dict)]
+    if any(reason in SERVICE_DISABLED_REASONS for reason in reasons):
+      return False
+    if details.get('status') is not None:
+      return details['status'] == 'PERMISSION_DENIED'
+    return not any('rate' in reason.lower() or 'quota' in reason.lower()
+                   for reason in reasons)
+  # google.api_core.exceptions.PermissionDenied raised by gRPC clients
+  if getattr(error, 'code', None) != 403:
+    return False
+  return (getattr(error, 'reason', None) not in SERVICE_DISABLED_REASONS
+          and 'SERVICE_DISABLED' not in str(error))
+
+
+class PermissionCache:
+  """Thread safe record of denied calls keyed by identity, project, method.
+
+  The resource is part of the key when given, for PER_RESOURCE_METHODS.
+  """
+
+  def __init__(self, path: Optional[str] = None, ttl: float = DEFAULT_TTL):
+    self.path = path
+    self.ttl = ttl
+    self._denials: Dict[str, float] = dict()
+    self._lock = threading.Lock()
+    self.hits = 0
+
+  @staticmethod
+  def _key(identity: str, project: str, method: str,
+           resource: Optional[str] = None) -> str:
+    if resource is None:
+      return f'{identity}|{project}|{method}'
+    return f'{identity}|{project}|{method}|{resource}'
+
+  def load(self) -> 'PermissionCache':
+    if self.path is None or not os.path.exists(self.path):
+      return self
+    try:
+      with open(self.path, 'r', encoding='utf-8') as f:
+        denials = json.load(f)
+    except (OSError, ValueError):
+      logging.warning('Ignoring unreadable permission cache %s', self.path)
+      return self
+    now = time.time()
+    with self._lock:
+      self._denials = {key: float(denied_at)
+                       for key, denied_at in denials.items()
+                       if now - float(denied_at) < self.ttl}
+    return self
+
+  def save(self) -> None:
+    if self.path is None:
+      return
+    with self._lock:
+      denials = dict(self._denials)
+    tmp_path = self.path + '.tmp'
+    with open(tmp_path, 'w', encoding='utf-8') as f:
+      json.dump(denials, f, indent=2, sort_keys=True)
+    os.replace(tmp_path, self.path)
+
+  def is_denied(self, identity: str, project: str, method: str,
+                resource: Optional[str] = None) -> bool:
+    key = self._key(identity, project, method, resource)
+    with self._lock:
+      denied_at = self._denials.get(key)
+      if denied_at is None:
+        return False
+      if time.time() - denied_at >= self.ttl:
+        del self._denials[key]
+        return False
+      self.hits += 1
+      return True
+
+  def record(self, identity: str, project: str, method: str,
+             resource: Optional[str] = None) -> None:
+    with self._lock:
+      self._denials[self._key(identity, project, method, resource)] = (
+          time.time())
+
+  def stats(self) -> Dict[str, Any]:
+    with self._lock:
+      return {'denials': len(self._denials), 'hits': self.hits}
@@ -0,0 +1,260 @@
+"""Sampling profiler attributing CPU and memory to crawlers and projects.
+
+A daemon thread samples the Python stacks of all threads at a fixed
+interval. Each sample is prefixed with the project, crawler and API method
+the thread was working on:
+
+* threads running blocking API calls are tagged by Crawler._run_blocking,
+* the event loop thread is attributed by looking for the crawler and the
+  API method in the frames of the running coroutine,
+* scanner stages such as serializing results are tagged with stage().
+
+Memory is traced with tracemalloc at one frame per allocation when asked
+for. Tracing slows down every allocation and takes a snapshot per saved
+project, so it is off by default to keep CPU sampling cheap enough to leave
+on. When a project is saved, the peak of the process since the previous
+saved project and the largest allocation sites are recorded. Projects are
+crawled concurrently, so a peak covers every project in flight during that
+window, not the saved project alone.
+
+Stacks are written in the collapsed format read by flamegraph.pl and
+speedscope, with a text summary of the heaviest functions, crawlers,
+methods, projects and allocation sites.
+"""
+
+import collections
+import contextlib
+import logging
+import os
+import sys
+import threading
+import time
+import tracemalloc
+from typing import Any, Callable, Dict, Iterator, List, Optional, Tuple
+
+PROFILE_DIR = "profile"
+DEFAULT_INTERVAL = 0.01
+DEFAULT_TOP = 25
+# Frames walked from the top of the event loop stack to find the crawler.
+MAX_ATTRIBUTION_DEPTH = 64
+
+# The running profiler, if any. Checked by callers before tagging work.
+ACTIVE: Optional["Profiler"] = None
+
+Tags = Tuple[str, str, str]
+UNTAGGED: Tags = ("-", "-", "-")
+# Functions idle threads block in. Untagged samples ending in them are
+# dropped, so that idle pool threads and the idle loop do not dominate.
+IDLE_FUNCTIONS = frozenset(("select", "_worker", "wait", "poll", "get"))
+
+
+def _frame_name(code: Any, cache: Dict[Any, str]) -> str:
+  name = cache.get(code)
+  if name is None:
+    name = cache[code] = (f"{code.co_name} "
+                          f"({os.path.basename(code.co_filename)}:"
+                          f"{code.co_firstlineno})")
+  return name
+
+
+class Profiler:
+  """Samples thread stacks and traces memory until stopped.
+
+  Args:
+    out_dir: A directory to write profile files into.
+    interval: Seconds between stack samples.
+    top: A number of entries in each table of the summary.
+    memory: Trace memory allocations with tracemalloc.
+  """
+
+  def __init__(self, out_dir: str, interval: float = DEFAULT_INTERVAL,
+               top: int = DEFAULT_TOP, memory: bool = False):
+    self.out_dir = out_dir
+    self.interval = interval
+    self.top = top
+    self.memory = memory
+    # thread id -> (project, crawler, API method) of the current work
+    self._tags: Dict[int, Tags] = dict()
+    self.stacks: Dict[str, int] = collections.Counter()
+    self.samples = 0
+    self.sampling_time = 0.0
+    # project -> (peak traced bytes of the process since the previous saved
+    # project, [(allocation site, bytes)])
+    self.memory_by_project: Dict[str, Tuple[int, List[Tuple[str, int]]]] = {}
+    self._code_names: Dict[Any, str] = dict()
+    self._stopped = threading.Event()
+    self._thread: Optional[threading.Thread] = None
+    self._started = 0.0
+
+  def start(self) -> "Profiler":
+    global ACTIVE
+    ACTIVE = self
+    if self.memory:
+      tracemalloc.start(1)
+    self._started = time.monotonic()
+    self._thread = threading.Thread(target=self._sample_loop,
+                                    name="profiler", daemon=True)
+    self._thread.start()
+    return self
+
+  def stop(self) -> None:
+    global ACTIVE
+    self._stopped.set()
+    if self._thread is not None:
+      self._thread.join()
+    if self.memory and tracemalloc.is_tracing():
+      tracemalloc.stop()
+    ACTIVE = None
+
+  def tagged(self, func: Callable[[], Any], crawler: str,
+             method: Optional[str], project: str) -> Callable[[], Any]:
+    """Wrap a call run in a worker thread to attribute its samples."""
+
+    def call():
+      thread_id = threading.get_ident()
+      self._tags[thread_id] = (project, crawler, method or "-")
+      try:
+        return func()
+      finally:
+        self._tags.pop(thread_id, None)
+    return call
+
+  @contextlib.contextmanager
+  def _stage(self, name: str, project: str) -> Iterator[None]:
+    thread_id = threading.get_ident()
+    previous = self._tags.get(thread_id)
+    self._tags[thread_id] = (project, "scanner", name)
+    try:
+      yield
+    finally:
+      if previous is None:
+        self._tags.pop(thread_id, None)
+      else:
+        self._tags[thread_id] = previous
+
+  def _attribute(self, frame: Any) -> Tags:
+    """Find the crawler and API method of a coroutine running in a loop."""
+    crawler = method = None
+    depth = 0
+    while frame is not None and depth < MAX_ATTRIBUTION_DEPTH:
+      code = frame.f_code
+      if code.co_name == "_guarded" and method is None:
+        method = frame.f_locals.get("method")
+      # Only frames of methods are inspected, f_locals copies the locals.
+      if code.co_argcount and code.co_varnames[0] == "self":
+        owner = frame.f_locals.get("self")
+        if hasattr(owner, "task_apis"):
+          crawler = owner
+      frame = frame.f_back
+      depth += 1
+    if crawler is None:
+      return UNTAGGED
+    return (crawler.project_name, type(crawler).__name__, method or "-")
+
+  def _sample_loop(self) -> None:
+    own_id = threading.get_ident()
+    names = {thread.ident: thread.name for thread in threading.enumerate()}
+    while not self._stopped.wait(self.interval):
+      start = time.perf_counter()
+      for thread_id, frame in sys._current_frames().items():  # pylint: disable=protected-access
+        if thread_id == own_id:
+          continue
+        if thread_id not in names:
+          names = {thread.ident: thread.name
+                   for thread in threading.enumerate()}
+        tags = self._tags.get(thread_id)
+        if tags is None:
+          if frame.f_code.co_name in IDLE_FUNCTIONS:
+            continue
+          tags = (self._attribute(frame)
+                  if names.get(thread_id) == "worker-loop" else UNTAGGED)
+        stack = list()
+        while frame is not None:
+          stack.append(_frame_name(frame.f_code, self._code_names))
+          frame = frame.f_back
+        stack.reverse()
+        key = ";".join([f"project:{tags[0]}", f"crawler:{tags[1]}",
+                        f"method:{tags[2]}"] + stack)
+        self.stacks[key] += 1
+      self.samples += 1
+      self.sampling_time += time.perf_counter() - start
+
+  def project_done(self, project: str) -> None:
+    """Record the process memory peak and allocation sites at a saved project.
+
+    The peak is process wide and covers every project crawled since the
+    previous call, not the saved project alone.
+    """
+
+    if not self.memory or not tracemalloc.is_tracing():
+      return
+    _, peak = tracemalloc.get_traced_memory()
+    snapshot = tracemalloc.take_snapshot().filter_traces((
+        tracemalloc.Filter(False, __file__),
+        tracemalloc.Filter(False, tracemalloc.__file__)))
+    statistics = snapshot.statistics("lineno")
+    self.memory_by_project[project] = (peak, [
+        (f"{os.path.basename(stat.traceback[0].filename)}:"
+         f"{stat.traceback[0].lineno}", stat.size)
+        for stat in statistics[:self.top]])
+    tracemalloc.reset_peak()
+
+  def _totals(self, position: int) -> List[Tuple[str, int]]:
+    totals = collections.Counter()
+    for key, count in self.stacks.items():
+      totals[key.split(";", 3)[position].split(":", 1)[1]] += count
+    return totals.most_common(self.top)
+
+  def write(self) -> None:
+    """Write cpu.collapsed and summary.txt into the profile directory."""
+
+    directory = os.path.join(self.out_dir, PROFILE_DIR)
+    os.makedirs(directory, exist_ok=True)
+    with open(os.path.join(directory, "cpu.collapsed"), "w",
+              encoding="utf-8") as outfile:
+      for key, count in sorted(self.stacks.items()):
+        outfile.write(f"{key} {count}\n")
+
+    self_time = collections.Counter()
+    for key, count in self.stacks.items():
+      self_time[key.rsplit(";", 1)[-1]] += count
+    elapsed = time.monotonic() - self._started
+    lines = [
+        f"{self.samples} samples every {self.interval * 1000:.0f} ms over "
+        f"{elapsed:.1f} s, sampler overhead "
+        f"{100 * self.sampling_time / max(elapsed, 1e-9):.2f}%", ""]
+    for title, rows in (("Functions (self samples)",
+                         self_time.most_common(self.top)),
+                        ("Crawlers", self._totals(1)),
+                        ("API methods", self._totals(2)),
+                        ("Projects", self._totals(0))):
+      lines.append(title)
+      lines.extend(f"  {count:>8}  {name}" for name, count in rows)
+      lines.append("")
+    if self.memory_by_project:
+      lines.append("Process memory peak until each project was saved, since"
+                   " the previous one, with concurrent projects (KiB)")
+      by_peak = sorted(self.memory_by_project.items(),
+                       key=lambda item: item[1][0], reverse=True)
+      for project, (peak, _) in by_peak[:self.top]:
+        lines.append(f"  {peak // 1024:>8}  {project}")
+      lines.append("")
+      sites = collections.Counter()
+      for _, project_sites in self.memory_by_project.values():
+        for site, size in project_sites:
+          sites[site] = max(sites[site], size)
+      lines.append("Allocation sites, largest live size seen (KiB)")
+      lines.extend(f"  {size // 1024:>8}  {site}"
+                   for site, size in sites.most_common(self.top))
+      lines.append("")
+    with open(os.path.join(directory, "summary.txt"), "w",
+              encoding="utf-8") as outfile:
+      outfile.write("\n".join(lines))
+    logging.info("Profile written to %s", directory)
+
+
+def stage(name: str, project: str):
+  """Attribute samples of the calling thread to a scanner stage."""
+  if ACTIVE is None:
+    return contextlib.nullcontext()
+  return ACTIVE._stage(name, project)  # pylint: disable=protected-access
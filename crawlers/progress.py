@@ -0,0 +1,201 @@
+"""Progress and throughput reporting of a scan.
+
+crawl_loop reports queued and finished service accounts and projects, with
+the number of items found per resource type. Crawlers report API requests
+they start and finish. From these, a status line shows projects done out of
+those discovered so far, the service account queue, requests in flight,
+items per second and an ETA from the measured project rate.
+
+Reports are rate limited: at most one status line and one "status" event
+per interval, whatever the number of calls. Events are optionally appended
+to a JSON lines file, one object per line with an "event" field.
+"""
+
+import collections
+import json
+import os
+import sys
+import threading
+import time
+from typing import Any, Dict, Optional, TextIO
+
+from . import concurrency
+
+DEFAULT_INTERVAL = 2.0
+# Weight of the latest project duration in the moving average of durations.
+RATE_ALPHA = 0.1
+
+# The running reporter, if any. Checked by callers before reporting.
+ACTIVE: Optional["Progress"] = None
+
+
+def count_items(value: Any) -> int:
+  """Return the number of resources in a crawler result."""
+  if isinstance(value, (list, dict, tuple)):
+    return len(value)
+  return 1 if value else 0
+
+
+def format_duration(seconds: Optional[float]) -> str:
+  if seconds is None:
+    return "?"
+  seconds = int(seconds)
+  hours, seconds = divmod(seconds, 3600)
+  minutes, seconds = divmod(seconds, 60)
+  if hours:
+    return f"{hours}h{minutes:02d}m"
+  return f"{minutes}m{seconds:02d}s"
+
+
+class Progress:
+  """Counters of a scan and the reporters showing them.
+
+  Args:
+    events_path: A path of a JSON lines file to append events to.
+    interval: Minimum seconds between two status reports.
+    stream: Where the status line is written, None to not show it.
+  """
+
+  def __init__(self, events_path: Optional[str] = None,
+               interval: float = DEFAULT_INTERVAL,
+               stream: Optional[TextIO] = sys.stderr):
+    self.interval = interval
+    self.stream = stream
+    self._events = (open(events_path, "a", encoding="utf-8")
+                    if events_path else None)
+    self._lock = threading.Lock()
+    self.started = time.monotonic()
+    self._last_report = 0.0
+    self.projects_total = 0
+    self.projects_done = 0
+    self.sa_queued = 0
+    self.sa_done = 0
+    self.in_flight = 0
+    self.requests = 0
+    self.items: Dict[str, int] = collections.Counter()
+    # moving average of seconds between finished projects
+    self._project_interval: Optional[float] = None
+    self._last_project = self.started
+
+  def start(self) -> "Progress":
+    global ACTIVE
+    ACTIVE = self
+    self._emit({"event": "start"})
+    return self
+
+  def stop(self) -> None:
+    global ACTIVE
+    self.report(force=True)
+    if self.stream is not None and self.stream.isatty():
+      self.stream.write("\n")
+    self._emit(dict(self.snapshot(), event="finish"))
+    if self._events is not None:
+      self._events.close()
+    ACTIVE = None
+
+  def _emit(self, event: Dict[str, Any]) -> None:
+    if self._events is None:
+      return
+    event["time"] = time.time()
+    # Shards of a scan may share the file.
+    event["pid"] = os.getpid()
+    with self._lock:
+      self._events.write(json.dumps(event) + "\n")
+      self._events.flush()
+
+  def request_started(self) -> None:
+    with self._lock:
+      self.in_flight += 1
+      self.requests += 1
+    self.report()
+
+  def request_finished(self) -> None:
+    with self._lock:
+      self.in_flight -= 1
+
+  def sa_added(self, sa_name: str) -> None:
+    with self._lock:
+      self.sa_queued += 1
+    self._emit({"event": "sa_queued", "service_account": sa_name})
+
+  def sa_finished(self, sa_name: str) -> None:
+    with self._lock:
+      self.sa_done += 1
+    self._emit({"event": "sa_done", "service_account": sa_name})
+    self.report()
+
+  def project_added(self) -> None:
+    with self._lock:
+      self.projects_total += 1
+
+  def project_finished(self, project_id: str, sa_name: str,
+                       results: Dict[str, Any], duration: float) -> None:
+    """Count a finished project and the items found in it."""
+
+    counts = {key: count_items(value) for key, value in results.items()}
+    now = time.monotonic()
+    with self._lock:
+      self.projects_done += 1
+      self.items.update(counts)
+      since_last = now - self._last_project
+      self._last_project = now
+      self._project_interval = (
+          since_last if self._project_interval is None else
+          RATE_ALPHA * since_last + (1 - RATE_ALPHA) * self._project_interval)
+    self._emit({"event": "project_done", "project": project_id,
+                "service_account": sa_name, "duration": duration,
+                "items": counts})
+    self.report()
+
+  def eta(self) -> Optional[float]:
+    """Estimate seconds until the projects discovered so far are done."""
+    remaining = self.projects_total - self.projects_done
+    if remaining <= 0:
+      return 0.0
+    if self._project_interval is None:
+      return None
+    return remaining * self._project_interval
+
+  def snapshot(self) -> Dict[str, Any]:
+    elapsed = time.monotonic() - self.started
+    with self._lock:
+      return {
+          "elapsed": elapsed,
+          "projects_done": self.projects_done,
+          "projects_total": self.projects_total,
+          "sa_queue": self.sa_queued - self.sa_done,
+          "in_flight": self.in_flight,
+          "requests": self.requests,
+          "items_per_second": {
+              key: count / max(elapsed, 1e-9)
+              for key, count in self.items.items()},
+          "eta": self.eta(),
+          "concurrency_limits": {
+              endpoint: stats["limit"] for endpoint, stats in
+              (concurrency.LIMITER.stats() if concurrency.LIMITER else {}).items()},
+      }
+
+  def report(self, force: bool = False) -> None:
+    """Show the status line and emit a status event, at most once per interval."""
+
+    now = time.monotonic()
+    with self._lock:
+      if not force and now - self._last_report < self.interval:
+        return
+      self._last_report = now
+    status = self.snapshot()
+    self._emit(dict(status, event="status"))
+    if self.stream is None:
+      return
+    total_rate = sum(status["items_per_second"].values())
+    line = (f"{status['projects_done']}/{status['projects_total']} projects"
+            f" | SA queue {status['sa_queue']}"
+            f" | {status['in_flight']} requests in flight"
+            f" | {total_rate:.1f} items/s"
+            f" | elapsed {format_duration(status['elapsed'])}"
+            f" | ETA {format_duration(status['eta'])}")
+    if self.stream.isatty():
+      self.stream.write("\r\033[K" + line)
+    else:
+      self.stream.write(line + "\n")
+    self.stream.flush()
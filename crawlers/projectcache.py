@@ -0,0 +1,149 @@
+"""Project metadata shared by every service account of a scan.
+
+Service accounts reached in an organization mostly see the same projects.
+The first listing downloads full project objects. Later listings only ask
+for project ids and numbers, a partial response, which is enough to know
+what the identity sees. Metadata of projects seen for the first time is then
+fetched with concurrent projects.get calls, or with a full listing when
+there are many of them.
+
+Project objects are kept once. For every identity, only the ids of the
+projects it sees are recorded.
+"""
+
+import concurrent.futures
+import threading
+from typing import Any, Dict, Iterable, List, Optional, Tuple
+
+from .projectcrawler import ProjectManager
+
+# Fields of a listing made to learn which projects an identity sees.
+VISIBILITY_FIELDS = "nextPageToken,projects(projectId,projectNumber)"
+# projects.get calls sent at the same time.
+FETCH_WORKERS = 16
+# New projects in a listing above which a full listing is cheaper than
+# fetching them one by one.
+RELIST_THRESHOLD = 50
+
+
+class ProjectCache:
+  """Thread safe cache of project objects and of their visibility.
+
+  Args:
+    fetch_workers: projects.get calls sent at the same time.
+    relist_threshold: New projects in an id listing above which the listing
+      is repeated with full objects.
+  """
+
+  def __init__(self, fetch_workers: int = FETCH_WORKERS,
+               relist_threshold: int = RELIST_THRESHOLD):
+    self.fetch_workers = fetch_workers
+    self.relist_threshold = relist_threshold
+    # project id -> project object
+    self._projects: Dict[str, Dict[str, Any]] = dict()
+    # identity -> ids of the projects it sees, in listing order
+    self._visible: Dict[str, Tuple[str, ...]] = dict()
+    self._lock = threading.Lock()
+    self.full_listings = 0
+    self.id_listings = 0
+    self.fetched = 0
+    self.hits = 0
+
+  def _store(self, projects: Iterable[Dict[str, Any]]) -> None:
+    with self._lock:
+      for project in projects:
+        self._projects[project["projectId"]] = project
+
+  def _get(self, project_id: str) -> Optional[Dict[str, Any]]:
+    with self._lock:
+      return self._projects.get(project_id)
+
+  def _fetch(self, project_ids: List[str], credentials: Any) -> None:
+    """Fetch and store project objects with concurrent projects.get calls."""
+
+    if not project_ids:
+      return
+    with concurrent.futures.ThreadPoolExecutor(
+        max_workers=min(self.fetch_workers, len(project_ids)),
+        thread_name_prefix="projects") as executor:
+      found = executor.map(
+          lambda project_id: ProjectManager(
+              project_id, credentials).fetch_project_info(), project_ids)
+      found = [project for project in found if project]
+    with self._lock:
+      self.fetched += len(project_ids)
+    self._store(found)
+
+  def list_projects(self, identity: str,
+                    credentials: Any) -> List[Dict[str, Any]]:
+    """Return objects of the projects an identity sees.
+
+    Args:
+      identity: A name of the identity, e.g. a service account.
+      credentials: Credentials of the identity.
+
+    Returns:
+      A new list of project objects, shared with other identities.
+    """
+
+    with self._lock:
+      visible = self._visible.get(identity)
+      known = bool(self._projects)
+    if visible is not None:
+      with self._lock:
+        self.hits += 1
+    elif not known:
+      projects = ProjectManager(None, credentials).get_project_list()
+      self.full_listings += 1
+      self._store(projects)
+      visible = tuple(project["projectId"] for project in projects)
+    else:
+      listed = ProjectManager(None, credentials).get_project_list(
+          fields=VISIBILITY_FIELDS)
+      self.id_listings += 1
+      visible = tuple(project["projectId"] for project in listed)
+      new = [project_id for project_id in visible
+             if self._get(project_id) is None]
+      if len(new) > self.relist_threshold:
+        self.full_listings += 1
+        self._store(ProjectManager(None, credentials).get_project_list())
+      else:
+        self._fetch(new, credentials)
+      # Ids and numbers are enough to scan a project whose object could not
+      # be fetched.
+      self._store([project for project in listed
+                   if self._get(project["projectId"]) is None])
+    with self._lock:
+      self._visible[identity] = visible
+      return [self._projects[project_id] for project_id in visible
+              if project_id in self._projects]
+
+  def fetch_projects(self, project_ids: List[str],
+                     credentials: Any) -> List[Dict[str, Any]]:
+    """Return objects of projects named explicitly, fetching unknown ones.
+
+    Args:
+      project_ids: Ids of the projects.
+      credentials: Credentials to fetch the projects with.
+
+    Returns:
+      Project objects in the order of project_ids. A project that could not
+      be fetched is returned with its id and an "N/A" number.
+    """
+
+    self._fetch([project_id for project_id in dict.fromkeys(project_ids)
+                 if self._get(project_id) is None], credentials)
+    return [self._get(project_id)
+            or {"projectId": project_id, "projectNumber": "N/A"}
+            for project_id in project_ids]
+
+  def stats(self) -> Dict[str, int]:
+    with self._lock:
+      return {
+          "projects": len(self._projects),
+          "identities": len(self._visible),
+          "full_listings": self.full_listings,
+          "id_listings": self.id_listings,
+          "fetched": self.fetched,
+          "hits": self.hits,
+      }
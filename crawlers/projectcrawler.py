@@ -1,5 +1,5 @@
 from httplib2 import Credentials
-from typing import Dict,Any,List,Tuple
+from typing import Dict,Any,Iterator,List,Optional,Set,Tuple
 from googleapiclient import discovery
 import logging
 import sys
@@ -40,11 +40,12 @@ class ProjectManager:
     return project_info
 
 
-  def get_project_list(self) -> List[Dict[str, Any]]:
+  def get_project_list(self, fields: Optional[str] = None) -> List[Dict[str, Any]]:
     """Retrieve a list of projects accessible by credentials provided.
 
     Args:
-      credentials: An google.oauth2.credentials.Credentials object.
+      fields: A partial response selector, e.g.
+        "nextPageToken,projects/projectId", None for full project objects.
 
     Returns:
       A list of Project objects from cloudresourcemanager RestAPI.
@@ -58,7 +59,7 @@ class ProjectManager:
           "v1",
           credentials=self.credentials,
           cache_discovery=False)
-      request = service.projects().list()
+      request = service.projects().list(fields=fields)
       while request is not None:
         response = request.execute()
 
@@ -176,6 +177,21 @@ class ProjectManager:
     return service_accounts
 
 
+  def _service_pages(self) -> Iterator[Optional[List[Dict[str, Any]]]]:
+    """Yield pages of services enabled in the project, raising API errors."""
+
+    serviceusage = discovery.build("serviceusage", "v1",
+                                   credentials=self.credentials)
+    request = serviceusage.services().list(
+        parent="projects/" + self.project_name, pageSize=200,
+        filter="state:ENABLED")
+    while request is not None:
+      response = request.execute()
+      yield response.get("services", None)
+
+      request = serviceusage.services().list_next(
+          previous_request=request, previous_response=response)
+
   def list_services(self) -> List[Any]:
     """Retrieve a list of services enabled in the project.
 
@@ -189,19 +205,35 @@ class ProjectManager:
 
     logging.info("Retrieving services list %s", self.project_name)
     list_of_services = list()
-    serviceusage = discovery.build("serviceusage", "v1", credentials=self.credentials)
-
-    request = serviceusage.services().list(
-        parent="projects/" + self.project_name, pageSize=200, filter="state:ENABLED")
     try:
-      while request is not None:
-        response = request.execute()
-        list_of_services.append(response.get("services", None))
+      for services_page in self._service_pages():
+        list_of_services.append(services_page)
+    except Exception:
+      logging.info("Failed to retrieve services for project %s", self.project_name)
+      logging.info(sys.exc_info())
 
-        request = serviceusage.services().list_next(
-            previous_request=request, previous_response=response)
+    return list_of_services
+
+  def get_enabled_services(self) -> Optional[Set[str]]:
+    """Retrieve names of services enabled in the project.
+
+    Returns:
+      A set of service names such as "compute.googleapis.com", or None when
+      the list of services could not be retrieved in full.
+    """
+
+    logging.info("Retrieving services list %s", self.project_name)
+    enabled_services = set()
+    try:
+      for services_page in self._service_pages():
+        for service in services_page or []:
+          enabled_services.add(service["config"]["name"])
     except Exception:
+      # A partial list would mark services of the missing pages disabled.
       logging.info("Failed to retrieve services for project %s", self.project_name)
       logging.info(sys.exc_info())
+      return None
 
-    return list_of_services
\ No newline at end of file
+    if not enabled_services:
+      return None
+    return enabled_services
@@ -0,0 +1,213 @@
+"""Registry of resource crawlers, loaded lazily from the scan config.
+
+Importing a manager module pulls in googleapiclient and, for GKE, the gRPC and
+protobuf stacks. The registry maps each resource key of the scan config to the
+module implementing it, so only crawlers enabled for a scan are imported.
+
+Every entry also declares the crawlers it depends on and a cost estimate. The
+estimate is refined from timings of previous runs and used to start the most
+expensive crawlers first.
+"""
+
+import importlib
+import json
+import logging
+import os
+import time
+from typing import Any, Dict, Iterable, List, NamedTuple, Optional, Tuple
+
+# Seconds a single crawler module may take to import before it is reported.
+IMPORT_TIME_BUDGET = 0.5
+
+# Name of the file in the output directory holding learned crawler costs.
+COST_FILE = 'crawler_costs.json'
+
+
+class CrawlerSpec(NamedTuple):
+  """Declaration of a crawler.
+
+  Attributes:
+    resource_key: A key of the scan config enabling the crawler.
+    module: A module implementing the crawler, relative to this package when
+      it starts with a dot.
+    class_name: A name of the manager class in the module.
+    depends_on: Resource keys that must be crawled before this one.
+    cost: Estimated seconds per project used until timings are learned.
+  """
+  resource_key: str
+  module: str
+  class_name: str
+  depends_on: Tuple[str, ...] = ()
+  cost: float = 1.0
+
+
+CRAWLERS: Dict[str, CrawlerSpec] = dict()
+
+_loaded: Dict[str, Any] = dict()
+_import_times: Dict[str, float] = dict()
+
+
+def register(spec: CrawlerSpec) -> None:
+  """Add a crawler to the registry, replacing any with the same key."""
+  CRAWLERS[spec.resource_key] = spec
+  _loaded.pop(spec.resource_key, None)
+
+
+register(CrawlerSpec('compute_instances', '.computecrawler', 'ComputeManager',
+                     cost=5.0))
+register(CrawlerSpec('db_instances', '.dbcrawler', 'DBManager', cost=4.0))
+register(CrawlerSpec('gke_instances', '.gkecrawler', 'GKEManager', cost=3.0))
+register(CrawlerSpec('mq_instances', '.mqcrawler', 'MQManager', cost=1.0))
+# KMS enumeration fans out over every location and key ring.
+register(CrawlerSpec('network_instances', '.networkcrawler', 'NetworkManager',
+                     cost=6.0))
+register(CrawlerSpec('serverless_instances', '.serverlesscrawler',
+                     'ServerlessManager', cost=2.0))
+register(CrawlerSpec('sourcerepo_instances', '.sourcerepocrawler',
+                     'SourceRepoManager', cost=1.0))
+# Bucket object dumps dominate scans whenever they are enabled.
+register(CrawlerSpec('storage_instances', '.storagecrawler', 'StorageManager',
+                     cost=8.0))
+
+
+def is_set(config: Optional[Dict[str, Any]], config_setting: str) -> bool:
+  if config is None:
+    return True
+  obj = config.get(config_setting, {})
+  return obj.get('fetch', False)
+
+
+def load_crawler(resource_key: str) -> Any:
+  """Import and return the manager class registered for a resource key.
+
+  Args:
+    resource_key: A key of the scan config, e.g. 'storage_instances'.
+
+  Returns:
+    The manager class.
+  """
+
+  if resource_key in _loaded:
+    return _loaded[resource_key]
+
+  spec = CRAWLERS[resource_key]
+  start = time.perf_counter()
+  module = importlib.import_module(spec.module, __package__)
+  elapsed = time.perf_counter() - start
+  _import_times[spec.module] = elapsed
+  if elapsed > IMPORT_TIME_BUDGET:
+    logging.warning('Importing %s took %.3fs (budget %.3fs)', spec.module,
+                    elapsed, IMPORT_TIME_BUDGET)
+
+  crawler_class = getattr(module, spec.class_name)
+  _loaded[resource_key] = crawler_class
+  return crawler_class
+
+
+def enabled_specs(
+    scan_config: Optional[Dict[str, Any]]) -> List[CrawlerSpec]:
+  """Return specs of every crawler enabled in the scan config."""
+  return [spec for resource_key, spec in CRAWLERS.items()
+          if is_set(scan_config, resource_key)]
+
+
+def enabled_crawlers(scan_config: Optional[Dict[str, Any]]) -> List[Any]:
+  """Load manager classes for every resource enabled in the scan config.
+
+  Args:
+    scan_config: A parsed scan config or None to enable everything.
+
+  Returns:
+    A list of manager classes in registry order.
+  """
+
+  return [load_crawler(spec.resource_key)
+          for spec in enabled_specs(scan_config)]
+
+
+def import_times() -> Dict[str, float]:
+  """Return measured import time in seconds for every loaded module."""
+  return dict(_import_times)
+
+
+class CostModel:
+  """Per-crawler duration estimates learned from previous runs.
+
+  Estimates are an exponential moving average of observed durations and are
+  persisted as JSON so that the next scan starts from them.
+  """
+
+  def __init__(self, path: Optional[str] = None, alpha: float = 0.3):
+    self.path = path
+    self.alpha = alpha
+    self.costs: Dict[str, float] = dict()
+
+  def load(self) -> 'CostModel':
+    if self.path is None or not os.path.exists(self.path):
+      return self
+    try:
+      with open(self.path, 'r', encoding='utf-8') as f:
+        self.costs = {key: float(value) for key, value in json.load(f).items()}
+    except (OSError, ValueError, AttributeError):
+      logging.warning('Ignoring unreadable crawler cost file %s', self.path)
+    return self
+
+  def save(self) -> None:
+    if self.path is None:
+      return
+    tmp_path = self.path + '.tmp'
+    with open(tmp_path, 'w', encoding='utf-8') as f:
+      json.dump(self.costs, f, indent=2, sort_keys=True)
+    os.replace(tmp_path, self.path)
+
+  def estimate(self, spec: CrawlerSpec) -> float:
+    return self.costs.get(spec.resource_key, spec.cost)
+
+  def observe(self, resource_key: str, seconds: float) -> None:
+    previous = self.costs.get(resource_key)
+    if previous is None:
+      self.costs[resource_key] = seconds
+    else:
+      self.costs[resource_key] = (
+          self.alpha * seconds + (1 - self.alpha) * previous)
+
+
+def schedule(specs: Iterable[CrawlerSpec],
+             cost_model: Optional[CostModel] = None) -> List[CrawlerSpec]:
+  """Order crawlers so that the longest chains of work start first.
+
+  A crawler's priority is its own estimated cost plus the largest priority
+  among crawlers depending on it, so an expensive crawler is never delayed
+  behind cheap ones and prerequisites of expensive crawlers start early.
+
+  Args:
+    specs: Crawlers to run.
+    cost_model: Learned costs or None to use the declared estimates.
+
+  Returns:
+    The crawlers ordered by decreasing priority.
+  """
+
+  specs = list(specs)
+  by_key = {spec.resource_key: spec for spec in specs}
+  dependents: Dict[str, List[str]] = {key: [] for key in by_key}
+  for spec in specs:
+    for dependency in spec.depends_on:
+      if dependency in dependents:
+        dependents[dependency].append(spec.resource_key)
+
+  priorities: Dict[str, float] = dict()
+
+  def priority(key: str, visiting: Tuple[str, ...] = ()) -> float:
+    if key in priorities:
+      return priorities[key]
+    if key in visiting:
+      raise ValueError(f'Crawler dependency cycle through {key}')
+    spec = by_key[key]
+    own = cost_model.estimate(spec) if cost_model else spec.cost
+    downstream = [priority(child, visiting + (key,))
+                  for child in dependents[key]]
+    priorities[key] = own + max(downstream, default=0.0)
+    return priorities[key]
+
+  return sorted(specs, key=lambda spec: -priority(spec.resource_key))
@@ -1,13 +1,18 @@
-from typing import List,Dict,Any
+from typing import List, Dict, Any, Awaitable, Callable, Tuple
 from httplib2 import Credentials
 from googleapiclient import discovery
 import logging
 import sys
+from .basecrawler import Crawler
+
+class ServerlessManager(Crawler):
+  task_apis = {
+      "cloud_functions": ("cloudfunctions.googleapis.com",),
+      "app_services": ("appengine.googleapis.com",),
+  }
 
-class ServerlessManager:
   def __init__(self,project_name:str, credentials:Credentials):
-    self.project_name = project_name
-    self.credentials = credentials
+    super().__init__(project_name, credentials)
 
   async def get_cloudfunctions(self) -> List[Dict[str, Any]]:
     """Retrieve a list of CloudFunctions available in the project.
@@ -28,7 +33,7 @@ class ServerlessManager:
       request = service.projects().locations().functions().list(
           parent=f"projects/{self.project_name}/locations/-")
       while request is not None:
-        response = request.execute()
+        response = await self._execute(request)
         for function in response.get("functions", []):
           functions_list.append(function)
 
@@ -58,7 +63,7 @@ class ServerlessManager:
     app_services = dict()
     try:
       request = app_client.apps().get(appsId=self.project_name)
-      response = request.execute()
+      response = await self._execute(request)
       if response.get("name", None) is not None:
         app_services["default_app"] = (response["name"],
                                       response["defaultHostname"],
@@ -68,7 +73,7 @@ class ServerlessManager:
 
       app_services["services"] = list()
       while request is not None:
-        response = request.execute()
+        response = await self._execute(request)
         for service_entry in response.get("services", []):
           app_services["services"].append(service_entry)
 
@@ -79,5 +84,8 @@ class ServerlessManager:
       logging.info(sys.exc_info())
     return app_services
 
-  def crawl(self):
-    pass
\ No newline at end of file
+  def tasks(self) -> List[Tuple[str, Callable[[], Awaitable[Any]]]]:
+    return [
+        ("cloud_functions", self.get_cloudfunctions),
+        ("app_services", self.get_app_services),
+    ]
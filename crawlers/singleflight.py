@@ -0,0 +1,88 @@
+"""Coalescing of identical API calls made concurrently.
+
+Calls are keyed by the credential identity and everything that determines
+the response. While a call is in flight, callers with the same key wait for
+its result instead of sending their own request. With a TTL set, results are
+also remembered for that long after the call completes.
+"""
+
+import concurrent.futures
+import threading
+import time
+from typing import Any, Callable, Dict, Hashable, Tuple
+
+
+class SingleFlight:
+  """Thread safe call coalescer."""
+
+  def __init__(self, ttl: float = 0.0, max_memo: int = 10000):
+    self.ttl = ttl
+    self.max_memo = max_memo
+    self._calls: Dict[Hashable, concurrent.futures.Future] = dict()
+    self._memo: Dict[Hashable, Tuple[float, Any]] = dict()
+    self._lock = threading.Lock()
+    self.executed = 0
+    self.shared = 0
+    self.memo_hits = 0
+
+  def do(self, key: Hashable, func: Callable[[], Any]) -> Any:
+    """Call func unless a call with the same key is running or remembered.
+
+    Args:
+      key: A hashable identifying the call.
+      func: A function making the call.
+
+    Returns:
+      The result of func or of the call it was coalesced with. Exceptions are
+      raised to every caller sharing the call and are not remembered.
+    """
+
+    with self._lock:
+      if self.ttl > 0:
+        memo = self._memo.get(key)
+        if memo is not None and memo[0] > time.monotonic():
+          self.memo_hits += 1
+          return memo[1]
+      future = self._calls.get(key)
+      leader = future is None
+      if leader:
+        future = concurrent.futures.Future()
+        self._calls[key] = future
+        self.executed += 1
+      else:
+        self.shared += 1
+
+    if not leader:
+      return future.result()
+
+    try:
+      result = func()
+    except BaseException as e:
+      with self._lock:
+        del self._calls[key]
+      future.set_exception(e)
+      raise
+
+    with self._lock:
+      del self._calls[key]
+      if self.ttl > 0:
+        self._remember(key, result)
+    future.set_result(result)
+    return result
+
+  def _remember(self, key: Hashable, result: Any) -> None:
+    now = time.monotonic()
+    if len(self._memo) >= self.max_memo:
+      self._memo = {k: v for k, v in self._memo.items() if v[0] > now}
+      if len(self._memo) >= self.max_memo:
+        self._memo.pop(next(iter(self._memo)))
+    self._memo[key] = (now + self.ttl, result)
+
+  def stats(self) -> Dict[str, int]:
+    with self._lock:
+      return {'executed': self.executed, 'shared': self.shared,
+              'memo_hits': self.memo_hits}
+
+
+# Calls made by crawlers and the scan loop.
+SHARED = SingleFlight()
@@ -1,13 +1,17 @@
-from typing import List,Any
+from typing import List, Any, Awaitable, Callable, Tuple
 from googleapiclient import discovery
 from httplib2 import Credentials
 import logging
 import sys
+from .basecrawler import Crawler
+
+class SourceRepoManager(Crawler):
+  task_apis = {
+      "sourcerepos": ("sourcerepo.googleapis.com",),
+  }
 
-class SourceRepoManager:
   def __init__(self,project_name: str, credentials: Credentials):
-    self.project_name = project_name
-    self.credentials = credentials
+    super().__init__(project_name, credentials)
   
   async def list_sourcerepo(self) -> List[Any]:
     """Retrieve a list of cloud source repositories enabled in the project.
@@ -30,7 +34,7 @@ class SourceRepoManager:
     )
     try:
       while request is not None:
-        response = request.execute()
+        response = await self._execute(request)
         list_of_repos.append(response.get("repos", None))
 
         request = service.projects().repos().list_next(
@@ -42,6 +46,8 @@ class SourceRepoManager:
       logging.info(sys.exc_info())
 
     return list_of_repos
-  
-  def crawl(self):
-    pass
\ No newline at end of file
+
+  def tasks(self) -> List[Tuple[str, Callable[[], Awaitable[Any]]]]:
+    return [
+        ("sourcerepos", self.list_sourcerepo),
+    ]
@@ -1,4 +1,7 @@
-from typing import Dict, Tuple, Any, List
+import asyncio
+import shutil
+import tempfile
+from typing import Dict, Tuple, Any, List, Optional, Awaitable, Callable
 import googleapiclient
 from googleapiclient import discovery
 from httplib2 import Credentials
@@ -6,12 +9,184 @@ import logging
 import sys
 import json
 import io
+from .basecrawler import Crawler, DeadlineExceeded, PermissionDenied
 
-class StorageManager:
-  def __init__(self,project_name:str,credentials:Credentials,dump_fd:io.TextIOWrapper):
-    self.project_name = project_name
-    self.credentials = credentials
+OBJECT_FIELDS = "nextPageToken,items(name,size,contentType,timeCreated)"
+# Characters object names are sampled at to find split points, in order.
+SPLIT_ALPHABET = "".join(chr(c) for c in range(0x21, 0x7f))
+# Split point candidates probed per partition asked for.
+SPLIT_OVERSAMPLING = 4
+# Pages of the top level of a bucket listed to find its prefixes.
+PREFIX_PROBE_PAGES = 4
+
+
+def _write_items(out: io.TextIOBase, items: List[Dict[str, Any]]) -> None:
+  out.write("".join(json.dumps(item, indent=2, sort_keys=False)
+                    for item in items))
+
+
+def _copy_spool(spool: io.TextIOBase, out: io.TextIOBase) -> None:
+  spool.seek(0)
+  shutil.copyfileobj(spool, out)
+  spool.close()
+
+
+class StorageManager(Crawler):
+  task_apis = {
+      "storage_buckets": ("storage.googleapis.com", "storage-api.googleapis.com"),
+      "filestore_instances": ("file.googleapis.com",),
+  }
+
+  def __init__(self,project_name:str,credentials:Credentials,dump_fd:Optional[io.TextIOWrapper]=None,
+               partitions:int=0,partition_mode:str="prefix"):
+    """
+    Args:
+      partitions: When above 1, objects of a bucket are listed in about this
+        many key ranges concurrently.
+      partition_mode: "prefix" splits buckets at their top level prefixes
+        (delimiter "/"), falling back to "sample" for flat buckets and
+        buckets with too many top level entries. "sample" splits at object
+        names found near evenly spaced keys.
+    """
+    super().__init__(project_name, credentials)
     self.dump_fd = dump_fd
+    self.partitions = partitions
+    self.partition_mode = partition_mode
+
+  async def _list_range(self, service: Any, bucket: str, out: io.TextIOBase,
+                        prefix: Optional[str] = None,
+                        start: Optional[str] = None,
+                        end: Optional[str] = None) -> None:
+    """Write objects of a bucket in a key range to out, in name order.
+
+    Objects are formatted and written in a thread of the default executor,
+    so large buckets do not stall the event loop shared by all crawlers.
+    """
+
+    params = {"bucket": bucket, "fields": OBJECT_FIELDS}
+    if prefix is not None:
+      params["prefix"] = prefix
+    if start is not None:
+      params["startOffset"] = start
+    if end is not None:
+      params["endOffset"] = end
+    loop = asyncio.get_running_loop()
+    req = service.objects().list(**params)
+    while req:
+      resp = await self._execute(req)
+      await loop.run_in_executor(None, _write_items, out,
+                                 resp.get("items", []))
+      req = service.objects().list_next(req, resp)
+
+  async def _prefix_partitions(self, service: Any,
+                               bucket: str) -> Optional[List[Dict[str, Any]]]:
+    """Split a bucket at its top level prefixes.
+
+    At most PREFIX_PROBE_PAGES pages of the top level are listed, so that a
+    flat bucket is not listed sequentially before falling back to sampling.
+
+    Returns:
+      Partitions in name order: {"prefix": p} for each prefix and
+      {"start": s, "end": e} for each run of objects at the top level, from
+      the first of them to the next prefix. None when the top level does not
+      fit the probe or has fewer prefixes than asked partitions.
+    """
+
+    partitions = list()
+    prefix_count = 0
+    req = service.objects().list(
+        bucket=bucket, delimiter="/",
+        fields="nextPageToken,prefixes,items(name)")
+    for _ in range(PREFIX_PROBE_PAGES):
+      resp = await self._execute(req)
+      keys = [(prefix, True) for prefix in resp.get("prefixes", [])]
+      keys.extend((item["name"], False) for item in resp.get("items", []))
+      for key, is_prefix in sorted(keys):
+        if is_prefix:
+          if partitions and "start" in partitions[-1]:
+            partitions[-1]["end"] = key
+          partitions.append({"prefix": key})
+          prefix_count += 1
+        elif not partitions or "start" not in partitions[-1]:
+          # Top level objects between two prefixes form one partition.
+          partitions.append({"start": key, "end": None})
+      req = service.objects().list_next(req, resp)
+      if req is None:
+        break
+    else:
+      return None
+    if prefix_count < self.partitions:
+      return None
+    return partitions
+
+  async def _sampled_partitions(self, service: Any,
+                                bucket: str) -> List[Dict[str, Any]]:
+    """Split a bucket at object names found near evenly spaced keys."""
+
+    count = self.partitions * SPLIT_OVERSAMPLING
+    size = len(SPLIT_ALPHABET)
+    candidates = sorted({
+        SPLIT_ALPHABET[position * size * size // count // size]
+        + SPLIT_ALPHABET[position * size * size // count % size]
+        for position in range(1, count)})
+
+    async def probe(candidate):
+      resp = await self._execute(service.objects().list(
+          bucket=bucket, startOffset=candidate, maxResults=1,
+          fields="items(name)"))
+      items = resp.get("items", [])
+      return items[0]["name"] if items else None
+
+    names = await asyncio.gather(*[probe(candidate) for candidate in candidates])
+    found = sorted({name for name in names if name is not None})
+    # Keep about the number of partitions asked, evenly over the names found.
+    step = max(len(found) // self.partitions, 1)
+    splits = found[step::step][:self.partitions - 1] if found else []
+    bounds = [None] + splits + [None]
+    return [{"start": start, "end": end}
+            for start, end in zip(bounds[:-1], bounds[1:])]
+
+  async def dump_objects(self, service: Any, bucket: str) -> None:
+    """Write the objects of a bucket to dump_fd in name order.
+
+    With partitions set, key ranges of the bucket are listed concurrently.
+    Each range is spooled to a temporary file, and ranges are copied to
+    dump_fd in order as soon as all ranges before them are complete.
+    """
+
+    if self.partitions <= 1:
+      await self._list_range(service, bucket, self.dump_fd)
+      return
+
+    partitions = None
+    if self.partition_mode == "prefix":
+      partitions = await self._prefix_partitions(service, bucket)
+    if partitions is None:
+      partitions = await self._sampled_partitions(service, bucket)
+    logging.info("Listing bucket %s in %d partitions", bucket, len(partitions))
+
+    spools = [tempfile.TemporaryFile("w+", encoding="utf-8")
+              for _ in partitions]
+
+    async def list_partition(partition, spool):
+      await self._list_range(service, bucket, spool,
+                             prefix=partition.get("prefix"),
+                             start=partition.get("start"),
+                             end=partition.get("end"))
+
+    tasks = [asyncio.ensure_future(list_partition(partition, spool))
+             for partition, spool in zip(partitions, spools)]
+    loop = asyncio.get_running_loop()
+    try:
+      for task, spool in zip(tasks, spools):
+        await task
+        await loop.run_in_executor(None, _copy_spool, spool, self.dump_fd)
+    finally:
+      for task in tasks:
+        task.cancel()
+      await asyncio.gather(*tasks, return_exceptions=True)
+      for spool in spools:
+        spool.close()
   
   async def get_bucket_names(self) -> Dict[str, Tuple[Any, List[Any]]]:
     """Retrieve a list of buckets available in the project.
@@ -35,8 +210,9 @@ class StorageManager:
     request = service.buckets().list(project=self.project_name)
     while request is not None:
       try:
-        response = request.execute()
-      except googleapiclient.errors.HttpError:
+        response = await self._execute(request)
+      except (googleapiclient.errors.HttpError, DeadlineExceeded,
+              PermissionDenied):
         logging.info("Failed to list buckets in the %s", self.project_name)
         logging.info(sys.exc_info())
         break
@@ -44,28 +220,22 @@ class StorageManager:
       for bucket in response.get("items", []):
         buckets_dict[bucket["name"]] = (bucket, None)
         if self.dump_fd is not None:
-          ret_fields = "nextPageToken,items(name,size,contentType,timeCreated)"
-
-          req = service.objects().list(bucket=bucket["name"], fields=ret_fields)
-
-          while req:
-            try:
-              resp = req.execute()
-              for item in resp.get("items", []):
-                self.dump_fd.write(json.dumps(item, indent=2, sort_keys=False))
+          try:
+            await self.dump_objects(service, bucket["name"])
+          except (googleapiclient.errors.HttpError, DeadlineExceeded,
+                  PermissionDenied):
+            logging.info("Failed to read the bucket %s", bucket["name"])
+            logging.info(sys.exc_info())
 
-              req = service.objects().list_next(req, resp)
-            except googleapiclient.errors.HttpError:
-              logging.info("Failed to read the bucket %s", bucket["name"])
-              logging.info(sys.exc_info())
-              break
+        if self.truncated:
+          return buckets_dict
 
       request = service.buckets().list_next(
           previous_request=request, previous_response=response)
 
     return buckets_dict
 
-  def get_filestore_instances(self) -> List[Dict[str, Any]]:
+  async def get_filestore_instances(self) -> List[Dict[str, Any]]:
     """Retrieve a list of Filestore instances available in the project.
 
     Args:
@@ -82,18 +252,21 @@ class StorageManager:
         "file", "v1", credentials=self.credentials, cache_discovery=False)
     try:
       request = service.projects().locations().instances().list(
-          parent=f"projects/{self.project_id}/locations/-")
+          parent=f"projects/{self.project_name}/locations/-")
       while request is not None:
-        response = request.execute()
+        response = await self._execute(request)
         for instance in response.get("instances", []):
           filestore_instances_list.append(instance)
 
         request = service.projects().locations().instances().list_next(
             previous_request=request, previous_response=response)
     except Exception:
-      logging.info("Failed to get filestore instances for project %s", self.project_id)
+      logging.info("Failed to get filestore instances for project %s", self.project_name)
       logging.info(sys.exc_info())
     return filestore_instances_list
 
-  def crawl(self):
-    pass
\ No newline at end of file
+  def tasks(self) -> List[Tuple[str, Callable[[], Awaitable[Any]]]]:
+    return [
+        ("storage_buckets", self.get_bucket_names),
+        ("filestore_instances", self.get_filestore_instances),
+    ]
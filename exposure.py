@@ -0,0 +1,327 @@
+# Copyright 2022 Google LLC
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     https://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+
+"""The module to evaluate network exposure of crawled compute resources.
+
+Firewall rules are compiled into NumPy arrays of integer intervals: IPv4
+source ranges, port ranges and rule targets. A query such as "tcp/22 from
+0.0.0.0/0" is then evaluated against every rule and every network interface
+with array operations instead of Python loops.
+
+Rules are applied as VPC firewalls do: among the ingress rules matching an
+interface, the lowest priority number wins and deny wins ties. Without a
+matching allow rule, ingress is denied. Only IPv4 is evaluated.
+"""
+
+import ipaddress
+from typing import Any, Dict, Iterable, List, NamedTuple, Optional, Tuple
+
+import numpy as np
+
+# Protocol id matching every protocol.
+ALL_PROTOCOLS = -1
+# Priority assigned when no rule matches; above the 0-65535 rule range.
+NO_MATCH = np.int64(1 << 62)
+
+_PROTOCOLS = {'tcp': 6, 'udp': 17, 'icmp': 1, 'esp': 50, 'ah': 51,
+              'sctp': 132, 'ipip': 94, 'all': ALL_PROTOCOLS}
+
+
+class Query(NamedTuple):
+  """Traffic to evaluate.
+
+  Attributes:
+    source: An IPv4 CIDR the traffic comes from.
+    protocol: A protocol name or number.
+    port: A destination port.
+  """
+  source: str
+  protocol: str
+  port: int
+
+
+def parse_queries(spec: str) -> List[Query]:
+  """Parse comma separated source:protocol:port queries.
+
+  For example "0.0.0.0/0:tcp:22,0.0.0.0/0:tcp:3389".
+  """
+
+  queries = list()
+  for entry in spec.split(','):
+    source, protocol, port = entry.strip().rsplit(':', 2)
+    ipaddress.IPv4Network(source)
+    queries.append(Query(source, protocol.lower(), int(port)))
+  return queries
+
+
+def _protocol_id(protocol: str) -> int:
+  protocol = str(protocol).lower()
+  if protocol in _PROTOCOLS:
+    return _PROTOCOLS[protocol]
+  return int(protocol)
+
+
+def _ipv4_range(cidr: str) -> Optional[Tuple[int, int]]:
+  try:
+    network = ipaddress.IPv4Network(cidr, strict=False)
+  except ValueError:
+    return None
+  return int(network.network_address), int(network.broadcast_address)
+
+
+def _network_name(url: str) -> str:
+  # Rules and interfaces refer to networks by full or partial URL.
+  return url.rsplit('/', 1)[-1] if url else 'default'
+
+
+class _Interner:
+
+  def __init__(self):
+    self.ids: Dict[str, int] = dict()
+
+  def __call__(self, value: str) -> int:
+    return self.ids.setdefault(value, len(self.ids))
+
+  def __len__(self) -> int:
+    return len(self.ids)
+
+
+class ExposureIndex:
+  """Firewall rules and network interfaces compiled into arrays."""
+
+  def __init__(self, firewall_rules: Iterable[Dict[str, Any]],
+               instances: Iterable[Dict[str, Any]]):
+    networks, tags, accounts = _Interner(), _Interner(), _Interner()
+    self.networks, self.tags, self.accounts = networks, tags, accounts
+
+    self.rules = [rule for rule in firewall_rules
+                  if rule.get('direction', 'INGRESS') == 'INGRESS'
+                  and not rule.get('disabled', False)]
+    priority, allow, rule_network = [], [], []
+    src_lo, src_hi, src_rule = [], [], []
+    port_lo, port_hi, port_proto, port_rule = [], [], [], []
+    target_tag, target_tag_rule = [], []
+    target_sa, target_sa_rule = [], []
+    untargeted = []
+    for index, rule in enumerate(self.rules):
+      priority.append(int(rule.get('priority', 1000)))
+      allow.append('allowed' in rule)
+      rule_network.append(networks(_network_name(rule.get('network', ''))))
+      for cidr in rule.get('sourceRanges', []):
+        bounds = _ipv4_range(cidr)
+        if bounds is not None:
+          src_lo.append(bounds[0])
+          src_hi.append(bounds[1])
+          src_rule.append(index)
+      for entry in rule.get('allowed', rule.get('denied', [])):
+        protocol = _protocol_id(entry.get('IPProtocol', 'all'))
+        for ports in entry.get('ports', ['0-65535']):
+          low, _, high = str(ports).partition('-')
+          port_lo.append(int(low))
+          port_hi.append(int(high or low))
+          port_proto.append(protocol)
+          port_rule.append(index)
+      for tag in rule.get('targetTags', []):
+        target_tag.append(tags(tag))
+        target_tag_rule.append(index)
+      for account in rule.get('targetServiceAccounts', []):
+        target_sa.append(accounts(account))
+        target_sa_rule.append(index)
+      if not rule.get('targetTags') and not rule.get('targetServiceAccounts'):
+        untargeted.append(index)
+
+    self.priority = np.array(priority, dtype=np.int64)
+    self.allow = np.array(allow, dtype=bool)
+    self.rule_network = np.array(rule_network, dtype=np.int64)
+    self.src_lo = np.array(src_lo, dtype=np.int64)
+    self.src_hi = np.array(src_hi, dtype=np.int64)
+    self.src_rule = np.array(src_rule, dtype=np.int64)
+    self.port_lo = np.array(port_lo, dtype=np.int64)
+    self.port_hi = np.array(port_hi, dtype=np.int64)
+    self.port_proto = np.array(port_proto, dtype=np.int64)
+    self.port_rule = np.array(port_rule, dtype=np.int64)
+    self.target_tag = np.array(target_tag, dtype=np.int64)
+    self.target_tag_rule = np.array(target_tag_rule, dtype=np.int64)
+    self.target_sa = np.array(target_sa, dtype=np.int64)
+    self.target_sa_rule = np.array(target_sa_rule, dtype=np.int64)
+    self.untargeted = np.array(untargeted, dtype=np.int64)
+
+    self.interfaces = list()
+    iface_network, iface_external = [], []
+    tag_iface, tag_id, sa_iface, sa_id = [], [], [], []
+    for instance in instances:
+      instance_tags = instance.get('tags', {}).get('items', [])
+      instance_accounts = [account['email'] for account
+                           in instance.get('serviceAccounts', [])]
+      for interface in instance.get('networkInterfaces', []):
+        index = len(self.interfaces)
+        nat_ips = [config['natIP']
+                   for config in interface.get('accessConfigs', [])
+                   if 'natIP' in config]
+        self.interfaces.append({
+            'instance': instance.get('name'),
+            'zone': _network_name(instance.get('zone', '')),
+            'network': _network_name(interface.get('network', '')),
+            'subnetwork': interface.get('subnetwork'),
+            'ip': interface.get('networkIP'),
+            'external_ips': nat_ips,
+        })
+        iface_network.append(networks(_network_name(
+            interface.get('network', ''))))
+        iface_external.append(bool(nat_ips))
+        for tag in instance_tags:
+          tag_iface.append(index)
+          tag_id.append(tags(tag))
+        for account in instance_accounts:
+          sa_iface.append(index)
+          sa_id.append(accounts(account))
+
+    self.iface_network = np.array(iface_network, dtype=np.int64)
+    self.iface_external = np.array(iface_external, dtype=bool)
+    self.tag_iface = np.array(tag_iface, dtype=np.int64)
+    self.tag_id = np.array(tag_id, dtype=np.int64)
+    self.sa_iface = np.array(sa_iface, dtype=np.int64)
+    self.sa_id = np.array(sa_id, dtype=np.int64)
+
+  def _matching_rules(self, query: Query) -> np.ndarray:
+    """Return a mask of rules whose sources and ports cover the query."""
+    query_lo, query_hi = _ipv4_range(query.source)
+    protocol = _protocol_id(query.protocol)
+    rule_count = len(self.rules)
+
+    covers = (self.src_lo <= query_lo) & (query_hi <= self.src_hi)
+    source_match = np.zeros(rule_count, dtype=bool)
+    source_match[self.src_rule[covers]] = True
+
+    opens = ((self.port_lo <= query.port) & (query.port <= self.port_hi)
+             & ((self.port_proto == protocol)
+                | (self.port_proto == ALL_PROTOCOLS)))
+    port_match = np.zeros(rule_count, dtype=bool)
+    port_match[self.port_rule[opens]] = True
+    return source_match & port_match
+
+  def _best(self, matching: np.ndarray, allow: bool) -> np.ndarray:
+    """Return, per interface, the winning matching rule of one action.
+
+    Values encode priority * rule count + rule index, so that the minimum
+    identifies both the best priority and the rule having it.
+    """
+
+    rule_count = max(len(self.rules), 1)
+    selected = matching & (self.allow == allow)
+    score = self.priority * rule_count + np.arange(len(self.rules))
+    best = np.full(len(self.interfaces), NO_MATCH, dtype=np.int64)
+
+    # Rules without targets apply to every interface of their network.
+    rules = self.untargeted[selected[self.untargeted]]
+    if rules.size:
+      by_network = np.full(len(self.networks), NO_MATCH, dtype=np.int64)
+      np.minimum.at(by_network, self.rule_network[rules], score[rules])
+      best = np.minimum(best, by_network[self.iface_network])
+
+    for rule_of, target_of, iface_of, value_of, size in (
+        (self.target_tag_rule, self.target_tag, self.tag_iface, self.tag_id,
+         len(self.tags)),
+        (self.target_sa_rule, self.target_sa, self.sa_iface, self.sa_id,
+         len(self.accounts))):
+      keep = selected[rule_of]
+      if not keep.any() or not iface_of.size:
+        continue
+      rules = rule_of[keep]
+      # (network, target) pairs flattened into one key space
+      keys = self.rule_network[rules] * size + target_of[keep]
+      unique_keys, inverse = np.unique(keys, return_inverse=True)
+      by_key = np.full(unique_keys.size, NO_MATCH, dtype=np.int64)
+      np.minimum.at(by_key, inverse, score[rules])
+
+      iface_keys = self.iface_network[iface_of] * size + value_of
+      position = np.searchsorted(unique_keys, iface_keys)
+      position = np.minimum(position, unique_keys.size - 1)
+      found = unique_keys[position] == iface_keys
+      np.minimum.at(best, iface_of[found], by_key[position[found]])
+    return best
+
+  def evaluate(self, query: Query,
+               external_only: Optional[bool] = None) -> List[Dict[str, Any]]:
+    """Find interfaces reachable by the query traffic.
+
+    Args:
+      query: Traffic to evaluate.
+      external_only: Only report interfaces with an external IP. By default
+        this applies to queries from non private sources.
+
+    Returns:
+      Exposed interfaces with the name of the rule allowing the traffic.
+    """
+
+    if not self.interfaces or not self.rules:
+      return []
+    if external_only is None:
+      external_only = not ipaddress.IPv4Network(query.source).is_private
+
+    matching = self._matching_rules(query)
+    best_allow = self._best(matching, True)
+    best_deny = self._best(matching, False)
+    rule_count = max(len(self.rules), 1)
+    # Deny wins at equal priority.
+    exposed = ((best_allow < NO_MATCH)
+               & (best_allow // rule_count < best_deny // rule_count))
+    if external_only:
+      exposed &= self.iface_external
+
+    return [dict(self.interfaces[index],
+                 rule=self.rules[best_allow[index] % rule_count]['name'])
+            for index in np.flatnonzero(exposed)]
+
+
+def analyze_project(project_result: Dict[str, Any],
+                    queries: List[Query]) -> Dict[str, Any]:
+  """Evaluate queries against compute results of a project.
+
+  Args:
+    project_result: Results of a project with compute_instances,
+      firewall_rules and optionally static_ips.
+    queries: Traffic to evaluate.
+
+  Returns:
+    Per query, exposed instances, static addresses and subnet counts.
+  """
+
+  index = ExposureIndex(project_result.get('firewall_rules') or [],
+                        project_result.get('compute_instances') or [])
+  static_ips = dict()
+  for scope in project_result.get('static_ips') or []:
+    for scoped_list in scope.values():
+      for address in scoped_list.get('addresses', []):
+        static_ips[address.get('address')] = address.get('name')
+
+  report = dict()
+  for query in queries:
+    exposed = index.evaluate(query)
+    subnets = dict()
+    addresses = list()
+    for interface in exposed:
+      subnet = interface.get('subnetwork') or interface['network']
+      subnets[subnet] = subnets.get(subnet, 0) + 1
+      for ip in [interface['ip']] + interface['external_ips']:
+        if ip in static_ips:
+          addresses.append({'name': static_ips[ip], 'address': ip,
+                            'instance': interface['instance']})
+    report[f'{query.source}:{query.protocol}:{query.port}'] = {
+        'instances': exposed,
+        'addresses': addresses,
+        'subnets': subnets,
+    }
+  return report
@@ -0,0 +1,183 @@
+# Copyright 2022 Google LLC
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     https://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+
+"""The module with the manifest of the results of a scan.
+
+The manifest lists every project saved by a service account with the file
+holding its results, the number of resources per type, the crawl duration,
+API calls made and failed, the bytes written and whether crawlers were
+truncated. Consumers can skip empty projects and load files in parallel
+without parsing them first.
+
+It is rewritten as projects are saved, at most once per interval, and when
+the scan ends. Entries of other scans of the output directory are kept, as
+results are appended to the same files. Each scan is listed under "runs"
+with its start and finish times; results of a scan that has not finished
+are still in staged files.
+"""
+
+import fcntl
+import json
+import os
+import time
+import uuid
+from typing import Any, Dict, List, Optional, Tuple
+
+from . import output
+from . import sharding
+
+from crawlers import progress
+
+MANIFEST_FILE = sharding.MANIFEST_FILE
+VERSION = 1
+DEFAULT_INTERVAL = 10.0
+# Note of a manifest merged from shards that traversed service accounts on
+# their own.
+PER_SHARD_TRAVERSAL = (
+    'Service accounts were traversed per shard: each shard followed only the'
+    ' impersonations found in its own projects, so service accounts, chains'
+    ' and edges can differ from an unsharded scan.')
+
+
+def project_entry(project_id: str, sa_name: str,
+                  results: Dict[str, Any], project_result: Dict[str, Any],
+                  duration: float, api_calls: int, errors: Dict[str, int],
+                  size: int) -> Dict[str, Any]:
+  """Build the manifest entry of a project saved by a service account.
+
+  Args:
+    project_id: An id of the project.
+    sa_name: A name of the service account.
+    results: Crawler results by result key.
+    project_result: The saved record of the project.
+    duration: Seconds the project took.
+    api_calls: API calls sent while crawling it.
+    errors: Failed API calls by API method.
+    size: Bytes of results written for it.
+
+  Returns:
+    A JSON serializable entry.
+  """
+
+  counts = {key: progress.count_items(value) for key, value in results.items()}
+  return {
+      'project': project_id,
+      'service_account': sa_name,
+      'file': '%s.json' % project_id,
+      'resources': counts,
+      'total_resources': sum(counts.values()),
+      'duration': round(duration, 3),
+      'api_calls': api_calls,
+      'errors': dict(errors),
+      'bytes': size,
+      'truncated': sorted(project_result.get('truncated', {})),
+      'permission_denied': project_result.get('permission_denied', []),
+      'asset_inventory': project_result.get('asset_inventory', []),
+  }
+
+
+def load(path: str) -> Dict[str, Any]:
+  """Load a manifest, or return an empty one when there is none."""
+
+  if not os.path.exists(path):
+    return {'version': VERSION, 'runs': {}, 'projects': []}
+  with open(path, encoding='utf-8') as infile:
+    return json.load(infile)
+
+
+def merge(manifests: List[Dict[str, Any]]) -> Dict[str, Any]:
+  """Combine manifests, e.g. of the shards of a scan."""
+
+  merged = {'version': VERSION, 'runs': {}, 'projects': []}
+  for manifest in manifests:
+    merged['runs'].update(manifest.get('runs', {}))
+    merged['projects'].extend(manifest.get('projects', []))
+  if any(run.get('shard') for run in merged['runs'].values()):
+    merged['notes'] = [PER_SHARD_TRAVERSAL]
+  return merged
+
+
+def write(path: str, manifest: Dict[str, Any]) -> None:
+  """Replace a manifest file at once."""
+
+  manifest['updated'] = time.time()
+  staged = '%s.%d%s' % (path, os.getpid(), output.PARTIAL_SUFFIX)
+  with open(staged, 'w', encoding='utf-8') as outfile:
+    json.dump(manifest, outfile, indent=2)
+  os.replace(staged, path)
+
+
+class Manifest:
+  """Entries of the projects saved by a scan, kept in the output directory.
+
+  Args:
+    out_dir: The output directory of the scan.
+    interval: Minimum seconds between two rewrites while scanning.
+    shard: (index, total) of a scan of one shard that traverses service
+      accounts on its own.
+  """
+
+  def __init__(self, out_dir: str, interval: float = DEFAULT_INTERVAL,
+               shard: Optional[Tuple[int, int]] = None):
+    self.out_dir = out_dir
+    self.path = os.path.join(out_dir, MANIFEST_FILE)
+    self.interval = interval
+    self.run_id = uuid.uuid4().hex
+    self.run: Dict[str, Any] = {
+        'pid': os.getpid(), 'started': time.time(), 'finished': None,
+        'shard': '%d/%d' % shard if shard is not None else None}
+    self.entries: List[Dict[str, Any]] = list()
+    self._last_write = 0.0
+
+  def start(self) -> 'Manifest':
+    self.flush()
+    return self
+
+  def add(self, entry: Dict[str, Any]) -> None:
+    entry['run'] = self.run_id
+    self.entries.append(entry)
+    if time.monotonic() - self._last_write >= self.interval:
+      self.flush()
+
+  def finish(self) -> None:
+    self.run['finished'] = time.time()
+    self.flush()
+
+  def flush(self) -> None:
+    """Rewrite the manifest with the entries of this scan.
+
+    The directory lock of the output writer is held, as other processes
+    sharing a work queue may rewrite it too.
+    """
+
+    self._last_write = time.monotonic()
+    with open(os.path.join(self.out_dir, output.LOCK_FILE), 'a') as lock:
+      fcntl.flock(lock, fcntl.LOCK_EX)
+      manifest = load(self.path)
+      manifest['version'] = VERSION
+      manifest['runs'][self.run_id] = self.run
+      manifest['projects'] = [
+          entry for entry in manifest['projects']
+          if entry.get('run') != self.run_id] + self.entries
+      write(self.path, manifest)
+
+  def stats(self) -> Dict[str, Any]:
+    return {
+        'projects': len(self.entries),
+        'empty': sum(1 for entry in self.entries
+                     if not entry['total_resources']),
+        'bytes': sum(entry['bytes'] for entry in self.entries),
+    }
+
@@ -0,0 +1,325 @@
+# Copyright 2022 Google LLC
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     https://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+
+"""The module to write scan results from a background thread.
+
+Writes are queued and a single thread appends them to their files in
+batches. The queue is bounded in bytes: callers only block on disk I/O
+when the writer falls that far behind.
+
+Files are staged next to their final path, with the process id and a
+.partial suffix, and moved into place when the writer is closed, or as
+soon as a write asking for it is done, so a scan that dies while writing
+leaves result files of a previous scan untouched. Results are appended: a
+staged file is renamed into place when there is no final file yet, and
+otherwise appended to it, so committing a file costs its own size only.
+Commits hold a lock on the directory, as processes sharing a work queue may
+write the same files. Files committed together are synced once, after all
+of them are in place.
+
+fsync policies:
+
+  none   leave flushing to the operating system,
+  batch  sync files written by a batch before reporting it written,
+  close  sync every file when it is committed, the default.
+"""
+
+import collections
+import concurrent.futures
+import fcntl
+import logging
+import os
+import shutil
+import threading
+import time
+from typing import Any, Deque, Dict, List, Optional, Set, Tuple
+
+FSYNC_NONE = 'none'
+FSYNC_BATCH = 'batch'
+FSYNC_CLOSE = 'close'
+FSYNC_POLICIES = (FSYNC_NONE, FSYNC_BATCH, FSYNC_CLOSE)
+
+PARTIAL_SUFFIX = '.partial'
+LOCK_FILE = '.output.lock'
+DEFAULT_QUEUE_BYTES = 256 * 1024 * 1024
+BATCH_BYTES = 8 * 1024 * 1024
+MAX_OPEN_FILES = 64
+
+
+class OutputWriter:
+  """Appends data to files from a single background thread.
+
+  Args:
+    fsync: One of FSYNC_POLICIES.
+    max_queue_bytes: Bytes queued before write() blocks. A larger write is
+      queued alone.
+    batch_bytes: Bytes the thread takes from the queue at once.
+    max_open_files: Staged files kept open between batches.
+  """
+
+  def __init__(self, fsync: str = FSYNC_CLOSE,
+               max_queue_bytes: int = DEFAULT_QUEUE_BYTES,
+               batch_bytes: int = BATCH_BYTES,
+               max_open_files: int = MAX_OPEN_FILES):
+    if fsync not in FSYNC_POLICIES:
+      raise ValueError(f'Unknown fsync policy {fsync}')
+    self.fsync = fsync
+    self.max_queue_bytes = max_queue_bytes
+    self.batch_bytes = batch_bytes
+    self.max_open_files = max_open_files
+    self._queue: Deque[Tuple[str, bytes, bool, concurrent.futures.Future]] = (
+        collections.deque())
+    self._queued_bytes = 0
+    self._condition = threading.Condition()
+    self._closing = False
+    self._error: Optional[BaseException] = None
+    self._thread: Optional[threading.Thread] = None
+    # final path -> open staged file, least recently written first
+    self._files: 'collections.OrderedDict[str, Any]' = collections.OrderedDict()
+    # final paths staged so far
+    self._staged: List[str] = list()
+    self._staged_set: Set[str] = set()
+    # final paths written since their last fsync
+    self._dirty: Set[str] = set()
+    self.bytes_by_path: Dict[str, int] = collections.Counter()
+    self.writes = 0
+    self.batches = 0
+    self.fsyncs = 0
+    self.blocked_seconds = 0.0
+    self.max_queued_bytes = 0
+
+  def start(self) -> 'OutputWriter':
+    self._thread = threading.Thread(target=self._run, name='output-writer',
+                                    daemon=True)
+    self._thread.start()
+    return self
+
+  def write(self, path: str, data: bytes,
+            commit: bool = False) -> concurrent.futures.Future:
+    """Queue data to append to a file.
+
+    Blocks while the queue is full.
+
+    Args:
+      path: The final path of the file.
+      data: Bytes to append.
+      commit: Whether to move the file into place once the data is written,
+        rather than when the writer is closed.
+
+    Returns:
+      A future done once the data is written, synced under the batch
+      policy, and committed when asked. It holds the exception of a failed
+      write.
+    """
+
+    future = concurrent.futures.Future()
+    with self._condition:
+      if self._closing:
+        raise ValueError('Write to a closed OutputWriter')
+      if self._error is not None:
+        raise self._error
+      start = time.monotonic()
+      while (self._queue and
+             self._queued_bytes + len(data) > self.max_queue_bytes):
+        self._condition.wait()
+      self.blocked_seconds += time.monotonic() - start
+      self._queue.append((path, data, commit, future))
+      self._queued_bytes += len(data)
+      self.max_queued_bytes = max(self.max_queued_bytes, self._queued_bytes)
+      self._condition.notify_all()
+    return future
+
+  def _next_batch(
+      self) -> List[Tuple[str, bytes, bool, concurrent.futures.Future]]:
+    with self._condition:
+      while not self._queue and not self._closing:
+        self._condition.wait()
+      batch = list()
+      size = 0
+      while self._queue and (not batch or size < self.batch_bytes):
+        entry = self._queue.popleft()
+        batch.append(entry)
+        size += len(entry[1])
+      self._queued_bytes -= size
+      self._condition.notify_all()
+      return batch
+
+  @staticmethod
+  def _staged_path(path: str) -> str:
+    return f'{path}.{os.getpid()}{PARTIAL_SUFFIX}'
+
+  def _sync(self, path: str, outfile: Any) -> None:
+    if path in self._dirty:
+      os.fsync(outfile.fileno())
+      self._dirty.discard(path)
+      self.fsyncs += 1
+
+  def _file(self, path: str) -> Any:
+    outfile = self._files.get(path)
+    if outfile is not None:
+      self._files.move_to_end(path)
+      return outfile
+    staged = self._staged_path(path)
+    if path not in self._staged_set:
+      # A staged file left by a scan that died is started over.
+      if os.path.exists(staged):
+        os.remove(staged)
+      self._staged.append(path)
+      self._staged_set.add(path)
+    if len(self._files) >= self.max_open_files:
+      evicted, evicted_file = self._files.popitem(last=False)
+      if self.fsync != FSYNC_NONE:
+        self._sync(evicted, evicted_file)
+      evicted_file.close()
+    outfile = self._files[path] = open(staged, 'ab')
+    return outfile
+
+  def _write_batch(
+      self,
+      batch: List[Tuple[str, bytes, bool, concurrent.futures.Future]]) -> None:
+    written = list()
+    committed = list()
+    for path, data, commit, _ in batch:
+      outfile = self._file(path)
+      outfile.write(data)
+      self._dirty.add(path)
+      self.bytes_by_path[path] += len(data)
+      written.append(path)
+      if commit:
+        committed.append(path)
+    for path in dict.fromkeys(written):
+      outfile = self._files.get(path)
+      if outfile is None:
+        continue
+      outfile.flush()
+      if self.fsync == FSYNC_BATCH:
+        self._sync(path, outfile)
+    committed = list(dict.fromkeys(committed))
+    for path in committed:
+      outfile = self._files.pop(path, None)
+      if outfile is not None:
+        # A staged file appended to its final file is synced there.
+        if self.fsync != FSYNC_NONE and not os.path.exists(path):
+          self._sync(path, outfile)
+        self._dirty.discard(path)
+        outfile.close()
+      self._staged.remove(path)
+      self._staged_set.discard(path)
+    self._commit_all(committed)
+    self.writes += len(batch)
+    self.batches += 1
+
+  def _run(self) -> None:
+    while True:
+      batch = self._next_batch()
+      if not batch:
+        return
+      try:
+        if self._error is not None:
+          raise self._error
+        self._write_batch(batch)
+      except BaseException as e:  # pylint: disable=broad-except
+        logging.error('Failed to write results: %s', e)
+        with self._condition:
+          if self._error is None:
+            self._error = e
+        for _, _, _, future in batch:
+          future.set_exception(e)
+        continue
+      for _, _, _, future in batch:
+        future.set_result(None)
+
+  def close(self) -> None:
+    """Write what is queued and move staged files into place.
+
+    Raises:
+      The exception of a failed write, in which case staged files are left
+      as they are.
+    """
+
+    with self._condition:
+      self._closing = True
+      self._condition.notify_all()
+    if self._thread is not None:
+      self._thread.join()
+    if self._error is not None:
+      raise self._error
+    for path, outfile in self._files.items():
+      if self.fsync != FSYNC_NONE and not os.path.exists(path):
+        self._sync(path, outfile)
+      outfile.close()
+    self._files.clear()
+    self._commit_all(self._staged)
+
+  def _commit_all(self, paths: List[str]) -> None:
+    """Commit staged files, holding the lock of each directory once."""
+
+    by_directory: Dict[str, List[str]] = collections.defaultdict(list)
+    for path in paths:
+      by_directory[os.path.dirname(path) or '.'].append(path)
+    for directory, directory_paths in by_directory.items():
+      with open(os.path.join(directory, LOCK_FILE), 'a') as lock:
+        fcntl.flock(lock, fcntl.LOCK_EX)
+        appended = [path for path in directory_paths if self._commit(path)]
+        if self.fsync == FSYNC_NONE:
+          continue
+        for path in appended:
+          fd = os.open(path, os.O_RDONLY)
+          try:
+            os.fsync(fd)
+          finally:
+            os.close(fd)
+          self.fsyncs += 1
+        if len(appended) < len(directory_paths):
+          # The renames are durable once the directory is synced.
+          fd = os.open(directory, os.O_RDONLY)
+          try:
+            os.fsync(fd)
+          finally:
+            os.close(fd)
+
+  def _commit(self, path: str) -> bool:
+    """Move a staged file into place, or append it to the final one.
+
+    Returns:
+      Whether the staged file was appended to an existing final file.
+    """
+
+    staged = self._staged_path(path)
+    if not os.path.exists(path):
+      os.replace(staged, path)
+      return False
+    with open(path, 'ab') as outfile, open(staged, 'rb') as infile:
+      size = outfile.tell()
+      try:
+        shutil.copyfileobj(infile, outfile)
+        outfile.flush()
+      except BaseException:
+        # Leave the final file as it was.
+        outfile.truncate(size)
+        raise
+    os.remove(staged)
+    return True
+
+  def stats(self) -> Dict[str, Any]:
+    return {
+        'files': len(self.bytes_by_path),
+        'writes': self.writes,
+        'batches': self.batches,
+        'bytes': sum(self.bytes_by_path.values()),
+        'fsyncs': self.fsyncs,
+        'max_queued_bytes': self.max_queued_bytes,
+        'blocked_seconds': round(self.blocked_seconds, 3),
+    }
@@ -0,0 +1,290 @@
+# Copyright 2022 Google LLC
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     https://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+
+"""The module to query privilege escalation paths found by a scan.
+
+Nodes are identities (service accounts, users, groups) and grants, a role
+held on a project such as "my-project:roles/owner". Edges are service
+account impersonations found by the crawl and IAM policy bindings giving an
+identity a grant. Node names are interned to integer ids and edges are
+compiled into CSR arrays in both directions, so reachability queries are
+breadth-first searches over NumPy arrays.
+
+Edges are appended as they are discovered. The CSR arrays are rebuilt
+lazily, on the first query after new edges were added.
+"""
+
+import json
+import logging
+import os
+from typing import Any, Dict, List, Optional, Tuple, Union
+
+import numpy as np
+
+from . import sharding
+
+IDENTITY = 0
+GRANT = 1
+
+IMPERSONATES = 0
+HOLDS = 1
+
+
+def identity_name(member: str) -> str:
+  """Normalize "serviceAccount:x@y" style IAM members to "x@y"."""
+  kind, _, name = member.partition(':')
+  if name and kind in ('serviceAccount', 'user', 'group', 'domain'):
+    return name
+  return member
+
+
+def grant_name(project_id: str, role: str) -> str:
+  return f'{project_id}:{role}'
+
+
+class _CSR:
+  """Adjacency in compressed sparse row form."""
+
+  def __init__(self, node_count: int, src: np.ndarray, dst: np.ndarray):
+    order = np.argsort(src, kind='stable')
+    self.indices = dst[order]
+    self.edge_ids = order
+    counts = np.bincount(src, minlength=node_count)
+    self.indptr = np.zeros(node_count + 1, dtype=np.int64)
+    np.cumsum(counts, out=self.indptr[1:])
+
+  def bfs(self, sources: np.ndarray) -> Tuple[np.ndarray, np.ndarray]:
+    """Return hop distances and BFS tree edges from sources.
+
+    Unreached nodes have distance -1. parent_edge holds, for every reached
+    node but the sources, the id of the edge it was first reached by.
+    """
+
+    node_count = self.indptr.size - 1
+    distance = np.full(node_count, -1, dtype=np.int64)
+    parent_edge = np.full(node_count, -1, dtype=np.int64)
+    frontier = np.unique(sources)
+    distance[frontier] = 0
+    level = 0
+    while frontier.size:
+      starts = self.indptr[frontier]
+      counts = self.indptr[frontier + 1] - starts
+      total = int(counts.sum())
+      if not total:
+        break
+      # positions of every neighbour of the frontier in self.indices
+      offsets = np.arange(total) - np.repeat(np.cumsum(counts) - counts,
+                                             counts)
+      positions = np.repeat(starts, counts) + offsets
+      neighbours = self.indices[positions]
+      new = distance[neighbours] < 0
+      neighbours, first = np.unique(neighbours[new], return_index=True)
+      level += 1
+      distance[neighbours] = level
+      parent_edge[neighbours] = self.edge_ids[positions[new][first]]
+      frontier = neighbours
+    return distance, parent_edge
+
+
+class PrivilegeGraph:
+  """Identities, grants and the edges between them."""
+
+  def __init__(self):
+    self._ids: Dict[str, int] = dict()
+    self.names: List[str] = list()
+    self.kinds: List[int] = list()
+    self._src: List[int] = list()
+    self._dst: List[int] = list()
+    self._edge_kind: List[int] = list()
+    self._edge_project: List[str] = list()
+    self._edge_set = set()
+    # role -> grant nodes of the role in any project
+    self._grants: Dict[str, List[int]] = dict()
+    self._forward: Optional[_CSR] = None
+    self._reverse: Optional[_CSR] = None
+
+  def _node(self, name: str, kind: int) -> int:
+    node = self._ids.get(name)
+    if node is None:
+      node = self._ids[name] = len(self.names)
+      self.names.append(name)
+      self.kinds.append(kind)
+      if kind == GRANT:
+        # Project ids may hold a colon (domain:project), roles never do.
+        self._grants.setdefault(name.rsplit(':', 1)[1], []).append(node)
+    return node
+
+  def add_edge(self, source: str, target: str, project_id: str,
+               kind: int = IMPERSONATES) -> bool:
+    """Add an edge. Returns False if it is already in the graph."""
+
+    source_id = self._node(identity_name(source), IDENTITY)
+    target_id = self._node(target if kind == HOLDS else identity_name(target),
+                           GRANT if kind == HOLDS else IDENTITY)
+    key = (source_id, target_id, kind, project_id)
+    if key in self._edge_set:
+      return False
+    self._edge_set.add(key)
+    self._src.append(source_id)
+    self._dst.append(target_id)
+    self._edge_kind.append(kind)
+    self._edge_project.append(project_id)
+    self._forward = self._reverse = None
+    return True
+
+  def add_policy(
+      self, project_id: str,
+      iam_policy: Union[List[Dict[str, Any]], Dict[str, Any], None]) -> None:
+    """Add grants of a project IAM policy.
+
+    The policy is a list of bindings, as returned by
+    ProjectManager.get_iam_policy and saved in project files, or a policy
+    object holding them.
+    """
+
+    bindings = (iam_policy if isinstance(iam_policy, list)
+                else (iam_policy or {}).get('bindings', []))
+    for binding in bindings:
+      grant = grant_name(project_id, binding['role'])
+      for member in binding.get('members', []):
+        self.add_edge(member, grant, project_id, HOLDS)
+
+  def _compile(self) -> None:
+    if self._forward is not None:
+      return
+    src = np.array(self._src, dtype=np.int64)
+    dst = np.array(self._dst, dtype=np.int64)
+    self._forward = _CSR(len(self.names), src, dst)
+    self._reverse = _CSR(len(self.names), dst, src)
+
+  def _lookup(self, names: List[str]) -> np.ndarray:
+    ids = [self._ids[name] for name in names if name in self._ids]
+    return np.array(ids, dtype=np.int64)
+
+  def _path(self, parent_edge: np.ndarray, node: int,
+            forward: bool) -> List[Dict[str, str]]:
+    path = list()
+    while parent_edge[node] >= 0:
+      edge = int(parent_edge[node])
+      path.append({'source': self.names[self._src[edge]],
+                   'target': self.names[self._dst[edge]],
+                   'project': self._edge_project[edge]})
+      node = self._src[edge] if forward else self._dst[edge]
+    if forward:
+      path.reverse()
+    return path
+
+  def reachable_from(self, identity: str) -> Dict[str, int]:
+    """Return identities and grants reachable from identity, with hops."""
+
+    self._compile()
+    distance, _ = self._forward.bfs(self._lookup([identity_name(identity)]))
+    return {self.names[node]: int(distance[node])
+            for node in np.flatnonzero(distance > 0)}
+
+  def who_can_reach(self, target: str) -> Dict[str, int]:
+    """Return identities able to reach an identity or grant, with hops."""
+
+    self._compile()
+    distance, _ = self._reverse.bfs(
+        self._lookup([target, identity_name(target)]))
+    return {self.names[node]: int(distance[node])
+            for node in np.flatnonzero(distance > 0)}
+
+  def shortest_chain(self, identity: str,
+                     role: str = 'roles/owner') -> Optional[List[Dict[str, str]]]:
+    """Return the shortest list of edges from identity to a holder of role.
+
+    Returns None if no grant of the role is reachable.
+    """
+
+    self._compile()
+    distance, parent_edge = self._forward.bfs(
+        self._lookup([identity_name(identity)]))
+    candidates = np.array(self._grants.get(role, []), dtype=np.int64)
+    candidates = candidates[distance[candidates] > 0]
+    if not candidates.size:
+      return None
+    best = candidates[np.argmin(distance[candidates])]
+    return self._path(parent_edge, int(best), forward=True)
+
+  def stats(self) -> Dict[str, int]:
+    return {'nodes': len(self.names), 'edges': len(self._src)}
+
+  def save(self, path: str) -> None:
+    tmp_path = path + '.tmp'
+    with open(tmp_path, 'wb') as outfile:
+      np.savez_compressed(
+          outfile,
+          names=np.array(self.names, dtype=str),
+          kinds=np.array(self.kinds, dtype=np.int8),
+          src=np.array(self._src, dtype=np.int64),
+          dst=np.array(self._dst, dtype=np.int64),
+          edge_kind=np.array(self._edge_kind, dtype=np.int8),
+          edge_project=np.array(self._edge_project, dtype=str))
+    os.replace(tmp_path, path)
+
+  def update(self, other: 'PrivilegeGraph') -> None:
+    """Add the edges of another graph."""
+
+    for src, dst, kind, project_id in zip(other._src, other._dst,
+                                          other._edge_kind,
+                                          other._edge_project):
+      self.add_edge(other.names[src], other.names[dst], project_id, kind)
+
+
+def load(path: str) -> PrivilegeGraph:
+  """Load a graph saved with PrivilegeGraph.save."""
+
+  graph = PrivilegeGraph()
+  with np.load(path) as data:
+    names = [str(name) for name in data['names']]
+    for src, dst, kind, project_id in zip(data['src'], data['dst'],
+                                          data['edge_kind'],
+                                          data['edge_project']):
+      graph.add_edge(names[src], names[dst], str(project_id), int(kind))
+  return graph
+
+
+def from_output(out_dir: str) -> PrivilegeGraph:
+  """Build a graph from the edges and project files of a scan."""
+
+  graph = PrivilegeGraph()
+  edges_path = os.path.join(out_dir, sharding.EDGES_FILE)
+  if os.path.exists(edges_path):
+    with open(edges_path, encoding='utf-8') as infile:
+      for edge in json.load(infile):
+        graph.add_edge(edge['source'], edge['target'], edge['project'])
+
+  decoder = json.JSONDecoder()
+  for file_name in sorted(os.listdir(out_dir)):
+    if not file_name.endswith('.json') or file_name in sharding.STATE_FILES:
+      continue
+    with open(os.path.join(out_dir, file_name), encoding='utf-8') as infile:
+      content = infile.read()
+    # A project file holds one document per service account that scanned it.
+    position = 0
+    while position < len(content):
+      if content[position].isspace():
+        position += 1
+        continue
+      try:
+        document, position = decoder.raw_decode(content, position)
+      except ValueError:
+        logging.info('Failed to parse %s', file_name)
+        break
+      for project_id, result in document.get('projects', {}).items():
+        graph.add_policy(project_id, result.get('iam_policy'))
+  return graph
@@ -18,23 +18,72 @@
 """
 
 import argparse
+import collections
+import concurrent.futures
+import functools
 import json
 import logging
 import os
 import sys
-from typing import List, Tuple, Dict, Optional
+import time
+from typing import Any, Deque, List, NamedTuple, Tuple, Dict, Optional, Set, TYPE_CHECKING
 
 from . import crawl
 from . import credsdb
-from google.cloud import container_v1
-from google.cloud import iam_credentials
-from google.cloud.iam_credentials_v1.services.iam_credentials.client import IAMCredentialsClient
-from googleapiclient import discovery
+from . import manifest
+from . import output
+from . import serialization
+from . import sharding
+from . import workqueue
 from httplib2 import Credentials
-from .models import SpiderContext
 
+import crawlers
+from crawlers import clientpool
+from crawlers import concurrency
+from crawlers import permcache
+from crawlers import profiling
+from crawlers import progress
+from crawlers import registry
+from crawlers import singleflight
 from workers import Worker
 
+if TYPE_CHECKING:
+  # Loading the IAM credentials client pulls in gRPC, so it is deferred until
+  # the first impersonation attempt.
+  from google.cloud.iam_credentials_v1.services.iam_credentials.client import IAMCredentialsClient
+
+# Seconds to wait between checks for work queued by other processes.
+QUEUE_WAIT = 30
+# Projects crawled in the background while crawl_loop moves on.
+PIPELINE_DEPTH = 4
+
+
+class ReadyCrawl(NamedTuple):
+  """A project whose IAM policy is read, waiting for its resource crawl."""
+  item: workqueue.Lease
+  credentials: Credentials
+  enabled_services: Optional[Set[str]]
+  prefilled: Dict[str, Any]
+  sa_results: Dict[str, Any]
+  started: float
+
+
+class PendingCrawl(NamedTuple):
+  """A project crawl started by crawl_loop and not saved yet."""
+  item: workqueue.Lease
+  worker: Worker
+  future: concurrent.futures.Future
+  sa_results: Dict[str, Any]
+  started: float
+
+
+class PendingSave(NamedTuple):
+  """Results of a crawled project being serialized before they are saved."""
+  crawl: PendingCrawl
+  results: Dict[str, Any]
+  data: concurrent.futures.Future
+
+
 def is_set(config, config_setting):
   if config is None:
     return True
@@ -46,7 +95,27 @@ def crawl_loop(initial_sa_tuples: List[Tuple[str, Credentials, List[str]]],
                out_dir: str,
                scan_config: Dict,
                target_project: Optional[str] = None,
-               force_projects: Optional[str] = None):
+               force_projects: Optional[str] = None,
+               crawler_timeout: Optional[float] = None,
+               project_timeout: Optional[float] = None,
+               service_precheck: bool = True,
+               denial_ttl: Optional[float] = None,
+               shard: Optional[Tuple[int, int]] = None,
+               work_queue: Optional[workqueue.WorkQueue] = None,
+               exposure_queries: Optional[List[Any]] = None,
+               privilege_graph: bool = False,
+               profile_interval: Optional[float] = None,
+               profile_memory: bool = False,
+               progress_line: bool = False,
+               progress_file: Optional[str] = None,
+               pipeline_depth: int = PIPELINE_DEPTH,
+               asset_scope: Optional[str] = None,
+               asset_endpoint: Optional[str] = None,
+               json_format: str = serialization.PRETTY,
+               json_backend: Optional[str] = None,
+               serializer_processes: int = 0,
+               fsync_policy: str = output.FSYNC_CLOSE,
+               write_queue_bytes: int = output.DEFAULT_QUEUE_BYTES):
   """The main loop function to crawl GCP resources.
 
   Args:
@@ -54,55 +123,302 @@ def crawl_loop(initial_sa_tuples: List[Tuple[str, Credentials, List[str]]],
     out_dir: directory to save results
     target_project: project name to scan
     force_projects: a list of projects to force scan
+    crawler_timeout: seconds each crawler may run per project
+    project_timeout: seconds all crawlers of a project may run together
+    service_precheck: skip crawling APIs that are disabled in a project
+    denial_ttl: seconds a denied API call is not retried, None to disable
+    shard: (index, total) to scan only projects of one shard
+    work_queue: a queue shared with other scanner processes
+    exposure_queries: traffic to evaluate against firewall rules
+    privilege_graph: keep impersonations and IAM grants in a graph file
+    profile_interval: seconds between profiler samples, None to not profile
+    profile_memory: trace memory allocations while profiling
+    progress_line: show a status line with progress and ETA
+    progress_file: a JSON lines file to append progress events to
+    pipeline_depth: projects crawled at the same time while traversal
+      continues
+    asset_scope: an organization or folder to search with Cloud Asset
+      Inventory, crawling per API only what the search does not cover
+    asset_endpoint: a root URL of the Cloud Asset API to use instead of the
+      default one
+    json_format: serialization.PRETTY or serialization.COMPACT
+    json_backend: serialization.ORJSON or serialization.STDLIB, None to use
+      orjson when it is installed
+    serializer_processes: processes serializing results, 0 for a thread
+    fsync_policy: one of output.FSYNC_POLICIES
+    write_queue_bytes: results queued for the output writer before saving
+      waits for the disk
   """
 
-  context = SpiderContext(initial_sa_tuples)
+  if work_queue is None:
+    work_queue = workqueue.LocalWorkQueue()
+  reporter = None
+  if progress_line or progress_file:
+    reporter = progress.Progress(
+        progress_file, stream=sys.stderr if progress_line else None).start()
+  # credentials known to this process by service account name
+  known_credentials = dict()
+  for sa_name, credentials, chain_so_far in initial_sa_tuples:
+    known_credentials[sa_name] = credentials
+    if (work_queue.put(sa_name, chain_so_far, credentials=credentials)
+        and reporter is not None):
+      reporter.sa_added(sa_name)
+
+  cost_model = registry.CostModel(
+      os.path.join(out_dir, registry.COST_FILE)).load()
+  # project id -> names of enabled services, shared by all service accounts
+  enabled_services_cache = dict()
+  # Loading it pulls in googleapiclient, which --merge-shards does not need.
+  from crawlers import projectcache  # pylint: disable=import-outside-toplevel
+  project_cache = projectcache.ProjectCache()
+  permission_cache = None
+  if denial_ttl is not None:
+    permission_cache = permcache.PermissionCache(
+        os.path.join(out_dir, permcache.CACHE_FILE), denial_ttl).load()
+  graph = None
+  if privilege_graph:
+    from . import privgraph  # pylint: disable=import-outside-toplevel
+    graph_path = os.path.join(out_dir, sharding.GRAPH_FILE)
+    graph = (privgraph.load(graph_path) if os.path.exists(graph_path)
+             else privgraph.PrivilegeGraph())
+  # asset inventory of the scope, searched once for all service accounts
+  inventory = None
+  asset_keys = set()
+  if asset_scope is not None:
+    from crawlers import assetinventory  # pylint: disable=import-outside-toplevel
+    asset_keys = {key for crawler_class in registry.enabled_crawlers(scan_config)
+                  for key in crawler_class.task_apis}
+    if (scan_config is not None and scan_config.get('storage_buckets', {}).get(
+        'fetch_file_names', False) is True):
+      # Objects are only listed by the crawler.
+      asset_keys.discard('storage_buckets')
+  profiler = None
+  if profile_interval is not None:
+    profiler = profiling.Profiler(out_dir, profile_interval,
+                                  memory=profile_memory).start()
+
+  serializer = serialization.Serializer(json_format, json_backend,
+                                        serializer_processes)
+  writer = output.OutputWriter(fsync_policy, write_queue_bytes).start()
+  scan_manifest = manifest.Manifest(out_dir, shard=shard).start()
+
+  def scope_inventory(credentials: Credentials) -> Any:
+    """Search the asset scope with the first credentials that need it."""
+
+    nonlocal inventory
+    if inventory is None:
+      with profiling.stage('inventory', asset_scope):
+        inventory = assetinventory.AssetInventory(
+            asset_scope, credentials, asset_endpoint, asset_keys,
+            keep=lambda project_id: (
+                sharding.in_shard(project_id, shard)
+                and (not target_project or target_project in project_id))
+        ).load()
+    return inventory
+
+  def start_crawl(ready_crawl: ReadyCrawl) -> PendingCrawl:
+    """Start the resource crawl of a project in the background."""
+
+    project_id = ready_crawl.item.project_id
+    crawler_options = dict()
+    if scan_config is not None:
+      buckets_config = scan_config.get('storage_buckets', {})
+      if buckets_config.get('fetch_file_names', False) is True:
+        crawler_options['storage_buckets'] = {
+            'dump_fd': open(os.path.join(
+                out_dir, project_id + sharding.OBJECTS_SUFFIX), 'a',
+                            encoding='utf-8'),
+            'partitions': buckets_config.get('object_partitions', 0),
+            'partition_mode': buckets_config.get('partition_mode', 'prefix'),
+        }
+
+    crawl_process = Worker(scan_config, project_id, ready_crawl.credentials,
+                           cost_model, crawler_timeout, project_timeout,
+                           ready_crawl.enabled_services,
+                           ready_crawl.item.sa_name, permission_cache,
+                           crawler_options, ready_crawl.prefilled)
+    return PendingCrawl(ready_crawl.item, crawl_process, crawl_process.start(),
+                        ready_crawl.sa_results, ready_crawl.started)
+
+  def finish_crawl(pending: PendingCrawl) -> PendingSave:
+    """Wait for the crawl of a project and start serializing its results."""
+
+    project_id = pending.item.project_id
+    sa_results = pending.sa_results
+    project_result = sa_results['projects'][project_id]
+    crawl_process = pending.worker
+    with profiling.stage('crawl', project_id):
+      results = pending.future.result()
+    dump_fd = crawl_process.crawler_options.get('storage_buckets', {}).get(
+        'dump_fd')
+    if dump_fd is not None:
+      dump_fd.close()
+    for crawler_results in results.values():
+      project_result.update(crawler_results)
+    if crawl_process.truncated:
+      # Partial results are kept; the record tells where to resume.
+      project_result['truncated'] = crawl_process.truncated
+    if crawl_process.disabled:
+      project_result['disabled_apis'] = crawl_process.disabled
+    if crawl_process.denied:
+      project_result['permission_denied'] = sorted(crawl_process.denied)
+    if exposure_queries and project_result.get('firewall_rules'):
+      from . import exposure  # pylint: disable=import-outside-toplevel
+      project_result['exposure'] = exposure.analyze_project(
+          project_result, exposure_queries)
+    return PendingSave(pending, results,
+                       serializer.submit(sa_results, project_id))
+
+  def save_crawl(saving: PendingSave) -> None:
+    """Write serialized results of a project."""
+
+    pending, results = saving.crawl, saving.results
+    project_id = pending.item.project_id
+    sa_results = pending.sa_results
+    project_result = sa_results['projects'][project_id]
+    # The serializer tags its own samples, so the wait is left idle.
+    sa_results_data = saving.data.result()
+
+    # Write out results to json DB
+    logging.info('Saving results for %s into the file', project_id)
+    # Only waits for the disk when the writer queue is full.
+    with profiling.stage('write', project_id):
+      written = writer.write(os.path.join(out_dir, '%s.json' % project_id),
+                             sa_results_data, commit=True)
+    resources = {key: value for crawler_results in results.values()
+                 for key, value in crawler_results.items()}
+    duration = time.monotonic() - pending.started
+    writing.append((pending.item.lease_id, written, manifest.project_entry(
+        project_id, pending.item.sa_name, resources, project_result, duration,
+        pending.worker.api_calls, pending.worker.errors,
+        len(sa_results_data))))
+
+    if profiler is not None:
+      profiler.project_done(project_id)
+    # Clean memory to avoid leak for large amount projects.
+    sa_results.clear()
+    if reporter is not None:
+      reporter.project_finished(project_id, pending.item.sa_name, resources,
+                                duration)
+
+  # projects whose IAM policies are read, waiting for a resource crawl
+  ready: Deque[ReadyCrawl] = collections.deque()
+  # crawls started in the background, oldest first
+  crawling: Deque[PendingCrawl] = collections.deque()
+  # crawled projects being serialized, saved in the order they finished
+  saving: Deque[PendingSave] = collections.deque()
+  # leases of saved projects, their pending writes and manifest entries,
+  # acked and listed once the project file is committed, so that a scan that
+  # dies never leaves a project done with its results in a staged file
+  writing: Deque[Tuple[str, concurrent.futures.Future,
+                       Dict[str, Any]]] = collections.deque()
+  # Leases of projects are renewed until they are acked, however long the
+  # crawl takes.
+  renewer = workqueue.LeaseRenewer(work_queue).start()
   # Main loop
-  processed_sas = set()
-  while not context.service_account_queue.empty():
-    # Get a new candidate service account / token
-    sa_name, credentials, chain_so_far = context.service_account_queue.get()
-    if sa_name in processed_sas:
+  while True:
+    while writing and writing[0][1].done():
+      lease_id, written, entry = writing.popleft()
+      written.result()
+      work_queue.ack(lease_id)
+      renewer.drop(lease_id)
+      scan_manifest.add(entry)
+    # Serialize crawls that are over and start ready ones in their place.
+    # Traversal does not wait for crawls: IAM policies of every leased project
+    # are read as soon as it is leased, and only resource crawls are bounded
+    # by the pipeline depth.
+    while crawling and crawling[0].future.done():
+      saving.append(finish_crawl(crawling.popleft()))
+    while ready and len(crawling) < max(pipeline_depth, 1):
+      crawling.append(start_crawl(ready.popleft()))
+    # Wait for the oldest serialization when the pipeline is full.
+    while saving and (saving[0].data.done()
+                      or len(saving) >= max(pipeline_depth, 1)):
+      save_crawl(saving.popleft())
+    # Get a new candidate service account / token. Other processes sharing
+    # the queue may still add work, so wait for them before giving up.
+    item = work_queue.lease(
+        wait=0 if ready or crawling or saving or writing else QUEUE_WAIT)
+    if item is None:
+      if crawling:
+        saving.append(finish_crawl(crawling.popleft()))
+        continue
+      if saving:
+        save_crawl(saving.popleft())
+        continue
+      if writing:
+        writing[0][1].result()
+        continue
+      if work_queue.pending() == 0:
+        break
+      continue
+    sa_name, chain_so_far = item.sa_name, item.chain
+    credentials = item.credentials or resolve_credentials(
+        sa_name, chain_so_far, known_credentials)
+    if credentials is None:
+      logging.error('No credentials to work as %s', sa_name)
+      work_queue.ack(item.lease_id)
+      if reporter is not None and item.project_id is None:
+        reporter.sa_finished(sa_name)
       continue
 
-    # Don't process this service account again
-    processed_sas.add(sa_name)
-    logging.info('>> current service account: %s', sa_name)
+    if item.project_id is None:
+      logging.info('>> current service account: %s', sa_name)
+      project_list = project_cache.list_projects(sa_name, credentials)
+      if len(project_list) <= 0:
+        logging.info('Unable to list projects accessible from service account')
+
+      if force_projects:
+        # Projects that cannot be fetched are scanned anyway, with an N/A
+        # number.
+        project_list.extend(
+            project_cache.fetch_projects(force_projects, credentials))
+
+      # Enumerate projects accessible by SA
+      for project in project_list:
+        if target_project and target_project not in project['projectId']:
+          continue
+        if not sharding.in_shard(project['projectId'], shard):
+          continue
+        if work_queue.put(sa_name, chain_so_far, project['projectId'],
+                          project, credentials):
+          if asset_scope is not None:
+            # The data of the project is kept until this crawl takes it.
+            scope_inventory(credentials).expect(project['projectNumber'])
+          if reporter is not None:
+            reporter.project_added()
+      work_queue.ack(item.lease_id)
+      if reporter is not None:
+        reporter.sa_finished(sa_name)
+      continue
+
+    project = item.payload
+    project_id = project['projectId']
+    project_number = project['projectNumber']
+    print(f'Inspecting project {project_id}')
+    project_started = time.monotonic()
+    renewer.hold(item.lease_id)
     sa_results = crawl.infinite_defaultdict()
     # Log the chain we used to get here (even if we have no privs)
     sa_results['service_account_chain'] = chain_so_far
     sa_results['current_service_account'] = sa_name
+    project_result = sa_results['projects'][project_id]
 
-    project_list = crawl.get_project_list(credentials)
-    if len(project_list) <= 0:
-      logging.info('Unable to list projects accessible from service account')
-
-    if force_projects:
-      for force_project_id in force_projects:
-        res = crawl.fetch_project_info(force_project_id, credentials)
-        if res:
-          project_list.append(res)
-        else:
-          # force object creation anyway
-          project_list.append({'projectId': force_project_id,
-                               'projectNumber': 'N/A'})
-
-    # Enumerate projects accessible by SA
-    for project in project_list:
-      if target_project and target_project not in project['projectId']:
-        continue
-
-      project_id = project['projectId']
-      project_number = project['projectNumber']
-      print(f'Inspecting project {project_id}')
-      project_result = sa_results['projects'][project_id]
+    project_result['project_info'] = project
 
-      project_result['project_info'] = project
+    iam_policy = None
+    prefilled = dict()
+    if asset_scope is not None:
+      iam_policy, prefilled = scope_inventory(credentials).pop_project(
+          project_number)
+      if prefilled:
+        project_result['asset_inventory'] = sorted(prefilled)
 
+    with profiling.stage('iam', project_id):
       if is_set(scan_config, 'iam_policy'):
         # Get IAM policy
-        iam_client = iam_client_for_credentials(credentials)
-        iam_policy = crawl.get_iam_policy(project_id, credentials)
+        if iam_policy is None:
+          iam_policy = shared_call('get_iam_policy', project_id, credentials)
         project_result['iam_policy'] = iam_policy
 
       if is_set(scan_config, 'service_accounts'):
@@ -111,63 +427,178 @@ def crawl_loop(initial_sa_tuples: List[Tuple[str, Credentials, List[str]]],
             project_number, credentials)
         project_result['service_accounts'] = project_service_accounts
 
-      # Iterate over discovered service accounts by attempting impersonation
-      project_result['service_account_edges'] = []
-      updated_chain = chain_so_far + [sa_name]
+    # Iterate over discovered service accounts by attempting impersonation
+    project_result['service_account_edges'] = []
+    updated_chain = chain_so_far + [sa_name]
+
+    # Impersonation runs before the resource crawl, so that service accounts
+    # found here are queued while the crawl of this project is in progress.
+    if scan_config is not None:
+      impers = scan_config.get('service_accounts', None)
+    else:
+      impers = {'impersonate': True}
+    if impers is not None and impers.get('impersonate', False) is True:
+      if iam_policy is None:
+        iam_policy = shared_call('get_iam_policy', project_id, credentials)
+
+      project_service_accounts = crawl.get_associated_service_accounts(
+          iam_policy)
+      iam_client = iam_client_for_credentials(credentials)
+
+      for candidate_service_account in project_service_accounts:
+        logging.info('Trying {candidate_service_account}')
+        if not candidate_service_account.startswith('serviceAccount'):
+          continue
+        try:
+          creds_impersonated = credsdb.impersonate_sa(
+              iam_client, candidate_service_account)
+          known_credentials.setdefault(candidate_service_account,
+                                       creds_impersonated)
+          if (work_queue.put(candidate_service_account, updated_chain,
+                             credentials=creds_impersonated)
+              and reporter is not None):
+            reporter.sa_added(candidate_service_account)
+          project_result['service_account_edges'].append(
+              candidate_service_account)
+          work_queue.add_edge(sa_name, candidate_service_account, project_id,
+                              updated_chain)
+          if graph is not None:
+            graph.add_edge(sa_name, candidate_service_account, project_id)
+          logging.info('Successfully impersonated {candidate_service_account}'
+          'using {sa_name}')
+        except Exception:
+          logging.error('Failed to get token for %s',
+                                                    candidate_service_account)
+          logging.error(sys.exc_info()[1])
+
+    if graph is not None:
+      graph.add_policy(project_id, iam_policy)
+
+    enabled_services = None
+    # No API is called when the inventory covers every task.
+    if service_precheck and not (asset_scope is not None
+                                 and asset_keys <= prefilled.keys()):
+      enabled_services = enabled_services_cache.get(project_id)
+      if enabled_services is None:
+        enabled_services = crawlers.ProjectManager(
+            project_id, credentials).get_enabled_services()
+        if enabled_services is not None:
+          enabled_services_cache[project_id] = enabled_services
+
+    ready.append(ReadyCrawl(item, credentials, enabled_services, prefilled,
+                            sa_results, project_started))
+
+  while crawling:
+    saving.append(finish_crawl(crawling.popleft()))
+  while saving:
+    save_crawl(saving.popleft())
+  serializer.close()
+  logging.info('Serializer: %s', serializer.stats())
+  writer.close()
+  while writing:
+    lease_id, _, entry = writing.popleft()
+    work_queue.ack(lease_id)
+    scan_manifest.add(entry)
+  renewer.stop()
+  scan_manifest.finish()
+  logging.info('Output writer: %s', writer.stats())
+  logging.info('Manifest: %s', scan_manifest.stats())
+
+  with open(os.path.join(out_dir, sharding.EDGES_FILE), 'w',
+            encoding='utf-8') as outfile:
+    json.dump(work_queue.edges(), outfile, indent=2)
+  logging.info('IAM credentials clients: %s', IAM_CLIENTS.stats())
+  logging.info('Coalesced API calls: %s', singleflight.SHARED.stats())
+  logging.info('Project cache: %s', project_cache.stats())
+  if concurrency.LIMITER is not None:
+    logging.info('Concurrency limits: %s', concurrency.LIMITER.stats())
+  IAM_CLIENTS.close_all()
+  cost_model.save()
+  if graph is not None:
+    logging.info('Privilege graph: %s', graph.stats())
+    graph.save(graph_path)
+  if permission_cache is not None:
+    permission_cache.save()
+    logging.info('Permission cache: %s', permission_cache.stats())
+  if profiler is not None:
+    profiler.stop()
+    profiler.write()
+  if reporter is not None:
+    reporter.stop()
+
+
+def shared_call(name: str, project_id: str, credentials: Credentials) -> Any:
+  """Call a ProjectManager method through the shared coalescer.
+
+  Args:
+    name: name of the method, e.g. get_iam_policy
+    project_id: project of the ProjectManager
+    credentials: credentials of the ProjectManager
 
+  Returns:
+    The result of the call or of an identical call made concurrently or,
+    with --memo-ttl, shortly before.
+  """
 
-      crawl_process = Worker(scan_config,project_id,credentials)
-      results = crawl_process.run()
+  key = (clientpool.credential_key(credentials), 'ProjectManager.' + name,
+         project_id)
+  return singleflight.SHARED.do(
+      key, lambda: getattr(crawlers.ProjectManager(project_id, credentials),
+                           name)())
 
 
-      # trying to impersonate SAs within project
-      if scan_config is not None:
-        impers = scan_config.get('service_accounts', None)
-      else:
-        impers = {'impersonate': True}
-      if impers is not None and impers.get('impersonate', False) is True:
-        if is_set(scan_config, 'iam_policy') is False:
-          iam_policy = crawl.get_iam_policy(project_id, credentials)
-
-        project_service_accounts = crawl.get_associated_service_accounts(
-            iam_policy)
-
-        for candidate_service_account in project_service_accounts:
-          logging.info('Trying {candidate_service_account}')
-          if not candidate_service_account.startswith('serviceAccount'):
-            continue
-          try:
-            creds_impersonated = credsdb.impersonate_sa(
-                iam_client, candidate_service_account)
-            context.service_account_queue.put(
-                (candidate_service_account, creds_impersonated, updated_chain))
-            project_result['service_account_edges'].append(
-                candidate_service_account)
-            logging.info('Successfully impersonated {candidate_service_account}'
-            'using {sa_name}')
-          except Exception:
-            logging.error('Failed to get token for %s',
-                                                      candidate_service_account)
-            logging.error(sys.exc_info()[1])
-
-      # Write out results to json DB
-      logging.info('Saving results for %s into the file', project_id)
-
-      sa_results_data = json.dumps(sa_results, indent=2, sort_keys=False)
-
-      with open(out_dir + '/%s.json' % project_id, 'a',
-                encoding='utf-8') as outfile:
-        outfile.write(sa_results_data)
-
-      # Clean memory to avoid leak for large amount projects.
-      sa_results.clear()
+def resolve_credentials(sa_name: str, chain: List[str],
+                        known_credentials: Dict[str, Credentials]
+                        ) -> Optional[Credentials]:
+  """Re-create credentials of a service account queued by another process.
 
+  The chain is followed from the first account with known credentials,
+  impersonating each following account in turn.
 
-def iam_client_for_credentials(
-    credentials: Credentials) -> IAMCredentialsClient:
+  Args:
+    sa_name: service account to get credentials for
+    chain: service accounts impersonated to reach sa_name
+    known_credentials: credentials by service account name, updated in place
+
+  Returns:
+    Credentials or None if no account on the chain is known.
+  """
+
+  if sa_name in known_credentials:
+    return known_credentials[sa_name]
+  hops = chain + [sa_name]
+  known = [i for i, hop in enumerate(hops) if hop in known_credentials]
+  if not known:
+    return None
+  credentials = known_credentials[hops[known[-1]]]
+  for hop in hops[known[-1] + 1:]:
+    try:
+      credentials = credsdb.impersonate_sa(
+          iam_client_for_credentials(credentials), hop)
+    except Exception:
+      logging.error('Failed to impersonate %s', hop)
+      logging.error(sys.exc_info()[1])
+      return None
+    known_credentials[hop] = credentials
+  return credentials
+
+
+def _new_iam_client(credentials: Credentials) -> 'IAMCredentialsClient':
+  from google.cloud import iam_credentials
   return iam_credentials.IAMCredentialsClient(credentials=credentials)
 
 
+# IAM credentials clients by credential. Each client holds a gRPC channel, so
+# one is kept per credential for all projects scanned with it.
+IAM_CLIENTS = clientpool.ClientPool(
+    _new_iam_client, close=lambda client: client.transport.close())
+
+
+def iam_client_for_credentials(
+    credentials: Credentials) -> 'IAMCredentialsClient':
+  return IAM_CLIENTS.get(credentials)
+
+
 def main():
   logging.getLogger('googleapicliet.discovery_cache').setLevel(logging.ERROR)
   logging.getLogger('googleapiclient.http').setLevel(logging.ERROR)
@@ -235,6 +666,196 @@ token_uri and client_secret stored in JSON format.'
       default=None,
       dest='config_path',
       help='A path to config file with a set of specific resources to scan.')
+  parser.add_argument(
+      '--crawler-timeout',
+      default=None,
+      type=float,
+      dest='crawler_timeout',
+      help='Seconds each crawler may spend on a project. A "timeout" in a\
+ resource section of the config file overrides it.')
+  parser.add_argument(
+      '--project-timeout',
+      default=None,
+      type=float,
+      dest='project_timeout',
+      help='Seconds all crawlers may spend on a project')
+  parser.add_argument(
+      '--no-service-check',
+      default=True,
+      dest='service_precheck',
+      action='store_false',
+      help='Call every API even when it is not enabled in the project')
+  parser.add_argument(
+      '--denial-ttl',
+      default=24,
+      type=float,
+      dest='denial_ttl',
+      help='Hours to skip API calls denied to a credential in a previous\
+ iteration or scan. 0 disables the permission cache.')
+  parser.add_argument(
+      '--shards',
+      default=1,
+      type=int,
+      dest='shards',
+      help='Number of processes to split projects across. Without\
+ --work-queue, each process follows only the impersonations found in its\
+ own projects, so service accounts, chains and edges can differ from an\
+ unsharded scan.')
+  parser.add_argument(
+      '--shard',
+      default=None,
+      type=sharding.parse_shard,
+      dest='shard',
+      help='Scan only shard i of N (i/N) of the projects, for runs spread\
+ over several hosts. Service accounts are traversed per shard, as with\
+ --shards.')
+  parser.add_argument(
+      '--merge-shards',
+      default=None,
+      dest='merge_shards',
+      help='A list of comma separated output directories of --shard runs to\
+ merge into the output directory. No scan is performed.')
+  parser.add_argument(
+      '--work-queue',
+      default=None,
+      dest='work_queue',
+      help='Path to a SQLite work queue shared by scanner processes. With\
+ --shards, the processes pull work from the queue instead of splitting\
+ projects.')
+  parser.add_argument(
+      '--memo-ttl',
+      default=0,
+      type=float,
+      dest='memo_ttl',
+      help='Seconds to reuse the response of an API call for identical calls\
+ made with the same credentials. By default only calls in flight at the same\
+ time are shared.')
+  parser.add_argument(
+      '--exposure',
+      default=None,
+      dest='exposure',
+      help='A list of comma separated source:protocol:port queries, e.g.\
+ 0.0.0.0/0:tcp:22, to report instances, static addresses and subnets\
+ reachable by that traffic. Requires numpy.')
+  parser.add_argument(
+      '--privilege-graph',
+      default=False,
+      dest='privilege_graph',
+      action='store_true',
+      help='Save impersonations and IAM grants as a graph for reachability\
+ queries. Requires numpy.')
+  parser.add_argument(
+      '--no-adaptive-concurrency',
+      default=True,
+      dest='adaptive_concurrency',
+      action='store_false',
+      help='Send API requests without per API limits adjusted to latency\
+ and errors')
+  parser.add_argument(
+      '--pipeline-depth',
+      default=PIPELINE_DEPTH,
+      type=int,
+      dest='pipeline_depth',
+      help='Number of projects crawled in the background while IAM policies\
+ of further projects are read and service accounts impersonated')
+  parser.add_argument(
+      '--asset-scope',
+      default=None,
+      dest='asset_scope',
+      help='An organization or folder, e.g. organizations/123, to search with\
+ Cloud Asset Inventory. Resources and project IAM policies found there are\
+ used instead of per API calls, which only run for what is not covered.')
+  parser.add_argument(
+      '--asset-endpoint',
+      default=None,
+      dest='asset_endpoint',
+      help='Root URL of the Cloud Asset API, e.g. of a local fake')
+  parser.add_argument(
+      '--json-format',
+      default=serialization.PRETTY,
+      dest='json_format',
+      choices=serialization.FORMATS,
+      help='Indent results (pretty, the default) or write them without\
+ whitespace (compact)')
+  parser.add_argument(
+      '--json-backend',
+      default=None,
+      dest='json_backend',
+      choices=serialization.BACKENDS,
+      help='Serialize with orjson or the json module. By default orjson is\
+ used when installed; the output is identical.')
+  parser.add_argument(
+      '--serializer-processes',
+      default=0,
+      type=int,
+      dest='serializer_processes',
+      help='Serialize results in this many forked processes instead of a\
+ thread, for large projects without orjson')
+  parser.add_argument(
+      '--fsync',
+      default=output.FSYNC_CLOSE,
+      dest='fsync_policy',
+      choices=output.FSYNC_POLICIES,
+      help=('When results are synced to disk: once per file before it is '
+            'moved into place (close, the default), after every batch of '
+            'writes (batch) or never (none)'))
+  parser.add_argument(
+      '--write-queue-mb',
+      default=output.DEFAULT_QUEUE_BYTES // (1024 * 1024),
+      type=int,
+      dest='write_queue_mb',
+      help=('Megabytes of results queued for the output writer before the '
+            'scan waits for the disk'))
+  parser.add_argument(
+      '--progress',
+      default=False,
+      dest='progress',
+      action='store_true',
+      help='Show projects done, queued service accounts, requests in flight,\
+ items per second and an ETA on stderr')
+  parser.add_argument(
+      '--progress-file',
+      default=None,
+      dest='progress_file',
+      help='Append progress events to this JSON lines file')
+  parser.add_argument(
+      '--profile',
+      default=False,
+      dest='profile',
+      action='store_true',
+      help='Sample CPU stacks by project, crawler and API method. Flame graph\
+ input and a summary are written into the profile directory of the output.')
+  parser.add_argument(
+      '--profile-interval',
+      default=profiling.DEFAULT_INTERVAL * 1000,
+      type=float,
+      dest='profile_interval',
+      help='Milliseconds between profiler samples')
+  parser.add_argument(
+      '--profile-memory',
+      default=False,
+      dest='profile_memory',
+      action='store_true',
+      help='Also trace memory by project while profiling. Tracing slows down\
+ allocations and snapshots memory after every saved project, so it is off by\
+ default.')
+  parser.add_argument(
+      '--record',
+      default=None,
+      dest='record',
+      help='Save every API response of the scan into a cassette archive')
+  parser.add_argument(
+      '--replay',
+      default=None,
+      dest='replay',
+      help='Answer API calls from a cassette archive instead of GCP')
+  parser.add_argument(
+      '--replay-latency',
+      default=0,
+      type=float,
+      dest='replay_latency',
+      help='With --replay, wait the recorded response time multiplied by\
+ this factor before each response. 0 replays without delays.')
   parser.add_argument(
       '-l',
       '--logging',
@@ -244,6 +865,20 @@ token_uri and client_secret stored in JSON format.'
       help='Set logging level (INFO, WARNING, ERROR)')
 
   args = parser.parse_args()
+  if args.record and args.replay:
+    parser.error('--record and --replay are exclusive')
+  if args.record and args.shards > 1:
+    parser.error('--record needs a single process, drop --shards')
+  if args.asset_scope and not args.asset_scope.startswith(
+      ('organizations/', 'folders/', 'projects/')):
+    parser.error('--asset-scope must be organizations/N, folders/N or'
+                 ' projects/ID')
+  if args.json_backend == serialization.ORJSON and serialization.orjson is None:
+    parser.error('--json-backend orjson needs the orjson package')
+  if args.merge_shards:
+    sharding.merge_shards(args.merge_shards.split(','), args.output)
+    return 0
+
   if not args.key_path and not args.gcloud_profile_path \
     and not args.use_metadata and not args.access_token_files\
     and not args.refresh_token_files:
@@ -258,6 +893,13 @@ token_uri and client_secret stored in JSON format.'
 
   logging.basicConfig(level=getattr(logging, args.log_level.upper(), None))
 
+  recorder = None
+  if args.record or args.replay:
+    from . import cassette  # pylint: disable=import-outside-toplevel
+    recorder = cassette.Cassette(
+        args.record or args.replay, 'record' if args.record else 'replay',
+        args.replay_latency).install(IAM_CLIENTS)
+
   sa_tuples = []
   if args.key_path:
     # extracting SA keys from folder
@@ -328,6 +970,51 @@ token_uri and client_secret stored in JSON format.'
       scan_config = json.load(f)
 
 
-  crawl_loop(sa_tuples, args.output, scan_config, args.target_project,
-             force_projects_list)
+  singleflight.SHARED.ttl = args.memo_ttl
+  if not args.adaptive_concurrency:
+    concurrency.LIMITER = None
+  work_queue = None
+  if args.work_queue:
+    work_queue = workqueue.SQLiteWorkQueue(args.work_queue)
+
+  exposure_queries = None
+  if args.exposure:
+    from . import exposure  # pylint: disable=import-outside-toplevel
+    exposure_queries = exposure.parse_queries(args.exposure)
+
+  scan = functools.partial(
+      crawl_loop, sa_tuples, scan_config=scan_config, work_queue=work_queue,
+      target_project=args.target_project, force_projects=force_projects_list,
+      crawler_timeout=args.crawler_timeout,
+      project_timeout=args.project_timeout,
+      service_precheck=args.service_precheck,
+      denial_ttl=args.denial_ttl * 3600 if args.denial_ttl > 0 else None,
+      exposure_queries=exposure_queries,
+      privilege_graph=args.privilege_graph,
+      profile_interval=args.profile_interval / 1000 if args.profile else None,
+      profile_memory=args.profile_memory,
+      progress_line=args.progress,
+      progress_file=args.progress_file,
+      pipeline_depth=args.pipeline_depth,
+      asset_scope=args.asset_scope,
+      asset_endpoint=args.asset_endpoint,
+      json_format=args.json_format,
+      json_backend=args.json_backend,
+      serializer_processes=args.serializer_processes,
+      fsync_policy=args.fsync_policy,
+      write_queue_bytes=args.write_queue_mb * 1024 * 1024)
+  try:
+    if args.shards > 1:
+      failed = sharding.run_shards(
+          args.shards, args.output,
+          lambda shard, shard_dir: scan(
+              out_dir=shard_dir, shard=None if work_queue else shard))
+      if failed:
+        return 1
+    else:
+      scan(out_dir=args.output, shard=args.shard)
+  finally:
+    if recorder is not None:
+      recorder.close()
+  logging.info('Crawler module import times: %s', registry.import_times())
   return 0
\ No newline at end of file
@@ -0,0 +1,403 @@
+# Copyright 2022 Google LLC
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     https://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+
+"""The module to query results of a finished scan through an index.
+
+Every resource found in the project files of an output directory becomes a
+record, indexed under terms:
+
+  type:<resource type>         e.g. type:storage_buckets
+  project:<project id>
+  label:<key> and label:<key>=<value>
+  email:<address>              any e-mail address in the resource
+  member:<special member>      allUsers or allAuthenticatedUsers
+  ip:<IPv4 address>
+  scanned_by:<service account> the identity the resource was found with
+
+The index is a list of immutable segments in <output>/.scan_index. A
+segment holds sorted 64-bit term hashes, posting lists of record ids and
+the records, as files that are memory-mapped for queries. Project files are
+only appended to by scans, so an update parses just the bytes added since
+the previous update and writes them as a new segment.
+
+  python -m gcp_scanner.scanquery -o out type:storage_buckets member:allUsers
+"""
+
+import argparse
+import hashlib
+import json
+import logging
+import mmap
+import os
+import re
+import shutil
+import sys
+from typing import Any, Dict, Iterator, List, Optional, Set, Tuple
+
+import numpy as np
+
+from . import sharding
+
+INDEX_DIR = '.scan_index'
+MANIFEST_FILE = 'manifest.json'
+# Segments are merged into one when there are more than this.
+MAX_SEGMENTS = 8
+
+# Result keys of a project that do not hold resources.
+SKIP_KEYS = ('truncated', 'disabled_apis', 'permission_denied',
+             'service_account_edges', 'exposure')
+SPECIAL_MEMBERS = ('allUsers', 'allAuthenticatedUsers')
+
+_EMAIL = re.compile(r'[\w.+-]+@[\w-]+(?:\.[\w-]+)+')
+_IPV4 = re.compile(r'(?:\d{1,3}\.){3}\d{1,3}')
+
+
+def term_hash(term: str) -> int:
+  return int.from_bytes(
+      hashlib.blake2b(term.encode('utf-8'), digest_size=8).digest(), 'little')
+
+
+def _strings(value: Any) -> Iterator[str]:
+  if isinstance(value, str):
+    yield value
+  elif isinstance(value, dict):
+    for item in value.values():
+      yield from _strings(item)
+  elif isinstance(value, (list, tuple)):
+    for item in value:
+      yield from _strings(item)
+
+
+def _labels(value: Any) -> Iterator[Tuple[str, str]]:
+  if isinstance(value, dict):
+    for key, item in value.items():
+      if key in ('labels', 'resourceLabels') and isinstance(item, dict):
+        for label, label_value in item.items():
+          yield label, str(label_value)
+      else:
+        yield from _labels(item)
+  elif isinstance(value, (list, tuple)):
+    for item in value:
+      yield from _labels(item)
+
+
+def resource_terms(resource: Any) -> Set[str]:
+  """Return the label, e-mail, member and IP terms of a resource."""
+
+  terms = set()
+  for label, label_value in _labels(resource):
+    terms.add(f'label:{label}')
+    terms.add(f'label:{label}={label_value}')
+  for string in _strings(resource):
+    if string in SPECIAL_MEMBERS:
+      terms.add(f'member:{string}')
+      continue
+    for email in _EMAIL.findall(string):
+      terms.add(f'email:{email.lower()}')
+    if _IPV4.fullmatch(string.split('/', 1)[0]):
+      terms.add(f'ip:{string.split("/", 1)[0]}')
+  return terms
+
+
+def _resources(resource_type: str, value: Any) -> Iterator[Tuple[str, Any]]:
+  """Split a result of a crawler into (name, resource) pairs."""
+
+  if isinstance(value, dict) and resource_type not in ('project_info',
+                                                       'iam_policy'):
+    for name, resource in value.items():
+      yield str(name), resource
+  elif isinstance(value, list):
+    for position, resource in enumerate(value):
+      name = None
+      if isinstance(resource, dict):
+        name = resource.get('name') or resource.get('email')
+      elif isinstance(resource, (list, tuple)) and resource:
+        name = resource[0]
+      yield str(name if name is not None else position), resource
+  elif value:
+    yield resource_type, value
+
+
+def document_records(file_name: str, document: Dict[str, Any]
+                     ) -> Iterator[Tuple[Dict[str, str], Set[str]]]:
+  """Return records and their terms for one scan document."""
+
+  scanned_by = document.get('current_service_account')
+  for project_id, result in document.get('projects', {}).items():
+    for resource_type, value in result.items():
+      if resource_type in SKIP_KEYS:
+        continue
+      for name, resource in _resources(resource_type, value):
+        terms = resource_terms(resource)
+        terms.add(f'type:{resource_type}')
+        terms.add(f'project:{project_id}')
+        if scanned_by:
+          terms.add(f'scanned_by:{scanned_by}')
+        yield ({'project': project_id, 'type': resource_type, 'name': name,
+                'file': file_name, 'scanned_by': scanned_by}, terms)
+
+
+class _Segment:
+  """A memory-mapped segment of the index."""
+
+  def __init__(self, path: str):
+    self.path = path
+    self.hashes = np.load(os.path.join(path, 'hashes.npy'), mmap_mode='r')
+    self.offsets = np.load(os.path.join(path, 'offsets.npy'), mmap_mode='r')
+    self.postings = np.load(os.path.join(path, 'postings.npy'), mmap_mode='r')
+    self.record_offsets = np.load(os.path.join(path, 'record_offsets.npy'),
+                                  mmap_mode='r')
+    self._records_file = open(os.path.join(path, 'records.bin'), 'rb')
+    self.records = (mmap.mmap(self._records_file.fileno(), 0,
+                              access=mmap.ACCESS_READ)
+                    if os.fstat(self._records_file.fileno()).st_size else b'')
+
+  def close(self) -> None:
+    if isinstance(self.records, mmap.mmap):
+      self.records.close()
+    self._records_file.close()
+
+  def __len__(self) -> int:
+    return self.record_offsets.size - 1
+
+  def lookup(self, term: str) -> np.ndarray:
+    key = np.uint64(term_hash(term))
+    position = int(np.searchsorted(self.hashes, key))
+    if position == self.hashes.size or self.hashes[position] != key:
+      return np.empty(0, dtype=np.uint32)
+    return self.postings[self.offsets[position]:self.offsets[position + 1]]
+
+  def record(self, record_id: int) -> Dict[str, str]:
+    start = int(self.record_offsets[record_id])
+    end = int(self.record_offsets[record_id + 1])
+    return json.loads(self.records[start:end])
+
+
+def _write_segment(path: str, pair_hashes: np.ndarray,
+                   pair_records: np.ndarray, records: List[bytes]) -> None:
+  """Write a segment from (term hash, record id) pairs and records."""
+
+  order = np.lexsort((pair_records, pair_hashes))
+  pair_hashes, pair_records = pair_hashes[order], pair_records[order]
+  hashes, starts = np.unique(pair_hashes, return_index=True)
+  offsets = np.append(starts, pair_hashes.size).astype(np.int64)
+  record_offsets = np.zeros(len(records) + 1, dtype=np.int64)
+  np.cumsum([len(record) for record in records], out=record_offsets[1:])
+
+  tmp_path = path + '.tmp'
+  # Left behind by an update that crashed while writing the segment, or
+  # before saving the manifest: segment names are only taken once saved.
+  shutil.rmtree(tmp_path, ignore_errors=True)
+  shutil.rmtree(path, ignore_errors=True)
+  os.makedirs(tmp_path)
+  np.save(os.path.join(tmp_path, 'hashes.npy'), hashes.astype(np.uint64))
+  np.save(os.path.join(tmp_path, 'offsets.npy'), offsets)
+  np.save(os.path.join(tmp_path, 'postings.npy'),
+          pair_records.astype(np.uint32))
+  np.save(os.path.join(tmp_path, 'record_offsets.npy'), record_offsets)
+  with open(os.path.join(tmp_path, 'records.bin'), 'wb') as outfile:
+    outfile.write(b''.join(records))
+  os.rename(tmp_path, path)
+
+
+class ScanIndex:
+  """An incrementally updated index over an output directory."""
+
+  def __init__(self, out_dir: str):
+    self.out_dir = out_dir
+    self.path = os.path.join(out_dir, INDEX_DIR)
+    self.manifest = {'segments': [], 'files': {}, 'next_segment': 0}
+    manifest_path = os.path.join(self.path, MANIFEST_FILE)
+    if os.path.exists(manifest_path):
+      with open(manifest_path, encoding='utf-8') as infile:
+        self.manifest = json.load(infile)
+    self._segments: Optional[List[_Segment]] = None
+
+  def _save_manifest(self) -> None:
+    manifest_path = os.path.join(self.path, MANIFEST_FILE)
+    with open(manifest_path + '.tmp', 'w', encoding='utf-8') as outfile:
+      json.dump(self.manifest, outfile)
+    os.replace(manifest_path + '.tmp', manifest_path)
+
+  def _new_segment_path(self) -> str:
+    name = 'segment-%06d' % self.manifest['next_segment']
+    self.manifest['next_segment'] += 1
+    return name
+
+  def segments(self) -> List[_Segment]:
+    if self._segments is None:
+      self._segments = [_Segment(os.path.join(self.path, name))
+                        for name in self.manifest['segments']]
+    return self._segments
+
+  def close(self) -> None:
+    for segment in self._segments or []:
+      segment.close()
+    self._segments = None
+
+  def update(self) -> int:
+    """Index bytes appended to project files since the last update.
+
+    Returns:
+      The number of records added.
+    """
+
+    os.makedirs(self.path, exist_ok=True)
+    decoder = json.JSONDecoder()
+    pair_hashes, pair_records, records = [], [], []
+    indexed = self.manifest['files']
+    for file_name in sorted(os.listdir(self.out_dir)):
+      if not file_name.endswith('.json') or file_name in sharding.STATE_FILES:
+        continue
+      file_path = os.path.join(self.out_dir, file_name)
+      start = indexed.get(file_name, 0)
+      if os.path.getsize(file_path) <= start:
+        continue
+      with open(file_path, 'rb') as infile:
+        infile.seek(start)
+        content = infile.read().decode('utf-8', errors='replace')
+      position = 0
+      while position < len(content):
+        if content[position].isspace():
+          position += 1
+          continue
+        try:
+          document, position_end = decoder.raw_decode(content, position)
+        except ValueError:
+          # A scan may still be writing the last document.
+          logging.info('Stopped indexing %s at byte %d', file_name,
+                       start + len(content[:position].encode('utf-8')))
+          break
+        position = position_end
+        for record, terms in document_records(file_name, document):
+          record_id = len(records)
+          records.append(json.dumps(record).encode('utf-8'))
+          for term in terms:
+            pair_hashes.append(term_hash(term))
+            pair_records.append(record_id)
+      indexed[file_name] = start + len(content[:position].encode('utf-8'))
+
+    if records:
+      name = self._new_segment_path()
+      _write_segment(os.path.join(self.path, name),
+                     np.array(pair_hashes, dtype=np.uint64),
+                     np.array(pair_records, dtype=np.uint32), records)
+      self.close()
+      self.manifest['segments'].append(name)
+    self._save_manifest()
+    if len(self.manifest['segments']) > MAX_SEGMENTS:
+      self.compact()
+    return len(records)
+
+  def compact(self) -> None:
+    """Merge all segments into one."""
+
+    pair_hashes, pair_records, records = [], [], []
+    base = 0
+    for segment in self.segments():
+      counts = np.diff(segment.offsets)
+      pair_hashes.append(np.repeat(np.asarray(segment.hashes), counts))
+      pair_records.append(np.asarray(segment.postings, dtype=np.uint32) + base)
+      records.extend(bytes(segment.records[segment.record_offsets[index]:
+                                           segment.record_offsets[index + 1]])
+                     for index in range(len(segment)))
+      base += len(segment)
+    old_segments = list(self.manifest['segments'])
+    name = self._new_segment_path()
+    _write_segment(os.path.join(self.path, name),
+                   np.concatenate(pair_hashes).astype(np.uint64),
+                   np.concatenate(pair_records).astype(np.uint32), records)
+    self.close()
+    self.manifest['segments'] = [name]
+    self._save_manifest()
+    for old_name in old_segments:
+      shutil.rmtree(os.path.join(self.path, old_name), ignore_errors=True)
+
+  def query(self, terms: List[str]) -> Iterator[Dict[str, str]]:
+    """Return records indexed under all terms."""
+
+    for segment in self.segments():
+      record_ids = None
+      for term in terms:
+        postings = segment.lookup(term)
+        record_ids = (postings if record_ids is None
+                      else np.intersect1d(record_ids, postings,
+                                          assume_unique=True))
+        if not record_ids.size:
+          break
+      for record_id in record_ids if record_ids is not None else []:
+        yield segment.record(int(record_id))
+
+
+def main():
+  parser = argparse.ArgumentParser(
+      prog='scanquery.py',
+      description='Query resources found by a GCP scan',
+      usage='%(prog)s -o out_dir [options] term [term ...]',
+      add_help=True,
+      allow_abbrev=False)
+  parser.add_argument(
+      'terms',
+      nargs='+',
+      help='Terms all matching resources have, e.g. type:storage_buckets,\
+ project:my-project, label:env=prod, email:sa@my-project.iam.gserviceaccount.com,\
+ member:allUsers, ip:10.0.0.2')
+  required_named = parser.add_argument_group('required arguments')
+  required_named.add_argument(
+      '-o',
+      '--output-dir',
+      required=True,
+      dest='output',
+      help='Path to output directory of a scan')
+  parser.add_argument(
+      '--no-update',
+      default=True,
+      dest='update',
+      action='store_false',
+      help='Query the index without indexing new scan results first')
+  parser.add_argument(
+      '--projects',
+      default=False,
+      dest='projects',
+      action='store_true',
+      help='Print only the projects of matching resources')
+  parser.add_argument(
+      '-l',
+      '--logging',
+      default='WARNING',
+      dest='log_level',
+      choices=('INFO', 'WARNING', 'ERROR'),
+      help='Set logging level (INFO, WARNING, ERROR)')
+
+  args = parser.parse_args()
+  logging.basicConfig(level=getattr(logging, args.log_level.upper(), None))
+
+  index = ScanIndex(args.output)
+  if args.update:
+    logging.info('Indexed %d new resources', index.update())
+  seen_projects = set()
+  for record in index.query(args.terms):
+    if args.projects:
+      if record['project'] not in seen_projects:
+        seen_projects.add(record['project'])
+        print(record['project'])
+    else:
+      print(json.dumps(record))
+  index.close()
+  return 0
+
+
+if __name__ == '__main__':
+  sys.exit(main())
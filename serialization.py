@@ -0,0 +1,256 @@
+# Copyright 2022 Google LLC
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     https://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+
+"""The module to serialize scan results to JSON off the crawl loop.
+
+Two formats are written: 'pretty', the json.dumps(indent=2) output of
+earlier scans, and 'compact', json.dumps with (',', ':') separators. Both
+escape non-ASCII characters.
+
+orjson is used when it is installed, and its output is made byte for byte
+identical to the json module:
+
+  non-ASCII characters and DEL are escaped afterwards,
+  outputs holding floats that the two libraries format differently (below
+  1e-4 or from 1e16 on) are serialized again with json,
+  objects orjson refuses, such as integers over 64 bits or non string keys,
+  are serialized with json,
+  objects holding NaN or infinities, which orjson writes as null, are
+  serialized with json, which writes NaN, Infinity and -Infinity.
+
+Serialization runs in a background thread, or in forked processes for the
+pure Python indenting encoder of the json module.
+"""
+
+import codecs
+import concurrent.futures
+import json
+import math
+import multiprocessing
+import re
+import threading
+from typing import Any, Dict, Optional, Tuple
+
+from crawlers import profiling
+
+try:
+  import orjson
+except ImportError:
+  orjson = None
+
+PRETTY = 'pretty'
+COMPACT = 'compact'
+FORMATS = (PRETTY, COMPACT)
+
+ORJSON = 'orjson'
+STDLIB = 'json'
+BACKENDS = (ORJSON, STDLIB)
+
+# An exponent of a float that ends a value, e.g. 1e16, or 1.5e-7 in a list.
+_EXPONENT = re.compile(rb'e-?[0-9]+(?:[,\]}\n]|\Z)')
+_SMALL = re.compile(rb'0\.0000')
+_DIGITS = b'0123456789'
+# The codec error handler escaping characters like json.dumps.
+_ESCAPE_ERRORS = 'jsonescape'
+
+
+def default_backend() -> str:
+  return ORJSON if orjson is not None else STDLIB
+
+
+def _escape(char: str) -> str:
+  code = ord(char)
+  if code < 0x10000:
+    return '\\u%04x' % code
+  code -= 0x10000
+  return '\\u%04x\\u%04x' % (0xd800 | (code >> 10), 0xdc00 | (code & 0x3ff))
+
+
+def _escape_errors(error: UnicodeEncodeError) -> Tuple[str, int]:
+  return ''.join(_escape(char)
+                 for char in error.object[error.start:error.end]), error.end
+
+
+codecs.register_error(_ESCAPE_ERRORS, _escape_errors)
+
+
+def _floats_differ(data: bytes) -> bool:
+  """Tell whether orjson output may hold floats json writes differently.
+
+  json switches to exponents below 1e-4 and from 1e16 on, orjson writes
+  1e16 and 0.00001. A match inside a string only costs a fallback.
+  """
+
+  for match in _EXPONENT.finditer(data):
+    if data[match.start() - 1] in _DIGITS:
+      return True
+  for match in _SMALL.finditer(data):
+    if match.start() == 0 or data[match.start() - 1] not in _DIGITS:
+      return True
+  return False
+
+
+def _has_non_finite(obj: Any) -> bool:
+  stack = [obj]
+  while stack:
+    value = stack.pop()
+    if isinstance(value, float):
+      if not math.isfinite(value):
+        return True
+    elif isinstance(value, dict):
+      stack.extend(value.values())
+    elif isinstance(value, (list, tuple)):
+      stack.extend(value)
+  return False
+
+
+def _dumps_json(obj: Any, json_format: str) -> bytes:
+  if json_format == PRETTY:
+    return json.dumps(obj, indent=2, sort_keys=False).encode('ascii')
+  return json.dumps(obj, separators=(',', ':')).encode('ascii')
+
+
+def _dumps_orjson(obj: Any, json_format: str) -> Optional[bytes]:
+  try:
+    data = orjson.dumps(
+        obj, option=orjson.OPT_INDENT_2 if json_format == PRETTY else 0)
+  except TypeError:
+    # orjson.JSONEncodeError is a TypeError
+    return None
+  if _floats_differ(data):
+    return None
+  # NaN and infinities come out as null, so only outputs with null can hold
+  # them.
+  if b'null' in data and _has_non_finite(obj):
+    return None
+  if not data.isascii() or b'\x7f' in data:
+    # Outside of strings, JSON is ASCII, so only strings are escaped.
+    data = data.decode('utf-8').replace('\x7f', '\\u007f').encode(
+        'ascii', _ESCAPE_ERRORS)
+  return data
+
+
+def dumps(obj: Any, json_format: str = PRETTY,
+          backend: str = STDLIB) -> Tuple[bytes, bool]:
+  """Serialize an object.
+
+  Args:
+    obj: An object to serialize.
+    json_format: PRETTY or COMPACT.
+    backend: ORJSON or STDLIB.
+
+  Returns:
+    The JSON document and whether orjson was used.
+  """
+
+  if backend == ORJSON:
+    data = _dumps_orjson(obj, json_format)
+    if data is not None:
+      return data, True
+  return _dumps_json(obj, json_format), False
+
+
+class Serializer:
+  """Serializes results in the background.
+
+  Args:
+    json_format: PRETTY or COMPACT.
+    backend: ORJSON or STDLIB, None for orjson when it is installed.
+    processes: A number of forked processes serializing results, 0 for a
+      thread of this process.
+  """
+
+  def __init__(self, json_format: str = PRETTY, backend: Optional[str] = None,
+               processes: int = 0):
+    if json_format not in FORMATS:
+      raise ValueError(f'Unknown JSON format {json_format}')
+    backend = backend or default_backend()
+    if backend not in BACKENDS:
+      raise ValueError(f'Unknown JSON backend {backend}')
+    if backend == ORJSON and orjson is None:
+      raise ValueError('orjson is not installed')
+    self.json_format = json_format
+    self.backend = backend
+    self.processes = processes
+    if processes > 0:
+      # Forked children inherit the modules already imported.
+      self._executor = concurrent.futures.ProcessPoolExecutor(
+          processes, mp_context=multiprocessing.get_context('fork'))
+    else:
+      self._executor = concurrent.futures.ThreadPoolExecutor(
+          max_workers=1, thread_name_prefix='serializer')
+    self._lock = threading.Lock()
+    self.fast = 0
+    self.fallbacks = 0
+    self.bytes = 0
+
+  def _count(self, data: bytes, fast: bool) -> bytes:
+    with self._lock:
+      if fast:
+        self.fast += 1
+      else:
+        self.fallbacks += 1
+      self.bytes += len(data)
+    return data
+
+  def _dumps_tagged(self, obj: Any, project: str) -> Tuple[bytes, bool]:
+    with profiling.stage('serialize', project):
+      return dumps(obj, self.json_format, self.backend)
+
+  def dumps(self, obj: Any) -> bytes:
+    """Serialize an object in the calling thread."""
+    return self._count(*dumps(obj, self.json_format, self.backend))
+
+  def submit(self, obj: Any,
+             project: str = '-') -> 'concurrent.futures.Future[bytes]':
+    """Serialize an object in the background.
+
+    The object must not change until the returned future is done.
+
+    Args:
+      obj: An object to serialize.
+      project: A project the object belongs to, for the profiler.
+
+    Returns:
+      A future of the JSON document.
+    """
+
+    if self.processes > 0:
+      inner = self._executor.submit(dumps, obj, self.json_format,
+                                    self.backend)
+    else:
+      inner = self._executor.submit(self._dumps_tagged, obj, project)
+    outer = concurrent.futures.Future()
+
+    def done(future):
+      try:
+        outer.set_result(self._count(*future.result()))
+      except BaseException as e:
+        outer.set_exception(e)
+    inner.add_done_callback(done)
+    return outer
+
+  def close(self) -> None:
+    self._executor.shutdown(wait=True)
+
+  def stats(self) -> Dict[str, Any]:
+    with self._lock:
+      return {
+          'backend': self.backend,
+          'format': self.json_format,
+          'fast': self.fast,
+          'fallbacks': self.fallbacks,
+          'bytes': self.bytes,
+      }
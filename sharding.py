@@ -0,0 +1,255 @@
+# Copyright 2022 Google LLC
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     https://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+
+"""The module to split a scan across processes or hosts by project.
+
+Each shard traverses service accounts on its own and follows only the
+impersonations found in its own projects. Merged output can therefore
+differ from an unsharded scan: service accounts reached through a project
+of another shard are missed, others are impersonated by several shards and
+chains may be shorter or longer. Shards sharing a work queue traverse
+service accounts together and do not have this difference.
+"""
+
+import hashlib
+import json
+import logging
+import multiprocessing
+import os
+import shutil
+from typing import Any, Callable, Dict, List, Optional, Tuple
+
+from crawlers import permcache
+from crawlers import profiling
+from crawlers import registry
+
+# Impersonation edges discovered by a scan.
+EDGES_FILE = 'service_account_edges.json'
+GRAPH_FILE = 'privilege_graph.npz'
+# Index of the projects saved by a scan, see manifest.py.
+MANIFEST_FILE = 'scan_manifest.json'
+# Suffix of files listing objects of the buckets of a project.
+OBJECTS_SUFFIX = '.gcs'
+# Files in the output directory that are not per-project results.
+STATE_FILES = (EDGES_FILE, registry.COST_FILE, permcache.CACHE_FILE,
+               MANIFEST_FILE)
+
+
+def shard_of(project_id: str, num_shards: int) -> int:
+  """Map a project to a shard.
+
+  The mapping only depends on the project id, so every process and host
+  agrees on it regardless of the order projects are listed in.
+
+  Args:
+    project_id: An id of a project.
+    num_shards: A total number of shards.
+
+  Returns:
+    A shard index in [0, num_shards).
+  """
+
+  digest = hashlib.sha1(project_id.encode('utf-8')).digest()
+  return int.from_bytes(digest[:8], 'big') % num_shards
+
+
+def parse_shard(value: str) -> Tuple[int, int]:
+  """Parse a shard given as "i/N" on the command line."""
+  try:
+    index, total = (int(part) for part in value.split('/'))
+  except ValueError:
+    raise ValueError(f'Invalid shard {value!r}, expected i/N') from None
+  if total < 1 or not 0 <= index < total:
+    raise ValueError(f'Invalid shard {value!r}, expected 0 <= i < N')
+  return index, total
+
+
+def shard_dir(out_dir: str, index: int, total: int) -> str:
+  return os.path.join(out_dir, f'shard-{index}-of-{total}')
+
+
+def run_shards(num_shards: int, out_dir: str,
+               crawl: Callable[[Tuple[int, int], str], Any]) -> int:
+  """Run a scan in num_shards processes and merge their output.
+
+  Every process gets its own directory seeded with the state files of
+  out_dir, so learned crawler costs and cached denials carry over.
+
+  Args:
+    num_shards: A number of processes to run.
+    out_dir: A directory to merge the results into.
+    crawl: A function called in each process with (shard, shard directory).
+
+  Returns:
+    A number of shards that failed.
+  """
+
+  # Forked children inherit credentials as they are, without pickling.
+  context = multiprocessing.get_context('fork')
+  processes = list()
+  for index in range(num_shards):
+    directory = shard_dir(out_dir, index, num_shards)
+    os.makedirs(directory, exist_ok=True)
+    for state_file in (registry.COST_FILE, permcache.CACHE_FILE):
+      if os.path.exists(os.path.join(out_dir, state_file)):
+        shutil.copyfile(os.path.join(out_dir, state_file),
+                        os.path.join(directory, state_file))
+    process = context.Process(
+        target=crawl, args=((index, num_shards), directory),
+        name=f'shard-{index}')
+    process.start()
+    processes.append((process, directory))
+
+  failed = 0
+  for process, _ in processes:
+    process.join()
+    if process.exitcode != 0:
+      logging.error('Shard %s exited with code %s', process.name,
+                    process.exitcode)
+      failed += 1
+
+  merge_shards([directory for _, directory in processes], out_dir)
+  for _, directory in processes:
+    shutil.rmtree(directory, ignore_errors=True)
+  return failed
+
+
+def _load_json(path: str, default: Any) -> Any:
+  if not os.path.exists(path):
+    return default
+  try:
+    with open(path, 'r', encoding='utf-8') as f:
+      return json.load(f)
+  except (OSError, ValueError):
+    logging.warning('Ignoring unreadable file %s', path)
+    return default
+
+
+def _write_json(path: str, data: Any) -> None:
+  tmp_path = path + '.tmp'
+  with open(tmp_path, 'w', encoding='utf-8') as f:
+    json.dump(data, f, indent=2, sort_keys=True)
+  os.replace(tmp_path, path)
+
+
+def merge_shards(shard_dirs: List[str], out_dir: str) -> None:
+  """Combine the output of shards into out_dir.
+
+  Project files are appended to the file of the same name, as a scan does
+  for every service account. Edge lists are concatenated, crawler costs are
+  averaged and permission denials are united, keeping the latest. Manifest
+  entries are combined.
+
+  Args:
+    shard_dirs: Output directories of the shards.
+    out_dir: A directory to merge into. May be one of shard_dirs.
+  """
+
+  os.makedirs(out_dir, exist_ok=True)
+  edges = list()
+  costs: Dict[str, List[float]] = dict()
+  denials: Dict[str, float] = dict()
+  for directory in shard_dirs:
+    edges.extend(_load_json(os.path.join(directory, EDGES_FILE), []))
+    for key, cost in _load_json(os.path.join(directory, registry.COST_FILE),
+                                {}).items():
+      costs.setdefault(key, []).append(cost)
+    for key, denied_at in _load_json(
+        os.path.join(directory, permcache.CACHE_FILE), {}).items():
+      denials[key] = max(denied_at, denials.get(key, denied_at))
+    if os.path.abspath(directory) == os.path.abspath(out_dir):
+      continue
+
+    for file_name in sorted(os.listdir(directory)):
+      if (not file_name.endswith(('.json', OBJECTS_SUFFIX))
+          or file_name in STATE_FILES):
+        continue
+      with open(os.path.join(directory, file_name), 'rb') as src, \
+          open(os.path.join(out_dir, file_name), 'ab') as dst:
+        shutil.copyfileobj(src, dst)
+
+  _write_json(os.path.join(out_dir, EDGES_FILE), _unique(edges))
+  if costs:
+    _write_json(os.path.join(out_dir, registry.COST_FILE),
+                {key: sum(values) / len(values) for key, values in costs.items()})
+  if denials:
+    _write_json(os.path.join(out_dir, permcache.CACHE_FILE), denials)
+  _merge_graphs(shard_dirs, out_dir)
+  _merge_profiles(shard_dirs, out_dir)
+  _merge_manifests(shard_dirs, out_dir)
+
+
+def _merge_graphs(shard_dirs: List[str], out_dir: str) -> None:
+  graph_paths = [os.path.join(directory, GRAPH_FILE)
+                 for directory in shard_dirs
+                 if os.path.exists(os.path.join(directory, GRAPH_FILE))]
+  if not graph_paths:
+    return
+  # Imported here: only scans run with --privilege-graph need numpy.
+  from . import privgraph  # pylint: disable=import-outside-toplevel
+  graph = privgraph.PrivilegeGraph()
+  for graph_path in graph_paths:
+    graph.update(privgraph.load(graph_path))
+  graph.save(os.path.join(out_dir, GRAPH_FILE))
+
+
+def _merge_manifests(shard_dirs: List[str], out_dir: str) -> None:
+  # Project files are appended to those of out_dir, so are their entries.
+  directories = [out_dir] + [
+      directory for directory in shard_dirs
+      if os.path.abspath(directory) != os.path.abspath(out_dir)]
+  paths = [os.path.join(directory, MANIFEST_FILE) for directory in directories
+           if os.path.exists(os.path.join(directory, MANIFEST_FILE))]
+  if not paths:
+    return
+  from . import manifest  # pylint: disable=import-outside-toplevel
+  manifest.write(os.path.join(out_dir, MANIFEST_FILE),
+                 manifest.merge([manifest.load(path) for path in paths]))
+
+
+def _merge_profiles(shard_dirs: List[str], out_dir: str) -> None:
+  # Collapsed stacks add up; summaries are kept per shard.
+  target = os.path.join(out_dir, profiling.PROFILE_DIR)
+  for directory in shard_dirs:
+    source = os.path.join(directory, profiling.PROFILE_DIR)
+    if (not os.path.isdir(source)
+        or os.path.abspath(directory) == os.path.abspath(out_dir)):
+      continue
+    os.makedirs(target, exist_ok=True)
+    with open(os.path.join(source, 'cpu.collapsed'), 'rb') as src, \
+        open(os.path.join(target, 'cpu.collapsed'), 'ab') as dst:
+      shutil.copyfileobj(src, dst)
+    shutil.copyfile(
+        os.path.join(source, 'summary.txt'),
+        os.path.join(target,
+                     'summary-%s.txt' % os.path.basename(directory.rstrip('/'))))
+
+
+def _unique(edges: List[Dict[str, Any]]) -> List[Dict[str, Any]]:
+  seen = set()
+  unique_edges = list()
+  for edge in edges:
+    key = json.dumps(edge, sort_keys=True)
+    if key not in seen:
+      seen.add(key)
+      unique_edges.append(edge)
+  return unique_edges
+
+
+def in_shard(project_id: str, shard: Optional[Tuple[int, int]]) -> bool:
+  if shard is None:
+    return True
+  index, total = shard
+  return shard_of(project_id, total) == index
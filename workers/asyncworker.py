@@ -1,18 +1,68 @@
 import asyncio
-from ..crawlers import (ComputeManager,
-                        DBManager,
-                        GKEManager,
-                        MQManager,
-                        NetworkManager,
-                        ServerlessManager,
-                        SourceRepoManager,
-                        StorageManager)
+import collections
+import logging
+import os
+import sys
+import threading
+import time
+from ..crawlers import registry
+
+# Seconds a crawler may overrun its deadline before it is abandoned.
+DEADLINE_GRACE = 5.0
+
+_loop = None
+_loop_pid = None
+_loop_lock = threading.Lock()
+
+
+def get_loop():
+    """Return the event loop running Worker coroutines.
+
+    One loop serves every Worker of the process, so async clients and their
+    channels can be shared between projects.
+    """
+    global _loop, _loop_pid
+    with _loop_lock:
+        # A loop thread does not survive fork, so children start their own.
+        if _loop is None or _loop_pid != os.getpid():
+            _loop = asyncio.new_event_loop()
+            _loop_pid = os.getpid()
+            threading.Thread(target=_loop.run_forever, name='worker-loop',
+                             daemon=True).start()
+        return _loop
+
+
 class Worker:
-    def __init__(self,scan_config,project_name, credentials):
+    def __init__(self,scan_config,project_name, credentials, cost_model=None,
+                 crawler_timeout=None, project_timeout=None,
+                 enabled_services=None, identity=None, permission_cache=None,
+                 crawler_options=None, prefilled=None):
         self.scan_config = scan_config
         self.project_name = project_name
         self.credentails = credentials
+        self.cost_model = cost_model
+        self.crawler_timeout = crawler_timeout
+        self.project_timeout = project_timeout
+        self.enabled_services = enabled_services
+        self.identity = identity
+        self.permission_cache = permission_cache
+        # resource key -> extra keyword arguments of the crawler
+        self.crawler_options = crawler_options or {}
+        # result key -> result known before the crawl, e.g. from an asset
+        # inventory
+        self.prefilled = prefilled or {}
+        # resource key -> results of crawlers whose tasks are all prefilled
+        self.prefilled_results = {}
         self.crawler_list = []
+        # resource key -> details about crawlers stopped by a deadline
+        self.truncated = {}
+        # result key -> services of tasks skipped as disabled in the project
+        self.disabled = {}
+        # API methods denied to the identity in the project
+        self.denied = set()
+        # API calls sent by the crawlers, and failed ones by API method
+        self.api_calls = 0
+        self.errors = collections.Counter()
 
     def is_set(self,config, config_setting):
         if config is None:
@@ -20,42 +70,109 @@ class Worker:
         obj = config.get(config_setting, {})
         return obj.get('fetch', False)
 
+    def timeout_for(self, resource_key):
+        # A "timeout" in the resource's scan config section overrides the
+        # default crawler timeout.
+        if self.scan_config is not None:
+            timeout = self.scan_config.get(resource_key, {}).get('timeout')
+            if timeout is not None:
+                return timeout
+        return self.crawler_timeout
+
     def spawn_crawlers(self):
-        if self.is_set(self.scan_config, 'compute_instances'):
-            self.crawler_list.append(ComputeManager(self.project_name,self.credentails))
-            
-        if self.is_set(self.scan_config, 'db_instances'):
-            self.crawler_list.append(DBManager(self.project_name,self.credentails))
-
-        if self.is_set(self.scan_config, 'gke_instances'):
-            self.crawler_list.append(GKEManager(self.project_name,self.credentails))
-        
-        if self.is_set(self.scan_config, 'mq_instances'):
-            self.crawler_list.append(MQManager(self.project_name,self.credentails))
-
-        if self.is_set(self.scan_config, 'network_instances'):
-            self.crawler_list.append(NetworkManager(self.project_name,self.credentails))
-        
-        if self.is_set(self.scan_config, 'serverless_instances'):
-            self.crawler_list.append(ServerlessManager(self.project_name,self.credentails))
-
-        if self.is_set(self.scan_config, 'sourcerepo_instances'):
-            self.crawler_list.append(SourceRepoManager(self.project_name,self.credentails))
-
-        if self.is_set(self.scan_config, 'storage_instances'):
-            self.crawler_list.append(StorageManager(self.project_name,self.credentails))
-        
+        # Only the managers enabled in scan_config are imported. The most
+        # expensive crawlers come first so that they start first.
+        specs = registry.schedule(registry.enabled_specs(self.scan_config),
+                                  self.cost_model)
+        for spec in specs:
+            crawler_class = registry.load_crawler(spec.resource_key)
+            if crawler_class.task_apis and all(
+                    key in self.prefilled for key in crawler_class.task_apis):
+                # Nothing is left to crawl, so the crawler and its API
+                # clients are not created.
+                self.prefilled_results[spec.resource_key] = {
+                    key: self.prefilled[key]
+                    for key in crawler_class.task_apis}
+                continue
+            crawler = crawler_class(
+                self.project_name, self.credentails,
+                **self.crawler_options.get(spec.resource_key, {}))
+            crawler.enabled_services = self.enabled_services
+            crawler.identity = self.identity
+            crawler.permission_cache = self.permission_cache
+            crawler.prefilled = self.prefilled
+            self.crawler_list.append((spec, crawler))
+
         return self.crawler_list
 
     async def work(self):
         self.crawler_list = self.spawn_crawlers()
-        results = []
-        for crawler in self.crawlers_list:
-            result = await crawler.crawl()
-            results.append(result)
-        return results
-    
-    async def run(self):
-        loop = asyncio.get_event_loop()
-        results = await loop.run_until_complete(self.work())
-        return results
\ No newline at end of file
+        finished = {spec.resource_key: asyncio.Event()
+                    for spec, _ in self.crawler_list}
+        project_deadline = None
+        if self.project_timeout is not None:
+            project_deadline = time.monotonic() + self.project_timeout
+
+        async def run_crawler(spec, crawler):
+            try:
+                for dependency in spec.depends_on:
+                    if dependency in finished:
+                        await finished[dependency].wait()
+                start = time.monotonic()
+                deadlines = [project_deadline]
+                timeout = self.timeout_for(spec.resource_key)
+                if timeout is not None:
+                    deadlines.append(start + timeout)
+                deadlines = [d for d in deadlines if d is not None]
+                if deadlines:
+                    crawler.deadline = min(deadlines)
+                    # The crawler stops by itself at its deadline; the grace
+                    # period only covers calls that never return.
+                    await asyncio.wait_for(
+                        crawler.crawl(),
+                        timeout=max(crawler.deadline - start, 0)
+                        + DEADLINE_GRACE)
+                else:
+                    await crawler.crawl()
+                if self.cost_model is not None and not crawler.truncated:
+                    self.cost_model.observe(spec.resource_key,
+                                            time.monotonic() - start)
+            except asyncio.TimeoutError:
+                crawler.truncated = True
+            except Exception:
+                # Siblings keep running; what was crawled so far is kept.
+                logging.info('Failed to crawl %s in %s', spec.resource_key,
+                             self.project_name)
+                logging.info(sys.exc_info())
+                self.errors['crawler:' + spec.resource_key] += 1
+            finally:
+                finished[spec.resource_key].set()
+
+            self.disabled.update(crawler.disabled)
+            self.denied.update(crawler.denied)
+            self.api_calls += crawler.api_calls
+            self.errors.update(crawler.errors)
+            if crawler.truncated:
+                logging.warning('Crawling %s in %s stopped at its deadline',
+                                spec.resource_key, self.project_name)
+                self.truncated[spec.resource_key] = {
+                    'pending': crawler.pending_tasks(),
+                    'resume_token': crawler.resume_token,
+                }
+            return crawler.results
+
+        # Tasks are started in schedule order, so the longest crawlers are
+        # the first to reach the thread pool.
+        results = await asyncio.gather(
+            *(run_crawler(spec, crawler) for spec, crawler in self.crawler_list))
+        crawled = dict(self.prefilled_results)
+        crawled.update((spec.resource_key, result)
+                       for (spec, _), result in zip(self.crawler_list, results))
+        return crawled
+
+    def start(self):
+        """Start crawling in the background and return a future of results."""
+        return asyncio.run_coroutine_threadsafe(self.work(), get_loop())
+
+    def run(self):
+        return self.start().result()
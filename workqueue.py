@@ -0,0 +1,370 @@
+# Copyright 2022 Google LLC
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     https://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+
+"""The module with work queues shared by scanner processes.
+
+A work item is a service account, optionally paired with a project. An item
+without a project asks to list the projects the account can see; an item
+with a project asks to crawl it. Items are leased to a worker and acked when
+done, so several processes or hosts can pull from the same queue and an item
+whose worker died is handed out again once its lease expires. A
+LeaseRenewer keeps the leases of long crawls from expiring.
+
+Credentials never leave a process. Each item carries the chain of service
+accounts used to reach it, from which a worker holding the initial
+credentials re-creates the impersonated ones.
+"""
+
+import abc
+import collections
+import json
+import logging
+import os
+import sqlite3
+import sys
+import threading
+import time
+import uuid
+from typing import Any, Deque, Dict, List, NamedTuple, Optional
+
+
+class Lease(NamedTuple):
+  """A work item handed to a worker.
+
+  Attributes:
+    lease_id: An id to ack or release the item with.
+    sa_name: A service account to work as.
+    project_id: A project to crawl, or None to list projects.
+    chain: Service accounts impersonated to reach sa_name.
+    payload: Data stored with the item, such as project info.
+    credentials: Credentials of sa_name if known to this process.
+  """
+  lease_id: str
+  sa_name: str
+  project_id: Optional[str]
+  chain: List[str]
+  payload: Any = None
+  credentials: Any = None
+
+
+class WorkQueue(abc.ABC):
+  """Interface of work queue backends."""
+
+  # Seconds a lease lasts unless renewed, None when leases do not expire.
+  lease_seconds: Optional[float] = None
+
+  @abc.abstractmethod
+  def put(self, sa_name: str, chain: List[str],
+          project_id: Optional[str] = None, payload: Any = None,
+          credentials: Any = None) -> bool:
+    """Add an item unless it was queued before. Returns True if added."""
+
+  @abc.abstractmethod
+  def lease(self, wait: float = 0) -> Optional[Lease]:
+    """Take the next item.
+
+    Service account items come before project items, so that traversal of
+    the service account graph runs ahead of resource crawls.
+
+    Args:
+      wait: Seconds to wait for new items while other workers hold leases.
+
+    Returns:
+      A lease, or None when no item is available.
+    """
+
+  def renew(self, lease_id: str) -> None:
+    """Extend a lease held for a long running item."""
+
+  @abc.abstractmethod
+  def ack(self, lease_id: str) -> None:
+    """Mark a leased item as done."""
+
+  @abc.abstractmethod
+  def release(self, lease_id: str) -> None:
+    """Return a leased item to the queue for another worker."""
+
+  @abc.abstractmethod
+  def add_edge(self, source: str, target: str, project_id: str,
+               chain: List[str]) -> None:
+    """Record that source impersonated target via project_id."""
+
+  @abc.abstractmethod
+  def edges(self) -> List[Dict[str, Any]]:
+    """Return the recorded impersonations."""
+
+  @abc.abstractmethod
+  def pending(self) -> int:
+    """Return a number of items not yet done."""
+
+
+class LocalWorkQueue(WorkQueue):
+  """In-process queue used when a single process runs the traversal."""
+
+  def __init__(self):
+    self._items: Deque[Lease] = collections.deque()
+    self._accounts: Deque[Lease] = collections.deque()
+    self._seen = set()
+    self._leased: Dict[str, Lease] = dict()
+    self._edges: List[Dict[str, Any]] = list()
+    self._lock = threading.Lock()
+
+  def put(self, sa_name, chain, project_id=None, payload=None,
+          credentials=None):
+    with self._lock:
+      if (sa_name, project_id) in self._seen:
+        return False
+      self._seen.add((sa_name, project_id))
+      queue = self._accounts if project_id is None else self._items
+      queue.append(
+          Lease(uuid.uuid4().hex, sa_name, project_id, list(chain), payload,
+                credentials))
+      return True
+
+  def lease(self, wait=0):
+    with self._lock:
+      queue = self._accounts or self._items
+      if not queue:
+        return None
+      item = queue.popleft()
+      self._leased[item.lease_id] = item
+      return item
+
+  def ack(self, lease_id):
+    with self._lock:
+      self._leased.pop(lease_id, None)
+
+  def release(self, lease_id):
+    with self._lock:
+      item = self._leased.pop(lease_id, None)
+      if item is not None:
+        queue = self._accounts if item.project_id is None else self._items
+        queue.appendleft(item)
+
+  def add_edge(self, source, target, project_id, chain):
+    with self._lock:
+      self._edges.append({'source': source, 'target': target,
+                          'project': project_id, 'chain': list(chain)})
+
+  def edges(self):
+    with self._lock:
+      return list(self._edges)
+
+  def pending(self):
+    with self._lock:
+      return len(self._accounts) + len(self._items) + len(self._leased)
+
+
+class SQLiteWorkQueue(WorkQueue):
+  """Queue kept in a SQLite file shared by processes of one host.
+
+  SQLite locking makes leasing safe across processes. Hosts may share the
+  file over a network file system only if it provides reliable locks.
+  """
+
+  def __init__(self, path: str, lease_seconds: float = 600,
+               poll_interval: float = 1.0):
+    self.path = path
+    self.lease_seconds = lease_seconds
+    self.poll_interval = poll_interval
+    self.owner = f'{os.uname().nodename}:{os.getpid()}'
+    # Credentials created by this process, by service account name.
+    self._credentials: Dict[str, Any] = dict()
+    # A connection per thread, e.g. for the LeaseRenewer
+    self._local = threading.local()
+    with self._transaction() as db:
+      db.execute('CREATE TABLE IF NOT EXISTS items ('
+                 ' sa_name TEXT NOT NULL,'
+                 ' project_id TEXT NOT NULL,'
+                 ' chain TEXT NOT NULL,'
+                 ' payload TEXT,'
+                 ' state TEXT NOT NULL,'
+                 ' lease_id TEXT,'
+                 ' lease_expires REAL,'
+                 ' owner TEXT,'
+                 ' added REAL NOT NULL,'
+                 ' PRIMARY KEY (sa_name, project_id))')
+      db.execute('CREATE INDEX IF NOT EXISTS items_state'
+                 ' ON items (state, added)')
+      db.execute('CREATE TABLE IF NOT EXISTS edges ('
+                 ' source TEXT NOT NULL,'
+                 ' target TEXT NOT NULL,'
+                 ' project_id TEXT NOT NULL,'
+                 ' chain TEXT NOT NULL,'
+                 ' PRIMARY KEY (source, target, project_id))')
+    done = self._db().execute(
+        "SELECT COUNT(*) FROM items WHERE state = 'done'").fetchone()[0]
+    if done:
+      # Items are keyed by service account and project, so these are not
+      # queued again.
+      logging.warning('Work queue %s has %d items done by earlier runs, which'
+                      ' are skipped. Use a new queue file to scan them again.',
+                      path, done)
+
+  def _db(self) -> sqlite3.Connection:
+    # A connection must not be shared with forked children, nor used by two
+    # threads at once.
+    local = self._local
+    if getattr(local, 'connection', None) is None or local.pid != os.getpid():
+      local.connection = sqlite3.connect(
+          self.path, timeout=60, isolation_level=None)
+      local.pid = os.getpid()
+    return local.connection
+
+  class _Transaction:
+
+    def __init__(self, db: sqlite3.Connection):
+      self.db = db
+
+    def __enter__(self) -> sqlite3.Connection:
+      self.db.execute('BEGIN IMMEDIATE')
+      return self.db
+
+    def __exit__(self, exc_type, exc, tb):
+      self.db.execute('ROLLBACK' if exc_type else 'COMMIT')
+
+  def _transaction(self) -> '_Transaction':
+    return self._Transaction(self._db())
+
+  def put(self, sa_name, chain, project_id=None, payload=None,
+          credentials=None):
+    if credentials is not None:
+      self._credentials[sa_name] = credentials
+    with self._transaction() as db:
+      cursor = db.execute(
+          'INSERT OR IGNORE INTO items (sa_name, project_id, chain, payload,'
+          ' state, added) VALUES (?, ?, ?, ?, ?, ?)',
+          (sa_name, project_id or '', json.dumps(chain), json.dumps(payload),
+           'pending', time.time()))
+      return cursor.rowcount == 1
+
+  def _try_lease(self) -> Optional[Lease]:
+    now = time.time()
+    with self._transaction() as db:
+      row = db.execute(
+          'SELECT sa_name, project_id, chain, payload FROM items'
+          " WHERE state = 'pending'"
+          " OR (state = 'leased' AND lease_expires < ?)"
+          " ORDER BY project_id != '', added LIMIT 1", (now,)).fetchone()
+      if row is None:
+        return None
+      sa_name, project_id, chain, payload = row
+      lease_id = uuid.uuid4().hex
+      db.execute(
+          "UPDATE items SET state = 'leased', lease_id = ?, lease_expires = ?,"
+          ' owner = ? WHERE sa_name = ? AND project_id = ?',
+          (lease_id, now + self.lease_seconds, self.owner, sa_name,
+           project_id))
+    return Lease(lease_id, sa_name, project_id or None, json.loads(chain),
+                 json.loads(payload), self._credentials.get(sa_name))
+
+  def lease(self, wait=0):
+    deadline = time.monotonic() + wait
+    while True:
+      item = self._try_lease()
+      if item is not None or self.pending() == 0:
+        return item
+      if time.monotonic() >= deadline:
+        return None
+      time.sleep(self.poll_interval)
+
+  def renew(self, lease_id):
+    with self._transaction() as db:
+      db.execute('UPDATE items SET lease_expires = ? WHERE lease_id = ?',
+                 (time.time() + self.lease_seconds, lease_id))
+
+  def ack(self, lease_id):
+    with self._transaction() as db:
+      cursor = db.execute(
+          "UPDATE items SET state = 'done', lease_id = NULL"
+          ' WHERE lease_id = ?', (lease_id,))
+      if cursor.rowcount == 0:
+        logging.warning('Lease %s expired before it was acked', lease_id)
+
+  def release(self, lease_id):
+    with self._transaction() as db:
+      db.execute(
+          "UPDATE items SET state = 'pending', lease_id = NULL"
+          ' WHERE lease_id = ?', (lease_id,))
+
+  def add_edge(self, source, target, project_id, chain):
+    with self._transaction() as db:
+      db.execute(
+          'INSERT OR IGNORE INTO edges (source, target, project_id, chain)'
+          ' VALUES (?, ?, ?, ?)',
+          (source, target, project_id, json.dumps(chain)))
+
+  def edges(self):
+    rows = self._db().execute(
+        'SELECT source, target, project_id, chain FROM edges').fetchall()
+    return [{'source': source, 'target': target, 'project': project_id,
+             'chain': json.loads(chain)}
+            for source, target, project_id, chain in rows]
+
+  def pending(self):
+    return self._db().execute(
+        "SELECT COUNT(*) FROM items WHERE state != 'done'").fetchone()[0]
+
+
+class LeaseRenewer:
+  """Renews leases held for long running items from a background thread.
+
+  Args:
+    queue: The queue the leases were taken from.
+    interval: Seconds between renewals, a third of the lease duration by
+      default.
+  """
+
+  def __init__(self, queue: WorkQueue, interval: Optional[float] = None):
+    self.queue = queue
+    if interval is None and queue.lease_seconds is not None:
+      interval = queue.lease_seconds / 3
+    self.interval = interval
+    self._held = set()
+    self._lock = threading.Lock()
+    self._stopped = threading.Event()
+    self._thread: Optional[threading.Thread] = None
+
+  def start(self) -> 'LeaseRenewer':
+    # Leases that do not expire need no renewal.
+    if self.interval is not None:
+      self._thread = threading.Thread(target=self._run, name='lease-renewer',
+                                      daemon=True)
+      self._thread.start()
+    return self
+
+  def hold(self, lease_id: str) -> None:
+    with self._lock:
+      self._held.add(lease_id)
+
+  def drop(self, lease_id: str) -> None:
+    with self._lock:
+      self._held.discard(lease_id)
+
+  def _run(self) -> None:
+    while not self._stopped.wait(self.interval):
+      with self._lock:
+        held = list(self._held)
+      for lease_id in held:
+        try:
+          self.queue.renew(lease_id)
+        except Exception:
+          logging.info('Failed to renew lease %s', lease_id)
+          logging.info(sys.exc_info())
+
+  def stop(self) -> None:
+    self._stopped.set()
+    if self._thread is not None:
+      self._thread.join()